@@ -0,0 +1,10 @@
+"""
+Asynchronous Server Gateway Interface (ASGI) entry point
+"""
+
+from service.aio import create_app
+
+app = create_app()
+
+if __name__ == "__main__":
+    app.run(host="0.0.0.0")
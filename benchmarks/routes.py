@@ -0,0 +1,355 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Route benchmark
+
+Drives list/read/create/update/delete load through every counter route
+and reports the throughput and p50/p95/p99 latency of each. The service
+runs in-process behind the Flask test client (or is reached over HTTP
+with --url) and Redis is either a redis-server spawned on a free port
+or an in-process fakeredis server, so no existing data is touched.
+
+The cold start (importing and creating the app, and connecting to
+Redis) is timed too. Results are written as JSON with --output. The run
+fails (exit status 1) when any request of a route fails. Given a
+--baseline in the same format it also fails when a route's p95 latency
+or the cold start rises, or a route's throughput falls, by more than
+--margin.
+
+The fakeredis server needs its Lua support (fakeredis[lua]) to run the
+scripts the service writes counters with.
+
+Usage:
+  python benchmarks/routes.py --redis fake --keys 1000 --concurrency 16
+  python benchmarks/routes.py --redis server --output results.json
+  python benchmarks/routes.py --baseline benchmarks/baseline.json --margin 0.25
+"""
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import argparse
+import platform
+import threading
+import subprocess
+import http.client
+from statistics import quantiles
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+ROUTES = ["list", "read", "create", "update", "delete"]
+
+
+######################################################################
+#  R E D I S   B A C K E N D S
+######################################################################
+
+
+def free_port() -> int:
+    """Returns a TCP port nobody is listening on"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = 10.0) -> None:
+    """Waits until something accepts connections on the port"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Redis on port {port} did not start")
+
+
+def start_redis(kind: str):
+    """Starts a throwaway Redis and returns (database_uri, stop function)"""
+    port = free_port()
+    if kind == "server":
+        if not shutil.which("redis-server"):
+            raise RuntimeError("redis-server is not installed, use --redis fake")
+        server = subprocess.Popen(  # pylint: disable=consider-using-with
+            ["redis-server", "--port", str(port), "--save", "", "--appendonly", "no"],
+            stdout=subprocess.DEVNULL,
+        )
+
+        def stop():
+            server.terminate()
+            server.wait()
+
+    else:
+        try:
+            from fakeredis import TcpFakeServer  # pylint: disable=import-outside-toplevel
+        except ImportError as err:
+            raise RuntimeError("fakeredis is not installed, use --redis server") from err
+        try:
+            import lupa  # noqa: F401 pylint: disable=import-outside-toplevel,unused-import
+        except ImportError as err:
+            raise RuntimeError("fakeredis cannot run scripts without lupa, install fakeredis[lua]") from err
+        server = TcpFakeServer(("127.0.0.1", port), server_type="redis")
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        def stop():
+            server.shutdown()
+            server.server_close()
+
+    wait_for_port(port)
+    return f"redis://127.0.0.1:{port}/0", stop
+
+
+######################################################################
+#  C L I E N T S
+######################################################################
+
+
+class AppClient:  # pylint: disable=too-few-public-methods
+    """Sends requests to the service in this process"""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def send(self, method: str, path: str) -> int:
+        """Sends one request and returns its status code"""
+        return self.client.open(path, method=method).status_code
+
+
+class HttpClient:  # pylint: disable=too-few-public-methods
+    """Sends requests to a running service over one keep-alive connection"""
+
+    def __init__(self, url: str):
+        parts = urlsplit(url)
+        self.conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+
+    def send(self, method: str, path: str) -> int:
+        """Sends one request and returns its status code"""
+        self.conn.request(method, path)
+        resp = self.conn.getresponse()
+        resp.read()
+        return resp.status
+
+
+######################################################################
+#  L O A D
+######################################################################
+
+
+def timed(client, method: str, path: str) -> tuple:
+    """Sends one request and returns (latency in seconds, failed)"""
+    start = time.perf_counter()
+    code = client.send(method, path)
+    return time.perf_counter() - start, code >= 400
+
+
+def requests_for(route: str, worker: int, count: int, keys: int) -> list:
+    """Returns the (method, path) pairs one client sends for a route"""
+    if route == "list":
+        return [("GET", "/counters?limit=100")] * count
+    if route in ("create", "delete"):
+        method = "POST" if route == "create" else "DELETE"
+        return [(method, f"/counters/new-{worker}-{i}") for i in range(count)]
+    method = "GET" if route == "read" else "PUT"
+    return [(method, f"/counters/key-{(worker * count + i) % keys}") for i in range(count)]
+
+
+def run_route(make_client, route: str, total: int, concurrency: int, keys: int) -> dict:
+    """Sends total requests for a route from concurrency clients"""
+    per_client = max(1, total // concurrency)
+
+    def client(worker: int) -> list:
+        conn = make_client()
+        return [timed(conn, method, path) for method, path in requests_for(route, worker, per_client, keys)]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = [result for batch in pool.map(client, range(concurrency)) for result in batch]
+    elapsed = time.perf_counter() - start
+
+    latencies = [latency for latency, _ in results]
+    cuts = quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return {
+        "requests": len(latencies),
+        "errors": sum(1 for _, failed in results if failed),
+        "throughput": len(latencies) / elapsed,
+        "p50": cuts[49] * 1000,
+        "p95": cuts[94] * 1000,
+        "p99": cuts[98] * 1000,
+    }
+
+
+def start_app(timeout: float = 30.0) -> tuple:
+    """Imports and creates the app and returns (app, cold start times in ms)
+
+    The app is ready once create_app returns, Redis is connected in the
+    background a little later
+    """
+    start = time.perf_counter()
+    from service import create_app  # pylint: disable=import-outside-toplevel
+
+    app = create_app()
+    ready = time.perf_counter()
+    deadline = ready + timeout
+    while app.extensions["startup"]["redis_seconds"] is None:
+        if time.perf_counter() > deadline:
+            raise RuntimeError("The service did not connect to Redis")
+        time.sleep(0.001)
+    connected = time.perf_counter()
+    return app, {"app_ms": (ready - start) * 1000, "redis_ms": (connected - start) * 1000}
+
+
+def populate(client, keys: int) -> None:
+    """Creates the counters that read and update work on"""
+    for i in range(keys):
+        client.send("POST", f"/counters/key-{i}")
+
+
+######################################################################
+#  B A S E L I N E
+######################################################################
+
+
+def route_errors(results: dict) -> list:
+    """Returns a message for every route that had failed requests"""
+    return [
+        f"{route}: {stats['errors']} of {stats['requests']} requests failed"
+        for route, stats in results["routes"].items()
+        if stats["errors"]
+    ]
+
+
+def compare(results: dict, baseline: dict, margin: float) -> list:
+    """Returns a message for every route that failed requests or is worse than the baseline by more than margin"""
+    regressions = route_errors(results)
+    for phase, elapsed in (results.get("startup") or {}).items():
+        base = (baseline.get("startup") or {}).get(phase)
+        if base and elapsed > base * (1 + margin):
+            regressions.append(f"startup {phase}: {elapsed:.1f} ms > baseline {base:.1f} ms + {margin:.0%}")
+    for route, stats in results["routes"].items():
+        base = baseline.get("routes", {}).get(route)
+        if not base:
+            continue
+        if stats["p95"] > base["p95"] * (1 + margin):
+            regressions.append(f"{route}: p95 {stats['p95']:.2f} ms > baseline {base['p95']:.2f} ms + {margin:.0%}")
+        if stats["throughput"] < base["throughput"] * (1 - margin):
+            regressions.append(
+                f"{route}: {stats['throughput']:.0f} req/s < baseline {base['throughput']:.0f} req/s - {margin:.0%}"
+            )
+    return regressions
+
+
+######################################################################
+#  M A I N
+######################################################################
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    """Parses the command line"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--routes", default=",".join(ROUTES), help="comma separated routes to run")
+    parser.add_argument("--requests", type=int, default=2000, help="requests per route")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent clients")
+    parser.add_argument("--keys", type=int, default=1000, help="counters created before the run")
+    parser.add_argument("--redis", choices=["fake", "server"], default="fake", help="Redis to start for the run")
+    parser.add_argument("--url", help="benchmark a running service instead (it must use a disposable Redis)")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--margin", type=float, default=0.2, help="allowed regression as a fraction (0.2 = 20%%)")
+    args = parser.parse_args(argv)
+    args.routes = [route for route in args.routes.split(",") if route]
+    unknown = set(args.routes) - set(ROUTES)
+    if unknown:
+        parser.error(f"unknown routes: {', '.join(sorted(unknown))}")
+    return args
+
+
+def benchmark(args: argparse.Namespace, make_client) -> dict:
+    """Runs every route and returns the results"""
+    populate(make_client(), args.keys)
+    results = {
+        "config": {
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "keys": args.keys,
+            "redis": "url" if args.url else args.redis,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+        },
+        "routes": {},
+    }
+    print(f"{'route':<10}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    # create runs before delete so that delete removes the counters create made
+    for route in [route for route in ROUTES if route in args.routes]:
+        stats = run_route(make_client, route, args.requests, args.concurrency, args.keys)
+        results["routes"][route] = stats
+        print(
+            f"{route:<10}{stats['requests']:>10}{stats['errors']:>8}{stats['throughput']:>10.0f}"
+            f"{stats['p50']:>10.2f}{stats['p95']:>10.2f}{stats['p99']:>10.2f}"
+        )
+    return results
+
+
+def main(argv=None) -> int:
+    """Runs the benchmark and checks it against the baseline"""
+    args = parse_args(argv)
+
+    stop = None
+    startup = None
+    if args.url:
+        url = args.url
+
+        def make_client():
+            return HttpClient(url)
+
+    else:
+        os.environ["DATABASE_URI"], stop = start_redis(args.redis)
+        app, startup = start_app()
+
+        def make_client():
+            return AppClient(app)
+
+    try:
+        results = benchmark(args, make_client)
+        results["startup"] = startup
+    finally:
+        if stop:
+            stop()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+            file.write("\n")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            regressions = compare(results, json.load(file), args.margin)
+    else:
+        regressions = route_errors(results)
+    for message in regressions:
+        print(f"REGRESSION {message}")
+    if regressions:
+        return 1
+    if args.baseline:
+        print(f"Within {args.margin:.0%} of the baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,131 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Sync vs Async benchmark
+
+Starts the WSGI service under gunicorn and the ASGI service under
+uvicorn, each with a single worker, and drives the same read/update
+load through both so that their throughput and latency can be compared.
+gunicorn is forced to a single-threaded sync worker, whatever
+gunicorn.conf.py would pick, so that one request at a time is compared
+with one event loop. Redis must be running at DATABASE_URI.
+
+Responses that are not 2xx are counted as errors and fail the run
+(exit status 1).
+
+Usage:
+  python benchmarks/sync_vs_async.py --requests 2000 --concurrency 64
+"""
+import os
+import sys
+import time
+import argparse
+import subprocess
+import http.client
+from statistics import quantiles
+from concurrent.futures import ThreadPoolExecutor
+
+SERVERS = {
+    "sync (gunicorn wsgi:app)": [
+        "gunicorn", "--workers", "1", "--worker-class", "sync", "--threads", "1", "--bind", "127.0.0.1:{port}", "wsgi:app"
+    ],
+    "async (uvicorn asgi:app)": ["uvicorn", "--workers", "1", "--port", "{port}", "--log-level", "warning", "asgi:app"],
+}
+
+
+def wait_until_up(port: int, timeout: float = 30.0) -> None:
+    """Waits for the server to answer /ready, i.e. until it has connected to Redis"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            conn.request("GET", "/ready")
+            resp = conn.getresponse()
+            resp.read()
+            if resp.status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError(f"Server on port {port} did not become ready")
+
+
+def request(conn: http.client.HTTPConnection, method: str, path: str) -> tuple:
+    """Sends one request and returns (latency in seconds, failed)"""
+    start = time.perf_counter()
+    conn.request(method, path)
+    resp = conn.getresponse()
+    resp.read()
+    return time.perf_counter() - start, not 200 <= resp.status < 300
+
+
+def drive(port: int, total: int, concurrency: int) -> dict:
+    """Sends total requests from concurrency clients and returns the statistics"""
+    setup = http.client.HTTPConnection("127.0.0.1", port)
+    request(setup, "DELETE", "/counters/bench")
+    request(setup, "POST", "/counters/bench")
+
+    def client(count: int) -> list:
+        conn = http.client.HTTPConnection("127.0.0.1", port)
+        return [request(conn, "PUT" if i % 2 else "GET", "/counters/bench") for i in range(count)]
+
+    per_client = max(1, total // concurrency)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = [result for batch in pool.map(client, [per_client] * concurrency) for result in batch]
+    elapsed = time.perf_counter() - start
+
+    latencies = [latency for latency, _ in results]
+    cuts = quantiles(latencies, n=100)
+    return {
+        "requests": len(latencies),
+        "errors": sum(1 for _, failed in results if failed),
+        "throughput": len(latencies) / elapsed,
+        "p50": cuts[49] * 1000,
+        "p95": cuts[94] * 1000,
+        "p99": cuts[98] * 1000,
+    }
+
+
+def main() -> int:
+    """Runs the benchmark against both servers"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000, help="requests per server")
+    parser.add_argument("--concurrency", type=int, default=64, help="concurrent clients")
+    parser.add_argument("--port", type=int, default=8181, help="port to run the servers on")
+    args = parser.parse_args()
+
+    print(f"{'server':<28}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    failed = False
+    for name, command in SERVERS.items():
+        command = [part.format(port=args.port) for part in command]
+        server = subprocess.Popen(command, env=os.environ.copy())  # pylint: disable=consider-using-with
+        try:
+            wait_until_up(args.port)
+            stats = drive(args.port, args.requests, args.concurrency)
+        finally:
+            server.terminate()
+            server.wait()
+        print(
+            f"{name:<28}{stats['requests']:>10}{stats['errors']:>8}{stats['throughput']:>10.0f}"
+            f"{stats['p50']:>10.2f}{stats['p95']:>10.2f}{stats['p99']:>10.2f}"
+        )
+        failed = failed or stats["errors"] > 0
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
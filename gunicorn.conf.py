@@ -0,0 +1,107 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+# pylint: disable=invalid-name
+"""
+Gunicorn configuration
+
+Gunicorn reads this file from the working directory on start up. The
+workers are sized to the container's cgroup CPU and memory limits (see
+service.common.tuning) and any setting can be forced with a GUNICORN_*
+environment variable. The hooks keep the Prometheus multiprocess
+directory (PROMETHEUS_MULTIPROC_DIR) consistent with the workers that
+are actually running.
+
+The app is preloaded in the master so that workers share its memory.
+The master then only builds the app: DEFER_START keeps it from
+connecting to Redis or starting the write-behind and read cache threads,
+and every worker starts them in post_fork, so no thread or connection
+is ever inherited from the master.
+"""
+import os
+import glob
+import importlib.util
+
+
+def load_tuning():
+    """Loads service/common/tuning.py by its path
+
+    Importing it as service.common.tuning would import the service
+    package, and with it the Prometheus metrics, which open their files
+    in PROMETHEUS_MULTIPROC_DIR before the stale ones are removed below
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "service", "common", "tuning.py")
+    spec = importlib.util.spec_from_file_location("tuning", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def clear_metrics():
+    """Removes the metric files left behind by a previous run
+
+    This runs when the configuration is read, before a preloaded app
+    imports the metrics, so the files of this run are never removed
+    """
+    directory = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        for path in glob.glob(os.path.join(directory, "*.db")):
+            os.remove(path)
+
+
+clear_metrics()
+tuning = load_tuning()
+cpus, memory = tuning.container_limits()
+settings = tuning.tune(cpus, memory)
+
+workers = settings["workers"]
+worker_class = settings["worker_class"]
+threads = settings["threads"]
+worker_connections = settings.get("worker_connections", 1000)
+timeout = settings["timeout"]
+graceful_timeout = settings["graceful_timeout"]
+keepalive = settings["keepalive"]
+preload_app = settings["preload_app"]
+
+if preload_app:
+    # read by service.config when the master preloads the app
+    os.environ["DEFER_START"] = "true"
+
+
+def post_fork(server, worker):  # pylint: disable=unused-argument
+    """Starts the background work of a preloaded app in the worker"""
+    if preload_app:
+        # pylint: disable=import-outside-toplevel
+        from service import start
+
+        start(server.app.wsgi())
+
+
+def child_exit(server, worker):  # pylint: disable=unused-argument
+    """Drops the in-flight gauge of a worker that exited"""
+    # pylint: disable=import-outside-toplevel
+    from service.common.metrics import mark_process_dead
+
+    mark_process_dead(worker.pid)
+
+
+def when_ready(server):
+    """Logs the settings the workers were sized with"""
+    limit = f"{memory // (1024 * 1024)}Mi" if memory else "unlimited"
+    server.log.info(
+        "Tuned for %.2f CPUs and %s memory: %d %s workers, %d threads, timeout %ds, keepalive %ds, preload %s",
+        cpus, limit, workers, worker_class, threads, timeout, keepalive, preload_app,
+    )
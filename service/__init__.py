@@ -15,10 +15,12 @@
 """
 Package for the application models and service routes
 """
+import time
+from typing import Optional
 from flask import Flask
 from flask_redis import FlaskRedis
 from service import config
-from service.common import log_handlers
+from service.common import log_handlers, metrics, serializers
 
 # Globally accessible libraries
 # redis = FlaskRedis()
@@ -29,8 +31,13 @@ from service.common import log_handlers
 ############################################################
 def create_app():
     """Initialize the core application."""
+    started = time.perf_counter()
     app = Flask(__name__)
     app.config.from_object(config)
+    serializers.init_app(app)
+    # ahead of the routes so that their own hooks' responses are counted
+    metrics.init_app(app)
+    app.extensions["startup"] = {"app_seconds": None, "redis_seconds": None}
 
     # Initialize Plugins
     # redis.init_app(app)
@@ -49,14 +56,55 @@ def create_app():
         app.logger.info("  H I T   C O U N T E R   S E R V I C E  ".center(70, "*"))
         app.logger.info(70 * "*")
 
-        app.logger.info("Service initialized!")
+        if not app.config["DEFER_START"]:
+            start(app, started)
 
-        # Initialize the database
-        try:
-            app.logger.info("Initializing the Redis database")
-            models.Counter.connect(app.config["DATABASE_URI"])
-            app.logger.info("Connected!")
-        except models.DatabaseConnectionError as err:
-            app.logger.error(str(err))
+        elapsed = time.perf_counter() - started
+        app.extensions["startup"]["app_seconds"] = elapsed
+        metrics.STARTUP.labels("app").set(elapsed)
+        app.logger.info("Service initialized in %.3f seconds", elapsed)
 
         return app
+
+
+def start(app: Flask, started: Optional[float] = None) -> None:
+    """Connects to Redis in the background and starts the write-behind buffer
+
+    create_app calls this unless DEFER_START is set. gunicorn.conf.py sets
+    it when the app is preloaded, so that the master never starts threads
+    for the workers to inherit, and calls this in every worker after the
+    fork instead.
+
+    Arguments:
+        app: the application created by create_app
+        started: when start up began (perf_counter), now by default
+    """
+    # pylint: disable=import-outside-toplevel
+    from service import models
+
+    started = time.perf_counter() if started is None else started
+
+    def on_connect():
+        """Finishes the set up that needs Redis once it is reachable"""
+        elapsed = time.perf_counter() - started
+        app.extensions["startup"]["redis_seconds"] = elapsed
+        metrics.STARTUP.labels("redis").set(elapsed)
+        app.logger.info("Connected to Redis %.3f seconds after start up", elapsed)
+
+        if app.config["READ_CACHE"]:
+            try:
+                models.Counter.enable_read_cache(app.config["READ_CACHE_SIZE"], app.config["READ_CACHE_CHECK_INTERVAL"])
+            except models.DatabaseConnectionError as err:
+                app.logger.error("Read cache not enabled: %s", err)
+
+    # Connect in the background so that workers boot (and answer
+    # /health) without waiting for Redis, /ready reports when it is up
+    app.logger.info("Initializing the Redis database")
+    models.Counter.connect_in_background(app.config["DATABASE_URI"], app.config, on_connect)
+
+    if app.config["WRITE_BEHIND"]:
+        models.Counter.enable_write_behind(
+            app.config["WRITE_BEHIND_INTERVAL"],
+            app.config["WRITE_BEHIND_MAX_PENDING"],
+            app.config["WRITE_BEHIND_STALENESS"],
+        )
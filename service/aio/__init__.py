@@ -0,0 +1,74 @@
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Package for the asyncio (ASGI) version of the service
+
+Run it with an ASGI server such as:  uvicorn asgi:app
+
+The asyncio service serves a subset of the WSGI service: /health,
+/ready, /stats and listing, creating, reading, incrementing, deleting
+and batch updating counters. It reads sharded counters but leaves the
+leaderboard, rates, unique members, export and import, purge and
+resharding to the WSGI service. It talks to a single Redis server and
+refuses to connect to several DATABASE_URI servers or through Sentinel.
+"""
+import os
+from quart import Quart
+from service import config
+from service.common import log_handlers
+
+
+############################################################
+# Initialize the Quart instance
+############################################################
+def create_app():
+    """Initialize the core application."""
+    static_folder = os.path.join(os.path.dirname(os.path.dirname(__file__)), "static")
+    app = Quart(__name__, static_folder=static_folder)
+    app.config.from_object(config)
+
+    # Include our Routes (error handlers must be imported before the blueprint is registered)
+    # pylint: disable=import-outside-toplevel, unused-import
+    from service.aio import error_handlers, models, routes
+
+    app.register_blueprint(routes.bp)
+
+    # Set up logging for production
+    log_handlers.init_logging(app, "uvicorn.error")
+
+    app.logger.info(70 * "*")
+    app.logger.info("  H I T   C O U N T E R   S E R V I C E  (asyncio)  ".center(70, "*"))
+    app.logger.info(70 * "*")
+
+    @app.before_serving
+    async def connect_database():
+        """Starts connecting to Redis on the event loop that serves requests
+
+        Connecting happens in the background so that the service answers
+        /health without waiting for Redis, /ready reports when it is up
+        """
+        try:
+            app.logger.info("Initializing the Redis database")
+            models.AsyncCounter.connect_in_background(app.config["DATABASE_URI"], app.config)
+        except models.DatabaseConnectionError as err:
+            app.logger.error(str(err))
+
+    @app.after_serving
+    async def disconnect_database():
+        """Stops connecting and closes the Redis connection pool"""
+        await models.AsyncCounter.disconnect()
+
+    app.logger.info("Service initialized!")
+    return app
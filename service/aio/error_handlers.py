@@ -0,0 +1,95 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Error Handlers for the asyncio service
+
+Sends back the same json errors as service.common.error_handlers
+"""
+import math
+from quart import jsonify
+from quart import current_app as app
+from service.common import status
+from service.models import DatabaseConnectionError, CounterNotFoundError, DataValidationError
+from .routes import bp
+
+######################################################################
+# Error Handlers
+######################################################################
+
+
+def error_response(code: int, error: str, message: str):
+    """Returns a json error document with the status code"""
+    if code >= status.HTTP_500_INTERNAL_SERVER_ERROR:
+        app.logger.error(message)
+    else:
+        app.logger.warning(message)
+    return jsonify(status=code, error=error, message=message), code
+
+
+@bp.app_errorhandler(DatabaseConnectionError)
+async def database_connection_error(error):
+    """Handles lost connections to Redis with 503_SERVICE_UNAVAILABLE
+
+    While the circuit breaker is open the response says when to retry
+    """
+    body, code = error_response(status.HTTP_503_SERVICE_UNAVAILABLE, "Service is unavailable", str(error))
+    retry_after = getattr(error.__cause__, "retry_after", None)
+    if retry_after is None:
+        return body, code
+    return body, code, {"Retry-After": str(max(1, math.ceil(retry_after)))}
+
+
+@bp.app_errorhandler(DataValidationError)
+async def data_validation_error(error):
+    """Handles Value Errors from bad data"""
+    return error_response(status.HTTP_400_BAD_REQUEST, "Bad Request", str(error))
+
+
+@bp.app_errorhandler(CounterNotFoundError)
+async def counter_not_found(error):
+    """Handles missing counters with 404_NOT_FOUND"""
+    return error_response(status.HTTP_404_NOT_FOUND, "Not Found", str(error))
+
+
+@bp.app_errorhandler(status.HTTP_400_BAD_REQUEST)
+async def bad_request(error):
+    """Handles bad requests with 400_BAD_REQUEST"""
+    return error_response(status.HTTP_400_BAD_REQUEST, "Bad Request", str(error))
+
+
+@bp.app_errorhandler(status.HTTP_404_NOT_FOUND)
+async def not_found(error):
+    """Handles resources not found with 404_NOT_FOUND"""
+    return error_response(status.HTTP_404_NOT_FOUND, "Not Found", str(error))
+
+
+@bp.app_errorhandler(status.HTTP_405_METHOD_NOT_ALLOWED)
+async def method_not_supported(error):
+    """Handles unsupported HTTP methods with 405_METHOD_NOT_SUPPORTED"""
+    return error_response(status.HTTP_405_METHOD_NOT_ALLOWED, "Method not Allowed", str(error))
+
+
+@bp.app_errorhandler(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+async def mediatype_not_supported(error):
+    """Handles unsupported media requests with 415_UNSUPPORTED_MEDIA_TYPE"""
+    return error_response(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, "Unsupported media type", str(error))
+
+
+@bp.app_errorhandler(status.HTTP_500_INTERNAL_SERVER_ERROR)
+async def internal_server_error(error):
+    """Handles unexpected server error with 500_SERVER_ERROR"""
+    return error_response(status.HTTP_500_INTERNAL_SERVER_ERROR, "Internal Server Error", str(error))
@@ -0,0 +1,481 @@
+######################################################################
+# Copyright 2016, 2024 John Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+# pylint: disable=duplicate-code
+"""
+Async Counter Model
+
+The same counters as service.models.Counter but backed by redis.asyncio
+so that a single worker can have many Redis round trips in flight.
+
+AsyncCounter talks to a single Redis server through the same circuit
+breaker as Counter and reads sharded counters by their shard layout. It
+refuses the multi-node settings (several DATABASE_URI servers or
+Sentinel) that need the hash ring of Counter.
+"""
+import os
+import time
+import random
+import asyncio
+import logging
+import contextlib
+from typing import Dict, Iterable, List, Optional, Self, Tuple
+from redis.asyncio import BlockingConnectionPool, ConnectionPool, Redis
+from redis.commands.core import AsyncScript
+from redis.exceptions import ConnectionError as RedisConnectionError, RedisError
+from service.common.breaker import CircuitBreaker, GuardedAsyncRedis, create_breaker
+from service.common.pool import pool_options
+from service.common.ring import node_name, split_uris
+from service.models import (
+    CREATE_LUA,
+    DELETE_LUA,
+    INCREMENT_EXISTING_LUA,
+    INCREMENT_MANY_LUA,
+    INDEX_KEY,
+    KEY_PREFIX,
+    LEADERBOARD_KEY,
+    RETRY_BACKOFF,
+    RETRY_COUNT,
+    RETRY_DELAY,
+    RETRY_DELAY_MAX,
+    SCAN_COUNT,
+    SERVICE_KEYS,
+    SHARD_LAYOUT_TTL,
+    SHARDS_KEY,
+    VERSION_KEY,
+    CounterNotFoundError,
+    DatabaseConnectionError,
+    check_overflow,
+    counter_key,
+    rate_keys,
+    shard_key,
+    sum_shards,
+    uniques_key,
+    validate_name,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncCounter:
+    """An integer counter that is persisted in Redis
+
+    Unlike Counter the value is read once when the counter is found
+    and every call that talks to Redis is a coroutine
+    """
+
+    redis: Redis = None
+    pool: ConnectionPool = None
+    breaker: CircuitBreaker = None
+    scripts: Dict[str, AsyncScript] = {}
+    # which counters are sharded, cached for SHARD_LAYOUT_TTL seconds
+    layout: Dict[str, int] = {}
+    layout_expires: float = 0.0
+    connector: Optional[asyncio.Task] = None
+
+    def __init__(self, name: str = "hits", value: int = 0):
+        """Constructor
+
+        :param name: Name of the counter (default is "hits")
+        :type name: str
+        :param value: Value of the counter when it was read
+        :type value: int
+        """
+        self.name = name
+        self.value = int(value)
+
+    async def increment(self) -> int:
+        """Increments the counter by 1 and returns (and keeps) the new value
+
+        Raises:
+            CounterNotFoundError: the counter was deleted
+        """
+        value = await AsyncCounter.increment_existing(self.name)
+        if value is None:
+            raise CounterNotFoundError([self.name])
+        self.value = value
+        return value
+
+    def serialize(self) -> dict:
+        """Converts a counter into a dictionary"""
+        return {"name": self.name, "counter": self.value}
+
+    @classmethod
+    async def create(cls, name: str) -> Optional[Self]:
+        """Creates a counter set to 0 or returns None if it already exists
+
+        Raises:
+            DataValidationError: the name is not a valid counter name
+        """
+        validate_name(name)
+        try:
+            keys = [counter_key(name), INDEX_KEY, LEADERBOARD_KEY, VERSION_KEY]
+            created = await cls.scripts["create"](keys=keys, args=[name])
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+        return cls(name) if created else None
+
+    @classmethod
+    async def increment_existing(cls, name: str, amount: int = 1) -> Optional[int]:
+        """Increments a counter only if it exists, in a single round trip
+
+        A sharded counter has a random shard incremented and is read back
+        with an MGET of all its keys in the same pipeline
+
+        Returns:
+            the new value of the counter, or None if it does not exist
+
+        Raises:
+            CounterOverflowError: the increment would overflow (nothing is changed)
+        """
+        try:
+            value = await cls._apply(name, amount)
+            if value is None and cls.layout.get(name):
+                # the counter may have been demoted since the layout was loaded
+                cls.layout_expires = 0.0
+                value = await cls._apply(name, amount)
+            return value
+        except Exception as err:
+            check_overflow(err)
+            raise DatabaseConnectionError(err) from err
+
+    @classmethod
+    async def _apply(cls, name: str, amount: int) -> Optional[int]:
+        """Increments a plain counter or a random shard of a sharded counter"""
+        now = int(time.time())
+        keys = await cls._keys(name)
+        script = cls.scripts["increment_existing"]
+        args = [amount, name, now, now // 60]
+        if len(keys) == 1:
+            return await script(keys=[keys[0], LEADERBOARD_KEY] + rate_keys(name, now) + [VERSION_KEY], args=args)
+        pipeline = cls.redis.pipeline(transaction=False)
+        await script(keys=[random.choice(keys[1:]), LEADERBOARD_KEY] + rate_keys(name, now) + [VERSION_KEY],
+                     args=args, client=pipeline)
+        pipeline.mget(keys)
+        value, values = await pipeline.execute()
+        return None if value is None else sum_shards(values)
+
+    @classmethod
+    async def delete(cls, name: str) -> bool:
+        """Deletes a counter with its shards and unique members and removes it from the index
+
+        Returns:
+            True if the counter existed
+        """
+        try:
+            keys = [INDEX_KEY, LEADERBOARD_KEY, SHARDS_KEY, VERSION_KEY] + await cls._keys(name) + [uniques_key(name)]
+            deleted = await cls.scripts["delete"](keys=keys, args=[name])
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+        cls.layout.pop(name, None)
+        return deleted > 0
+
+    @classmethod
+    async def increment_many(cls, deltas: Iterable[Tuple[str, int]]) -> List[int]:
+        """Increments many counters atomically in a single round trip
+
+        Raises:
+            CounterNotFoundError: a counter does not exist (nothing is changed)
+            CounterOverflowError: an increment would overflow (nothing is changed)
+        """
+        names, amounts = zip(*deltas)
+        try:
+            now = int(time.time())
+            buckets = [rate_keys(name, now) for name in names]
+            keys = [counter_key(name) for name in names] + [LEADERBOARD_KEY]
+            keys += [bucket[0] for bucket in buckets] + [bucket[1] for bucket in buckets] + [VERSION_KEY]
+            found, values = await cls.scripts["increment_many"](keys=keys, args=amounts + names + (now, now // 60))
+            if found:
+                # the script only touches the base keys, add the shards of sharded counters
+                values = [value + offset for value, offset in zip(values, await cls._shard_totals(names))]
+        except Exception as err:
+            check_overflow(err)
+            raise DatabaseConnectionError(err) from err
+        if not found:
+            raise CounterNotFoundError([key[len(KEY_PREFIX):] for key in values])
+        return values
+
+    ######################################################################
+    #  F I N D E R   M E T H O D S
+    ######################################################################
+
+    @classmethod
+    async def all(cls) -> List[dict]:
+        """Returns all of the counters"""
+        counters = []
+        cursor = ""
+        while True:
+            page, cursor = await cls.page(cursor, SCAN_COUNT)
+            counters.extend(page)
+            if not cursor:
+                break
+        return counters
+
+    @classmethod
+    async def page(cls, cursor: str = "", limit: int = SCAN_COUNT) -> Tuple[List[dict], str]:
+        """Returns one page of counters and the cursor of the next page (see Counter.page)"""
+        try:
+            names = await cls.redis.zrangebylex(INDEX_KEY, f"({cursor}" if cursor else "-", "+", start=0, num=limit)
+            layouts = [await cls._keys(name) for name in names]
+            values = await cls.redis.mget([key for layout in layouts for key in layout]) if names else []
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+        counters = []
+        start = 0
+        for name, layout in zip(names, layouts):
+            count = sum_shards(values[start:start + len(layout)])
+            start += len(layout)
+            # counters deleted between reading the index and the MGET come back as None
+            if count is not None:
+                counters.append({"name": name, "counter": count})
+        return counters, names[-1] if len(names) == limit else ""
+
+    @classmethod
+    async def count(cls) -> int:
+        """Returns the number of counters"""
+        try:
+            return await cls.redis.zcard(INDEX_KEY)
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+
+    @classmethod
+    async def find(cls, name: str) -> Optional[Self]:
+        """Finds a counter with the name, adding up its shards, or returns None"""
+        try:
+            keys = await cls._keys(name)
+            count = await cls.redis.get(keys[0]) if len(keys) == 1 else sum_shards(await cls.redis.mget(keys))
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+        return cls(name, count) if count is not None else None
+
+    @classmethod
+    async def remove_all(cls) -> None:
+        """Removes every counter, and nothing else, with SCAN and UNLINK (see Counter.remove_all)"""
+        try:
+            batch = []
+            async for key in cls.redis.scan_iter(match=f"{KEY_PREFIX}*", count=SCAN_COUNT):
+                batch.append(key)
+                if len(batch) == SCAN_COUNT:
+                    await cls.redis.unlink(*batch)
+                    batch = []
+            await cls.redis.unlink(*batch, *SERVICE_KEYS)
+        except Exception as err:
+            raise DatabaseConnectionError(err) from err
+        cls.layout = {}
+
+    ######################################################################
+    #  S H A R D   L A Y O U T   M E T H O D S
+    ######################################################################
+
+    @classmethod
+    async def _shards(cls, name: str) -> int:
+        """Returns the number of shards from the cached layout"""
+        if time.monotonic() >= cls.layout_expires:
+            layout = await cls.redis.hgetall(SHARDS_KEY)
+            cls.layout = {key: int(shards) for key, shards in layout.items()}
+            cls.layout_expires = time.monotonic() + SHARD_LAYOUT_TTL
+        return cls.layout.get(name, 0)
+
+    @classmethod
+    async def _keys(cls, name: str) -> List[str]:
+        """Returns the key of a counter followed by the keys of its shards"""
+        return [counter_key(name)] + [shard_key(name, index) for index in range(await cls._shards(name))]
+
+    @classmethod
+    async def _shard_totals(cls, names: Iterable[str]) -> List[int]:
+        """Returns the sum of the shards of each counter (0 for plain counters)"""
+        keys = {name: (await cls._keys(name))[1:] for name in set(names)}
+        sharded = [name for name, shard_keys in keys.items() if shard_keys]
+        if not sharded:
+            return [0 for _ in names]
+        values = await cls.redis.mget([key for name in sharded for key in keys[name]])
+        totals = {}
+        start = 0
+        for name in sharded:
+            count = len(keys[name])
+            totals[name] = sum(int(value) for value in values[start:start + count] if value is not None)
+            start += count
+        return [totals.get(name, 0) for name in names]
+
+    ######################################################################
+    #  R E D I S   D A T A B A S E   C O N N E C T I O N   M E T H O D S
+    ######################################################################
+
+    @classmethod
+    async def test_connection(cls) -> bool:
+        """Test connection by pinging the host"""
+        success = False
+        try:
+            await cls.redis.ping()
+            logger.info("Connection established")
+            success = True
+        except RedisConnectionError:
+            logger.warning("Connection Error!")
+        return success
+
+    @classmethod
+    async def ping(cls) -> bool:
+        """Returns True if Redis answers a PING
+
+        Unlike test_connection nothing is logged, so it can back a probe
+        """
+        try:
+            return bool(cls.redis) and await cls.redis.ping()
+        except RedisError:
+            return False
+
+    @classmethod
+    def breaker_stats(cls) -> Optional[dict]:
+        """Returns the state of the circuit breaker, or None before connect"""
+        return cls.breaker.stats() if cls.breaker else None
+
+    @classmethod
+    async def connect(cls, database_uri: Optional[str] = None, settings: Optional[dict] = None) -> Redis:
+        """Establishes the shared connection pool
+
+        Arguments:
+            database_uri: a uri to a single Redis database
+            settings: the REDIS_* and BREAKER_* configuration (REDIS_SENTINEL_URIS is refused)
+
+        Raises:
+            DatabaseConnectionError: Could not connect, or the settings
+                need more than one Redis server
+        """
+        await cls.disconnect()
+        settings = settings or {}
+        database_uri = cls._database_uri(database_uri, settings)
+        delay = RETRY_DELAY
+        for attempt in range(1, RETRY_COUNT + 1):
+            if await cls._connect(database_uri, settings):
+                return cls.redis
+            if attempt < RETRY_COUNT:
+                logger.warning("Connection attempt %d failed, retrying in %d seconds...", attempt, delay)
+                await asyncio.sleep(delay)
+                delay *= RETRY_BACKOFF
+
+        logger.fatal("*** FATAL ERROR: Could not connect to the Redis Service")
+        raise DatabaseConnectionError("Could not connect to the Redis Service")
+
+    @classmethod
+    def connect_in_background(cls, database_uri: Optional[str] = None, settings: Optional[dict] = None) -> asyncio.Task:
+        """Connects on a background task so that serving never waits for Redis
+
+        The task retries with exponential backoff (up to RETRY_DELAY_MAX
+        seconds apart) until Redis answers. Until then redis is None and
+        ping() returns False. It must be called from the event loop that
+        serves requests.
+
+        Arguments:
+            database_uri: a uri to a single Redis database
+            settings: the REDIS_* and BREAKER_* configuration (REDIS_SENTINEL_URIS is refused)
+
+        Raises:
+            DatabaseConnectionError: the settings need more than one Redis server
+        """
+        settings = settings or {}
+        database_uri = cls._database_uri(database_uri, settings)
+        cls.connector = asyncio.get_running_loop().create_task(cls._keep_connecting(database_uri, settings))
+        return cls.connector
+
+    @classmethod
+    async def disconnect(cls) -> None:
+        """Stops connecting in the background and closes the shared connection pool"""
+        connector, cls.connector = cls.connector, None
+        if connector and not connector.done():
+            connector.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await connector
+        await cls._close()
+
+    @classmethod
+    async def _keep_connecting(cls, database_uri: str, settings: dict) -> None:
+        """Tries to connect until it succeeds (runs as the connector task)"""
+        delay = RETRY_DELAY
+        while not await cls._connect(database_uri, settings):
+            logger.warning("Redis is not reachable, retrying in %d seconds...", delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * RETRY_BACKOFF, RETRY_DELAY_MAX)
+
+    @staticmethod
+    def _create_pool(database_uri: str, settings: dict) -> ConnectionPool:
+        """Creates the connection pool from the same REDIS_* settings as the sync service"""
+        options = pool_options(settings)
+        if settings.get("REDIS_POOL_BLOCKING"):
+            pool_class = BlockingConnectionPool
+            options["timeout"] = settings.get("REDIS_POOL_TIMEOUT")
+        else:
+            pool_class = ConnectionPool
+        return pool_class.from_url(database_uri, encoding="utf-8", decode_responses=True, **options)
+
+    @classmethod
+    async def _connect(cls, database_uri: str, settings: dict) -> bool:
+        """Connects once without retrying and returns True if Redis answered
+
+        The new client is only made visible once it has answered, so that
+        redis stays None while Redis is unreachable
+        """
+        logger.info("Attempting to connecting to Redis...")
+        await cls._close()
+        pool = cls._create_pool(database_uri, settings)
+        breaker = create_breaker(settings, node_name(database_uri))
+        redis = GuardedAsyncRedis(connection_pool=pool, breaker=breaker)
+        try:
+            await redis.ping()
+            scripts = {
+                "create": redis.register_script(CREATE_LUA),
+                "delete": redis.register_script(DELETE_LUA),
+                "increment_existing": redis.register_script(INCREMENT_EXISTING_LUA),
+                "increment_many": redis.register_script(INCREMENT_MANY_LUA),
+            }
+            # load the scripts up front so that requests never pay for a NOSCRIPT retry
+            for script in scripts.values():
+                await redis.script_load(script.script)
+        except RedisError as err:
+            logger.warning("Connection Error! %s", err)
+            await redis.aclose()
+            await pool.aclose()
+            return False
+        cls.pool, cls.breaker, cls.redis, cls.scripts = pool, breaker, redis, scripts
+        cls.layout_expires = 0.0
+        logger.info("Successfully connected to Redis")
+        return True
+
+    @classmethod
+    async def _close(cls) -> None:
+        """Closes the shared connection pool"""
+        if cls.redis:
+            await cls.redis.aclose()
+            await cls.pool.aclose()
+        cls.redis = None
+        cls.pool = None
+
+    @staticmethod
+    def _database_uri(database_uri: Optional[str], settings: dict) -> str:
+        """Returns the uri to connect to, from DATABASE_URI when none is given
+
+        Raises:
+            DatabaseConnectionError: there is no uri, or the settings need
+                more than one Redis server
+        """
+        database_uri = database_uri or os.environ.get("DATABASE_URI")
+        if not database_uri:
+            msg = "DATABASE_URI is missing from environment."
+            logger.error(msg)
+            raise DatabaseConnectionError(msg)
+        if len(split_uris(database_uri)) > 1 or settings.get("REDIS_SENTINEL_URIS"):
+            msg = "The asyncio service supports a single Redis server, use the WSGI service for several or Sentinel"
+            logger.error(msg)
+            raise DatabaseConnectionError(msg)
+        return database_uri
@@ -0,0 +1,234 @@
+######################################################################
+# Copyright 2015, 2024 John J. Rofrano All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+# pylint: disable=duplicate-code
+"""
+Redis Counter Demo as an asyncio service
+
+The same REST API as service.routes served by Quart. Quart can only
+push an application context from a coroutine so the routes are kept
+on a Blueprint that create_app() registers.
+"""
+import time
+from urllib.parse import quote
+from quart import Blueprint, jsonify, abort, request, url_for
+from quart import current_app as app
+from service.common import status  # HTTP Status Codes
+from service.models import DatabaseConnectionError, parse_deltas, validate_name
+from .models import AsyncCounter
+
+bp = Blueprint("counters", __name__)
+
+# the last readiness check, see ready()
+readiness = {"healthy": False, "checked": None}
+
+# endpoints that answer without Redis
+NO_REDIS_ENDPOINTS = {"counters.health", "counters.ready", "counters.stats", "counters.index"}
+
+
+@bp.before_request
+async def require_redis():
+    """Answers 503_SERVICE_UNAVAILABLE until Redis has been connected to"""
+    if AsyncCounter.redis is None and request.endpoint not in NO_REDIS_ENDPOINTS:
+        raise DatabaseConnectionError("Not connected to Redis yet")
+
+
+@bp.url_value_preprocessor
+def check_name(endpoint, values):  # pylint: disable=unused-argument
+    """Answers 400_BAD_REQUEST for a counter name that could reach another counter's keys"""
+    if values and "name" in values:
+        validate_name(values["name"])
+
+
+############################################################
+# Health Endpoint
+############################################################
+@bp.route("/health")
+async def health():
+    """Health Status"""
+    return {"status": "OK"}, status.HTTP_200_OK
+
+
+############################################################
+# Readiness Endpoint
+############################################################
+@bp.route("/ready")
+async def ready():
+    """Readiness Status
+
+    Ready once Redis answers. The answer is reused for READY_CHECK_INTERVAL
+    seconds so that probes never add load to Redis
+    """
+    checked = readiness["checked"]
+    if checked is None or time.monotonic() - checked >= app.config["READY_CHECK_INTERVAL"]:
+        readiness.update(healthy=await AsyncCounter.ping(), checked=time.monotonic())
+    healthy = readiness["healthy"]
+    body = {"status": "OK" if healthy else "Redis is not reachable",
+            "checked_seconds_ago": round(time.monotonic() - readiness["checked"], 3)}
+    return body, status.HTTP_200_OK if healthy else status.HTTP_503_SERVICE_UNAVAILABLE
+
+
+############################################################
+# Statistics Endpoint
+############################################################
+@bp.route("/stats")
+async def stats():
+    """Statistics of this worker's Redis access"""
+    return {"breaker": AsyncCounter.breaker_stats()}, status.HTTP_200_OK
+
+
+############################################################
+# Home Page
+############################################################
+@bp.route("/")
+async def index():
+    """Home Page"""
+    return await app.send_static_file("index.html")
+
+
+############################################################
+#           R E S T   A P I   M E T H O D S
+############################################################
+
+
+############################################################
+# List counters
+############################################################
+@bp.route("/counters", methods=["GET"])
+async def list_counters():
+    """List counters
+
+    Takes the same optional ``cursor`` and ``limit`` query parameters
+    as the synchronous service
+    """
+    app.logger.info("Request to list all counters...")
+
+    if "cursor" not in request.args and "limit" not in request.args:
+        counters = await AsyncCounter.all()
+        app.logger.info("Returning %d counters...", len(counters))
+        return jsonify(counters)
+
+    cursor = request.args.get("cursor", "")
+    limit = get_int_arg("limit", app.config["PAGE_SIZE"], minimum=1)
+    limit = min(limit, app.config["PAGE_SIZE_MAX"])
+
+    counters, next_cursor = await AsyncCounter.page(cursor, limit)
+
+    headers = {"X-Total-Count": str(await AsyncCounter.count())}
+    if next_cursor:
+        headers["X-Next-Cursor"] = quote(next_cursor, safe="")
+        next_url = url_for(".list_counters", cursor=next_cursor, limit=limit, _external=True)
+        headers["Link"] = f'<{next_url}>; rel="next"'
+    app.logger.info("Returning %d counters, next cursor %r...", len(counters), next_cursor)
+    return jsonify(counters), status.HTTP_200_OK, headers
+
+
+############################################################
+# Read counters
+############################################################
+@bp.route("/counters/<name>", methods=["GET"])
+async def read_counters(name):
+    """Read a counter"""
+    app.logger.info("Request to Read counter: '%s'...", name)
+
+    counter = await AsyncCounter.find(name)
+    if not counter:
+        abort(status.HTTP_404_NOT_FOUND, f"Counter '{name}' does not exist")
+
+    app.logger.info("Returning: %d...", counter.value)
+    return jsonify(counter.serialize())
+
+
+############################################################
+# Create counter
+############################################################
+@bp.route("/counters/<name>", methods=["POST"])
+async def create_counters(name):
+    """Create a counter"""
+    app.logger.info("Request to Create counter: '%s'...", name)
+
+    counter = await AsyncCounter.create(name)
+    if counter is None:
+        abort(status.HTTP_409_CONFLICT, f"Counter '{name}' already exists")
+
+    location_url = url_for(".read_counters", name=name, _external=True)
+    app.logger.info("Counter '%s' created", name)
+    return (
+        jsonify(counter.serialize()),
+        status.HTTP_201_CREATED,
+        {"Location": location_url},
+    )
+
+
+############################################################
+# Batch update counters
+############################################################
+@bp.route("/counters/batch", methods=["POST"])
+async def batch_update_counters():
+    """Increment many counters at once"""
+    app.logger.info("Request to Batch update counters...")
+
+    deltas = parse_deltas(await request.get_json(), app.config["BATCH_SIZE_MAX"])
+    counts = await AsyncCounter.increment_many(deltas)
+
+    app.logger.info("Batch updated %d counters", len(counts))
+    return jsonify([{"name": name, "counter": count} for (name, _), count in zip(deltas, counts)])
+
+
+############################################################
+# Update counters
+############################################################
+@bp.route("/counters/<name>", methods=["PUT"])
+async def update_counters(name):
+    """Update a counter"""
+    app.logger.info("Request to Update counter: '%s'...", name)
+
+    count = await AsyncCounter.increment_existing(name)
+    if count is None:
+        abort(status.HTTP_404_NOT_FOUND, f"Counter '{name}' does not exist")
+
+    app.logger.info("Counter '%s' updated to %d", name, count)
+    return jsonify(name=name, counter=count)
+
+
+############################################################
+# Delete counters
+############################################################
+@bp.route("/counters/<name>", methods=["DELETE"])
+async def delete_counters(name):
+    """Delete a counter"""
+    app.logger.info("Request to Delete counter: '%s'...", name)
+
+    if await AsyncCounter.delete(name):
+        app.logger.info("Counter '%s' deleted", name)
+
+    return "", status.HTTP_204_NO_CONTENT
+
+
+############################################################
+#  U T I L I T Y   F U N C T I O N S
+############################################################
+
+
+def get_int_arg(name: str, default: int, minimum: int = 0) -> int:
+    """Returns an integer query parameter or aborts with 400_BAD_REQUEST"""
+    value = request.args.get(name, default)
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        abort(status.HTTP_400_BAD_REQUEST, f"Query parameter '{name}' must be an integer")
+    if value < minimum:
+        abort(status.HTTP_400_BAD_REQUEST, f"Query parameter '{name}' must be at least {minimum}")
+    return value
@@ -0,0 +1,261 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Circuit Breaker
+
+This module contains a circuit breaker for Redis and a Redis client that
+goes through it. Once Redis has failed (or been slower than
+``slow_call`` seconds) ``failures`` times in a row the circuit opens and
+every command fails at once with CircuitOpenError instead of waiting for
+a socket timeout. After ``reset_timeout`` seconds one trial command at a
+time is let through (half-open); its success closes the circuit again and
+its failure re-opens it.
+
+Bulk operations (imports, reindexing, purges and rebalancing) run inside
+bulk_calls(), so that they are slow because of how much they do is not
+taken for Redis being in trouble. Their failures still count.
+"""
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Iterator, Optional
+from redis.asyncio.client import Pipeline as AsyncPipeline, Redis as AsyncRedis
+from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
+from service.common.metrics import BREAKER_STATE, BREAKER_TRIPS, InstrumentedPipeline, InstrumentedRedis
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+HALF_OPEN = "half-open"
+OPEN = "open"
+
+# errors that say Redis itself is in trouble (not e.g. a WRONGTYPE reply)
+FAILURES = (RedisConnectionError, RedisTimeoutError)
+
+# whether the current thread is running a bulk operation, see bulk_calls()
+_local = threading.local()
+
+
+class CircuitOpenError(RedisConnectionError):
+    """Raised instead of talking to Redis while the circuit is open"""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Redis is unavailable, retry in {retry_after:.0f} seconds")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Stops calling Redis after repeated failures and probes until it recovers"""
+
+    def __init__(self, failures: int = 5, slow_call: float = 1.0, reset_timeout: float = 5.0, name: str = "redis"):
+        """Constructor
+
+        :param failures: consecutive failed or slow calls that open the circuit
+        :param slow_call: seconds after which a successful call counts as a failure
+        :param reset_timeout: seconds the circuit stays open before a trial call
+        :param name: the Redis server the breaker guards, its metrics label
+        """
+        self.name = name
+        self.failures = failures
+        self.slow_call = slow_call
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._set_state(CLOSED)
+        self.consecutive = 0
+        self.trips = 0
+        self.opened_at = 0.0
+        self._trial = False
+
+    @contextmanager
+    def guard(self) -> Iterator[None]:
+        """Runs the body as one call through the breaker
+
+        Raises:
+            CircuitOpenError: the circuit is open (the body is not run)
+        """
+        trial = self._before()
+        start = time.monotonic()
+        try:
+            yield
+        except FAILURES:
+            self._after(trial, failed=True)
+            raise
+        except BaseException:
+            # e.g. a WRONGTYPE reply, Redis answered so it is healthy
+            self._after(trial, failed=False)
+            raise
+        slow = time.monotonic() - start > self.slow_call
+        self._after(trial, failed=slow and not getattr(_local, "bulk", False))
+
+    def retry_after(self) -> float:
+        """Returns the seconds until the next trial call is allowed"""
+        with self._lock:
+            return self._retry_after()
+
+    def stats(self) -> dict:
+        """Returns the state of the breaker"""
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.consecutive,
+                "trips": self.trips,
+                "retry_after": self._retry_after() if self.state != CLOSED else 0.0,
+            }
+
+    def reset(self) -> None:
+        """Closes the circuit"""
+        with self._lock:
+            self._set_state(CLOSED)
+            self.consecutive = 0
+            self._trial = False
+
+    ######################################################################
+    #  P R I V A T E   M E T H O D S
+    ######################################################################
+
+    def _before(self) -> bool:
+        """Lets a call through or raises CircuitOpenError, returns True for a trial call"""
+        with self._lock:
+            if self.state == CLOSED:
+                return False
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self._set_state(HALF_OPEN)
+            if self.state == HALF_OPEN and not self._trial:
+                self._trial = True
+                return True
+            raise CircuitOpenError(self._retry_after())
+
+    def _after(self, trial: bool, failed: bool) -> None:
+        """Records the outcome of a call"""
+        with self._lock:
+            if trial:
+                self._trial = False
+            if not failed:
+                self.consecutive = 0
+                if trial:
+                    logger.info("Redis circuit closed")
+                    self._set_state(CLOSED)
+                return
+            self.consecutive += 1
+            if trial or (self.state == CLOSED and self.consecutive >= self.failures):
+                logger.error("Redis circuit opened after %d failed or slow calls", self.consecutive)
+                self.opened_at = time.monotonic()
+                self.trips += 1
+                BREAKER_TRIPS.labels(server=self.name).inc()
+                self._set_state(OPEN)
+
+    def _retry_after(self) -> float:
+        """Seconds until a trial call (caller holds the lock)"""
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def _set_state(self, state: str) -> None:
+        """Changes the state (caller holds the lock)"""
+        self.state = state
+        BREAKER_STATE.labels(server=self.name).set({CLOSED: 0, HALF_OPEN: 1, OPEN: 2}[state])
+
+
+@contextmanager
+def bulk_calls() -> Iterator[None]:
+    """Runs the body without counting the slow calls this thread makes in it
+
+    It can also decorate a function that runs a bulk operation
+    """
+    bulk = getattr(_local, "bulk", False)
+    _local.bulk = True
+    try:
+        yield
+    finally:
+        _local.bulk = bulk
+
+
+def create_breaker(settings: dict, name: str = "redis") -> CircuitBreaker:
+    """Creates a circuit breaker from the BREAKER_* configuration settings
+
+    Arguments:
+        settings: the configuration
+        name: the Redis server the breaker guards
+    """
+    options = {
+        "failures": settings.get("BREAKER_FAILURES"),
+        "slow_call": settings.get("BREAKER_SLOW_CALL"),
+        "reset_timeout": settings.get("BREAKER_RESET_TIMEOUT"),
+    }
+    return CircuitBreaker(name=name, **{key: value for key, value in options.items() if value is not None})
+
+
+######################################################################
+#  G U A R D E D   R E D I S   C L I E N T
+######################################################################
+
+
+class GuardedRedis(InstrumentedRedis):
+    """A Redis client whose commands go through a circuit breaker"""
+
+    def __init__(self, *args, breaker: Optional[CircuitBreaker] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.breaker = breaker or CircuitBreaker()
+
+    def execute_command(self, *args, **options):
+        with self.breaker.guard():
+            return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None) -> "GuardedPipeline":
+        pipeline = GuardedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+        pipeline.breaker = self.breaker
+        return pipeline
+
+
+class GuardedPipeline(InstrumentedPipeline):
+    """A Pipeline whose round trip goes through a circuit breaker"""
+
+    breaker: CircuitBreaker = None
+
+    def execute(self, raise_on_error: bool = True):
+        with self.breaker.guard():
+            return super().execute(raise_on_error)
+
+
+class GuardedAsyncRedis(AsyncRedis):
+    """An asyncio Redis client whose commands go through a circuit breaker
+
+    The breaker only holds its lock while it decides and records, never
+    across an await, so it is shared safely by every task of a worker
+    """
+
+    def __init__(self, *args, breaker: Optional[CircuitBreaker] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.breaker = breaker or CircuitBreaker()
+
+    async def execute_command(self, *args, **options):
+        with self.breaker.guard():
+            return await super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None) -> "GuardedAsyncPipeline":
+        pipeline = GuardedAsyncPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+        pipeline.breaker = self.breaker
+        return pipeline
+
+
+class GuardedAsyncPipeline(AsyncPipeline):
+    """An asyncio Pipeline whose round trip goes through a circuit breaker"""
+
+    breaker: CircuitBreaker = None
+
+    async def execute(self, raise_on_error: bool = True):
+        with self.breaker.guard():
+            return await super().execute(raise_on_error)
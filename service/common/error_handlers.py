@@ -19,10 +19,11 @@ Error Handlers
 
 This module contains error handlers functions to send back errors as json
 """
+import math
 from flask import jsonify
 from flask import current_app as app
-from service.common import status
-from service.models import DatabaseConnectionError
+from service.common import metrics, status
+from service.models import DatabaseConnectionError, CounterNotFoundError, DataValidationError
 
 ######################################################################
 # Error Handlers
@@ -31,8 +32,41 @@ from service.models import DatabaseConnectionError
 
 @app.errorhandler(DatabaseConnectionError)
 def request_validation_error(error):
+    """Handles Redis being unreachable with 503_SERVICE_UNAVAILABLE
+
+    While the circuit breaker is open the response says when to retry
+    """
+    metrics.count_error(error)
+    body, code = service_unavailable(error)
+    retry_after = getattr(error.__cause__, "retry_after", None)
+    if retry_after is None:
+        return body, code
+    return body, code, {"Retry-After": str(max(1, math.ceil(retry_after)))}
+
+
+@app.errorhandler(DataValidationError)
+def data_validation_error(error):
     """Handles Value Errors from bad data"""
-    return service_unavailable(error)
+    metrics.count_error(error)
+    return bad_request(error)
+
+
+@app.errorhandler(CounterNotFoundError)
+def counter_not_found(error):
+    """Handles missing counters with 404_NOT_FOUND"""
+    metrics.count_error(error)
+    return not_found(error)
+
+
+@app.errorhandler(status.HTTP_400_BAD_REQUEST)
+def bad_request(error):
+    """Handles bad requests with 400_BAD_REQUEST"""
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        jsonify(status=status.HTTP_400_BAD_REQUEST, error="Bad Request", message=message),
+        status.HTTP_400_BAD_REQUEST,
+    )
 
 
 @app.errorhandler(status.HTTP_404_NOT_FOUND)
@@ -61,9 +95,25 @@ def method_not_supported(error):
     )
 
 
+@app.errorhandler(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+def mediatype_not_supported(error):
+    """Handles unsupported media requests with 415_UNSUPPORTED_MEDIA_TYPE"""
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        jsonify(
+            status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            error="Unsupported media type",
+            message=message,
+        ),
+        status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+    )
+
+
 @app.errorhandler(status.HTTP_500_INTERNAL_SERVER_ERROR)
 def internal_server_error(error):
     """Handles unexpected server error with 500_SERVER_ERROR"""
+    metrics.count_error(getattr(error, "original_exception", None) or error)
     message = str(error)
     app.logger.error(message)
     return (
@@ -0,0 +1,63 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Cached Health Checks
+
+This module contains a health check whose result is remembered for a
+while, so that however often a probe asks, the dependency it checks is
+contacted at most once per interval
+"""
+import time
+import threading
+from typing import Callable, Tuple
+
+
+class CachedCheck:
+    """Runs a check at most once every ``interval`` seconds
+
+    While one caller refreshes the result the others get the previous
+    result instead of waiting or running the check again
+    """
+
+    def __init__(self, check: Callable[[], bool], interval: float = 5.0):
+        """Constructor
+
+        :param check: returns True when healthy, it must not raise
+        :param interval: seconds a result is reused for
+        """
+        self.check = check
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._healthy = False
+        self._checked = None
+
+    def status(self) -> Tuple[bool, float]:
+        """Returns (healthy, seconds since the check ran)"""
+        if self._checked is None or time.monotonic() - self._checked >= self.interval:
+            # blocking only for the very first check, when there is no result to return yet
+            if self._lock.acquire(blocking=self._checked is None):
+                try:
+                    self._healthy = self.check()
+                    self._checked = time.monotonic()
+                finally:
+                    self._lock.release()
+        return self._healthy, time.monotonic() - self._checked
+
+    def reset(self) -> None:
+        """Forgets the last result so the next status() runs the check"""
+        with self._lock:
+            self._checked = None
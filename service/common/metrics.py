@@ -0,0 +1,194 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Prometheus Metrics
+
+This module contains the metrics the service exposes on /metrics, the
+Flask hooks that time every request and a Redis client that times every
+round trip.
+
+When PROMETHEUS_MULTIPROC_DIR is set every gunicorn worker writes its
+samples to files in that directory and /metrics adds them up, so it
+does not matter which worker answers the scrape. The directory must be
+emptied before the workers start (see gunicorn.conf.py).
+"""
+import os
+import time
+from typing import Tuple
+from flask import Flask, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from redis import Redis
+from redis.client import Pipeline
+
+MULTIPROCESS_DIR_ENV = "PROMETHEUS_MULTIPROC_DIR"
+
+REQUESTS = Counter(
+    "http_requests_total",
+    "HTTP requests by method, route and status code",
+    ["method", "route", "status"],
+)
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Time spent handling HTTP requests",
+    ["method", "route"],
+)
+IN_FLIGHT = Gauge(
+    "http_requests_in_flight",
+    "HTTP requests being handled right now",
+    multiprocess_mode="livesum",
+)
+ERRORS = Counter(
+    "errors_total",
+    "Errors turned into HTTP error responses by exception type",
+    ["type"],
+)
+STARTUP = Gauge(
+    "startup_seconds",
+    "Time from the start of create_app until the app was built (app) and Redis was connected (redis)",
+    ["phase"],
+    multiprocess_mode="max",
+)
+BREAKER_STATE = Gauge(
+    "redis_breaker_state",
+    "State of the circuit breaker of each Redis server (0 closed, 1 half-open, 2 open)",
+    ["server"],
+    multiprocess_mode="max",
+)
+BREAKER_TRIPS = Counter(
+    "redis_breaker_trips_total",
+    "Times the circuit breaker of each Redis server opened",
+    ["server"],
+)
+REDIS_COMMANDS = Counter(
+    "redis_commands_total",
+    "Redis commands sent by command name",
+    ["command"],
+)
+REDIS_LATENCY = Histogram(
+    "redis_round_trip_seconds",
+    "Time spent waiting on Redis per round trip (pipelines are one round trip)",
+    ["command"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+
+
+def init_app(app: Flask) -> None:
+    """Times every request the application handles
+
+    Call it before the routes are imported. The timer starts in a URL
+    value preprocessor registered ahead of theirs, so requests that their
+    preprocessors or before_request hooks answer (a 400 for a bad name, a
+    503 before Redis is connected) are counted as well.
+    """
+    app.url_value_preprocessor(_start_request)
+    app.after_request(_end_request)
+    app.teardown_request(_leave_request)
+
+
+def count_error(error: Exception) -> None:
+    """Counts an error that an error handler turned into a response"""
+    ERRORS.labels(type(error).__name__).inc()
+
+
+def render() -> Tuple[bytes, str]:
+    """Returns the metrics of every worker in the Prometheus text format"""
+    registry = REGISTRY
+    if os.environ.get(MULTIPROCESS_DIR_ENV):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid: int) -> None:
+    """Removes the live gauges of a worker that exited"""
+    if os.environ.get(MULTIPROCESS_DIR_ENV):
+        multiprocess.mark_process_dead(pid)
+
+
+######################################################################
+#  I N S T R U M E N T E D   R E D I S   C L I E N T
+######################################################################
+
+
+class InstrumentedRedis(Redis):
+    """A Redis client that counts and times the commands it sends"""
+
+    def execute_command(self, *args, **options):
+        command = str(args[0]).upper()
+        REDIS_COMMANDS.labels(command).inc()
+        start = time.perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        finally:
+            REDIS_LATENCY.labels(command).observe(time.perf_counter() - start)
+
+    def pipeline(self, transaction=True, shard_hint=None) -> "InstrumentedPipeline":
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+class InstrumentedPipeline(Pipeline):
+    """A Pipeline that counts the commands it sends and times the round trip"""
+
+    def execute(self, raise_on_error: bool = True):
+        for args, _ in self.command_stack:
+            REDIS_COMMANDS.labels(str(args[0]).upper()).inc()
+        start = time.perf_counter()
+        try:
+            return super().execute(raise_on_error)
+        finally:
+            REDIS_LATENCY.labels("PIPELINE").observe(time.perf_counter() - start)
+
+
+######################################################################
+#  P R I V A T E   F U N C T I O N S
+######################################################################
+
+
+def _route() -> str:
+    """Returns the route pattern of the request so that labels stay bounded"""
+    return request.url_rule.rule if request.url_rule else "unmatched"
+
+
+def _start_request(_endpoint=None, _values=None) -> None:
+    """Remembers when the request started"""
+    IN_FLIGHT.inc()
+    request.environ["metrics.start"] = time.perf_counter()
+
+
+def _end_request(response):
+    """Counts the request and records how long it took"""
+    start = request.environ.get("metrics.start")
+    if start is not None:
+        route = _route()
+        REQUEST_LATENCY.labels(request.method, route).observe(time.perf_counter() - start)
+        REQUESTS.labels(request.method, route, str(response.status_code)).inc()
+    return response
+
+
+def _leave_request(_error=None) -> None:
+    """Takes the request out of the in-flight gauge however it ended"""
+    if request.environ.pop("metrics.start", None) is not None:
+        IN_FLIGHT.dec()
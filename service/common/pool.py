@@ -0,0 +1,162 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Connection Pools
+
+This module contains Redis connection pools that keep statistics about
+how busy they are, so that workers and pools can be sized against each
+other, and functions that build one from the service configuration,
+either for a Redis uri or for the primary Redis Sentinel knows of
+"""
+import time
+import threading
+from abc import ABC, abstractmethod
+from redis import BlockingConnectionPool, ConnectionPool
+from redis.connection import parse_url
+from redis.exceptions import ConnectionError as RedisConnectionError
+from redis.sentinel import Sentinel, SentinelConnectionPool
+
+
+class PoolStatsMixin(ABC):
+    """Times how long callers wait to get a connection from the pool
+
+    Each pool class counts its own connections, see _counts()
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._stats_lock = threading.Lock()
+        self.reset_stats()
+        super().__init__(*args, **kwargs)
+
+    def reset_stats(self) -> None:
+        """Zeroes the acquisition and wait time statistics"""
+        with self._stats_lock:
+            self.acquired = 0
+            self.failed = 0
+            self.wait_total = 0.0
+            self.wait_max = 0.0
+
+    def get_connection(self, *args, **kwargs):
+        """Gets a connection and records how long that took"""
+        start = time.perf_counter()
+        try:
+            connection = super().get_connection(*args, **kwargs)
+        except RedisConnectionError:
+            # the pool was exhausted or a new connection could not be opened
+            with self._stats_lock:
+                self.failed += 1
+            raise
+        waited = time.perf_counter() - start
+        with self._stats_lock:
+            self.acquired += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+        return connection
+
+    def stats(self) -> dict:
+        """Returns how many connections are in use and how long callers waited"""
+        created, idle = self._counts()
+        with self._stats_lock:
+            return {
+                "max_connections": self.max_connections,
+                "created": created,
+                "in_use": created - idle,
+                "idle": idle,
+                "acquired": self.acquired,
+                "failed": self.failed,
+                "wait_avg_ms": self.wait_total / self.acquired * 1000 if self.acquired else 0.0,
+                "wait_max_ms": self.wait_max * 1000,
+            }
+
+    @abstractmethod
+    def _counts(self) -> tuple:
+        """Returns the number of connections created and idle"""
+
+
+class StatsConnectionPool(PoolStatsMixin, ConnectionPool):
+    """A ConnectionPool that fails when max_connections are in use"""
+
+    def _counts(self) -> tuple:
+        with self._lock:
+            return self._created_connections, len(self._available_connections)
+
+
+class StatsBlockingConnectionPool(PoolStatsMixin, BlockingConnectionPool):
+    """A BlockingConnectionPool that waits up to timeout for a free connection"""
+
+    def _counts(self) -> tuple:
+        idle = sum(1 for connection in list(self.pool.queue) if connection is not None)
+        return len(self._connections), idle
+
+
+class StatsSentinelConnectionPool(PoolStatsMixin, SentinelConnectionPool):
+    """A SentinelConnectionPool, it asks Sentinel where the primary is on every new connection"""
+
+    def _counts(self) -> tuple:
+        with self._lock:
+            return self._created_connections, len(self._available_connections)
+
+
+def pool_options(settings: dict) -> dict:
+    """Returns the connection options that are set in the REDIS_* configuration settings"""
+    options = {
+        "max_connections": settings.get("REDIS_MAX_CONNECTIONS"),
+        "socket_timeout": settings.get("REDIS_SOCKET_TIMEOUT"),
+        "socket_connect_timeout": settings.get("REDIS_SOCKET_CONNECT_TIMEOUT"),
+        "socket_keepalive": settings.get("REDIS_SOCKET_KEEPALIVE"),
+        "health_check_interval": settings.get("REDIS_HEALTH_CHECK_INTERVAL"),
+    }
+    return {key: value for key, value in options.items() if value is not None}
+
+
+def create_pool(database_uri: str, settings: dict) -> ConnectionPool:
+    """Creates a connection pool from the REDIS_* configuration settings
+
+    Arguments:
+        database_uri: a uri to the Redis database
+        settings: a mapping such as app.config, missing settings use the
+            redis-py defaults
+    """
+    options = pool_options(settings)
+    if settings.get("REDIS_POOL_BLOCKING"):
+        pool_class = StatsBlockingConnectionPool
+        options["timeout"] = settings.get("REDIS_POOL_TIMEOUT")
+    else:
+        pool_class = StatsConnectionPool
+    return pool_class.from_url(database_uri, encoding="utf-8", decode_responses=True, **options)
+
+
+def create_sentinel_pool(service: str, sentinel: Sentinel, database_uri: str, settings: dict) -> ConnectionPool:
+    """Creates a connection pool to the primary Sentinel knows for a service
+
+    A connection that finds its server is no longer the primary (e.g.
+    after a failover) is dropped, and new connections go to the primary
+    Sentinel reports, so writes follow a failover without reconnecting.
+    The pool never blocks (REDIS_POOL_BLOCKING is ignored).
+
+    Arguments:
+        service: the name the primary is monitored under (e.g. "mymaster")
+        sentinel: the Sentinel client to ask
+        database_uri: a uri whose credentials and database are used, its
+            host and port are ignored
+        settings: a mapping such as app.config
+    """
+    options = {key: value for key, value in parse_url(database_uri).items() if key not in ("host", "port")}
+    options.update(pool_options(settings))
+    return StatsSentinelConnectionPool(
+        service, sentinel, is_master=True, check_connection=True, encoding="utf-8", decode_responses=True, **options
+    )
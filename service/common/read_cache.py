@@ -0,0 +1,298 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Read Cache
+
+This module contains a bounded, per-process LRU cache of counter values
+that Redis keeps coherent. On Redis 6+ the server tells us which keys
+changed using CLIENT TRACKING in broadcast mode, with the invalidation
+messages redirected to a pub/sub connection. Older servers fall back to
+a pub/sub channel that every process publishes its own writes to.
+
+A watchdog thread checks every ``check_interval`` seconds that the
+listener is running and that the tracking connection still answers. When
+either is lost the cache is emptied and turned off until the watchdog
+has subscribed again, so values are never served without invalidations.
+"""
+import logging
+import threading
+from collections import OrderedDict
+from typing import Callable, Iterable, Optional
+from redis import Redis
+from redis.exceptions import RedisError, ResponseError
+
+logger = logging.getLogger(__name__)
+
+# channel that Redis sends CLIENT TRACKING invalidation messages to
+TRACKING_CHANNEL = "__redis__:invalidate"
+
+# channel that processes publish their own writes to when tracking is not available
+FALLBACK_CHANNEL = "counters:invalidate"
+
+
+class ReadCache:
+    """An LRU cache of counter values invalidated by Redis
+
+    Call begin() before reading a value from Redis and pass the token it
+    returns to fill(). If the key is invalidated while the read is in
+    flight the value is not cached, so a stale value can never be stored.
+    """
+
+    def __init__(
+        self, connection: Callable[[], Redis], max_size: int = 10000, prefix: str = "", check_interval: float = 1.0
+    ):
+        """Constructor
+
+        :param connection: returns the Redis client to listen with
+        :param max_size: most values to keep before evicting the least recently used
+        :param prefix: only track keys that start with this prefix
+        :param check_interval: seconds between checks of the invalidation connections
+        """
+        self.connection = connection
+        self.max_size = max_size
+        self.prefix = prefix
+        self.check_interval = check_interval
+        self.mode = None
+        self.restarts = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._values: OrderedDict = OrderedDict()
+        self._loading: dict = {}
+        self._pubsub = None
+        self._tracker = None
+        self._thread = None
+        self._watchdog = None
+        self._stopping = threading.Event()
+
+    def start(self) -> None:
+        """Starts listening for invalidations and watching the connections
+
+        Tries CLIENT TRACKING first and falls back to the pub/sub channel
+        """
+        self._listen()
+        self._stopping.clear()
+        self._watchdog = threading.Thread(target=self._watch, name="read-cache-watchdog", daemon=True)
+        self._watchdog.start()
+        logger.info("Read cache started in %s mode with room for %d values", self.mode, self.max_size)
+
+    def stop(self) -> None:
+        """Stops listening for invalidations and empties the cache"""
+        self._stopping.set()
+        if self._watchdog:
+            self._watchdog.join(timeout=5)
+            self._watchdog = None
+        self._close()
+        self.mode = None
+        self.invalidate()
+
+    def listening(self) -> bool:
+        """Returns True if invalidations are being received
+
+        In tracking mode the tracking connection is sent a PING, the
+        server stops tracking as soon as that connection is gone
+        """
+        if not self.mode or not (self._thread and self._thread.is_alive()):
+            return False
+        if self._tracker:
+            try:
+                self._tracker.send_command("PING")
+                self._tracker.read_response()
+            except RedisError:
+                return False
+        return True
+
+    def get(self, name: str) -> Optional[int]:
+        """Returns the cached value of a counter or None on a miss"""
+        with self._lock:
+            value = self._values.get(name) if self.mode else None
+            if value is None:
+                self.misses += 1
+                return None
+            self._values.move_to_end(name)
+            self.hits += 1
+            return value
+
+    def begin(self, name: str) -> object:
+        """Marks a read from Redis as in flight and returns its token"""
+        token = object()
+        with self._lock:
+            self._loading[name] = token
+        return token
+
+    def fill(self, name: str, value: int, token: object) -> None:
+        """Caches a value read from Redis unless it was invalidated meanwhile"""
+        with self._lock:
+            if not self.mode or self._loading.get(name) is not token:
+                return
+            del self._loading[name]
+            self._values[name] = value
+            self._values.move_to_end(name)
+            if len(self._values) > self.max_size:
+                self._values.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, names: Optional[Iterable[str]] = None) -> None:
+        """Drops names from the cache, or everything when names is None"""
+        with self._lock:
+            if names is None:
+                self.invalidations += len(self._values)
+                self._values.clear()
+                self._loading.clear()
+                return
+            for name in names:
+                if self._values.pop(name, None) is not None:
+                    self.invalidations += 1
+                self._loading.pop(name, None)
+
+    def written(self, names: Optional[Iterable[str]] = None) -> None:
+        """Tells the cache that this process changed names (None is everything)
+
+        The local copies are dropped right away. In pub/sub mode the other
+        processes are told as well, CLIENT TRACKING tells them by itself.
+        """
+        names = None if names is None else list(names)
+        self.invalidate(names)
+        if self.mode != "pubsub":
+            return
+        try:
+            self.connection().publish(FALLBACK_CHANNEL, "" if names is None else "\n".join(names))
+        except RedisError as err:
+            # the write itself succeeded so only the other processes miss out
+            logger.warning("Could not publish read cache invalidation: %s", err)
+
+    def stats(self) -> dict:
+        """Returns the hit, miss and invalidation counts and the state of the listener"""
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "listening": bool(self.mode and self._thread and self._thread.is_alive()),
+                "tracking": self._tracker is not None,
+                "restarts": self.restarts,
+                "size": len(self._values),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "evictions": self.evictions,
+            }
+
+    ######################################################################
+    #  P R I V A T E   M E T H O D S
+    ######################################################################
+
+    def _listen(self) -> None:
+        """Subscribes to invalidations, with CLIENT TRACKING when the server has it"""
+        redis = self.connection()
+        self._pubsub = redis.pubsub(ignore_subscribe_messages=True)
+        try:
+            self._start_tracking(redis)
+            self.mode = "tracking"
+        except ResponseError as err:
+            logger.info("CLIENT TRACKING is not available (%s), using pub/sub invalidation", err)
+            self._pubsub.subscribe(**{FALLBACK_CHANNEL: self._on_fallback_message})
+            self.mode = "pubsub"
+        self._thread = self._pubsub.run_in_thread(
+            sleep_time=1.0, daemon=True, exception_handler=self._on_listener_error
+        )
+
+    def _close(self) -> None:
+        """Closes the listener and the tracking connection"""
+        if self._thread:
+            self._thread.stop()
+            self._thread.join(timeout=5)
+            self._thread = None
+        if self._pubsub:
+            self._pubsub.close()
+            self._pubsub = None
+        if self._tracker:
+            self._tracker.disconnect()
+            self._tracker = None
+
+    def _watch(self) -> None:
+        """Subscribes again, with the cache emptied, whenever invalidations may be missed"""
+        while not self._stopping.wait(self.check_interval):
+            if self.listening():
+                continue
+            self._disable()
+            self._close()
+            try:
+                self._listen()
+            except RedisError as err:
+                logger.warning("Read cache could not subscribe to invalidations: %s", err)
+                self._close()
+                self.mode = None
+                continue
+            self.restarts += 1
+            logger.info("Read cache resubscribed in %s mode", self.mode)
+
+    def _start_tracking(self, redis: Redis) -> None:
+        """Redirects broadcast invalidations to the pub/sub connection
+
+        Tracking lives as long as the connection that enabled it, so that
+        connection is kept out of the pool for as long as the cache runs
+        """
+        pool = redis.connection_pool
+        listener = pool.connection_class(**pool.connection_kwargs)
+        listener.send_command("CLIENT", "ID")
+        client_id = listener.read_response()
+        # a new connection has a new client id that tracking does not redirect to
+        listener.register_connect_callback(self._on_reconnect)
+        self._pubsub.connection = listener
+        self._pubsub.subscribe(**{TRACKING_CHANNEL: self._on_tracking_message})
+
+        tracker = pool.connection_class(**pool.connection_kwargs)
+        command = ["CLIENT", "TRACKING", "ON", "REDIRECT", client_id, "BCAST"]
+        if self.prefix:
+            command += ["PREFIX", self.prefix]
+        try:
+            tracker.send_command(*command)
+            tracker.read_response()
+        except ResponseError:
+            tracker.disconnect()
+            self._pubsub.reset()
+            raise
+        self._tracker = tracker
+
+    def _on_tracking_message(self, message: dict) -> None:
+        """Handles an invalidation sent by CLIENT TRACKING (None means flushed)"""
+        self.invalidate(message["data"])
+
+    def _on_fallback_message(self, message: dict) -> None:
+        """Handles an invalidation published by another process"""
+        data = message["data"]
+        self.invalidate(data.split("\n") if data else None)
+
+    def _on_reconnect(self, _connection) -> None:
+        """Turns the cache off when the tracking redirect is lost"""
+        logger.warning("Read cache invalidation connection was re-established, caching is off")
+        self._disable()
+
+    def _on_listener_error(self, error: Exception, pubsub, thread) -> None:
+        """Turns the cache off when invalidations may have been missed"""
+        logger.warning("Read cache lost its invalidation connection: %s", error)
+        self._disable()
+        pubsub.close()
+        thread.stop()
+
+    def _disable(self) -> None:
+        """Stops caching until the cache is restarted"""
+        with self._lock:
+            self.mode = None
+        self.invalidate()
@@ -0,0 +1,189 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Read Replicas
+
+This module sends reads to the replicas of a Redis primary. A replica is
+only read from while it is fresh: its link to the primary is up, or has
+been down for no longer than ``max_lag`` seconds, and its circuit breaker
+is not open. Freshness is checked with INFO replication at most once every
+``check_interval`` seconds, and reads go to the primary whenever no
+replica is fresh.
+
+Replicas are either listed up front or discovered from Redis Sentinel,
+which is asked again for the replicas of its primary at every check, so
+replicas that are added, removed or promoted are picked up as they change.
+"""
+import time
+import logging
+import threading
+import itertools
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit, urlunsplit
+from redis import Redis
+from redis.exceptions import RedisError
+from redis.sentinel import Sentinel
+from service.common.breaker import OPEN
+
+logger = logging.getLogger(__name__)
+
+
+def replica_is_fresh(replica: Redis, max_lag: float) -> bool:
+    """Returns True if a replica is replicating and at most max_lag seconds behind"""
+    try:
+        info = replica.info("replication")
+    except RedisError:
+        return False
+    if info.get("role") != "slave":
+        return False  # e.g. a replica that was promoted
+    if info.get("master_link_status") == "up":
+        return True
+    return info.get("master_link_down_since_seconds", float("inf")) <= max_lag
+
+
+class ReplicaSet:
+    """A Redis primary and the replicas its reads are spread over"""
+
+    def __init__(
+        self,
+        primary: Redis,
+        replicas: Optional[Dict[str, Redis]] = None,
+        max_lag: float = 5.0,
+        check_interval: float = 1.0,
+        discover: Optional[Callable[[], Dict[str, Redis]]] = None,
+    ):
+        """Constructor
+
+        :param primary: the Redis that is written to
+        :param replicas: the replicas of primary by their addresses
+        :param max_lag: seconds a replica may be behind and still be read from
+        :param check_interval: seconds between checks of the replicas
+        :param discover: returns the current replicas (e.g. from Sentinel)
+        """
+        self.primary = primary
+        self.replicas = replicas or {}
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.discover = discover
+        self._lock = threading.Lock()
+        self._fresh: List[Redis] = []
+        self._turn = itertools.count()
+        self.checked_at = float("-inf")
+        self.replica_reads = 0
+        self.primary_reads = 0
+
+    @property
+    def has_replicas(self) -> bool:
+        """Returns True if there are (or may be discovered) replicas to read from"""
+        return bool(self.replicas or self.discover)
+
+    def reader(self) -> Redis:
+        """Returns the Redis to read from, taking fresh replicas in turn"""
+        if time.monotonic() - self.checked_at >= self.check_interval and self._lock.acquire(blocking=False):
+            # one caller checks while the others keep using the last result
+            try:
+                self.check()
+            finally:
+                self._lock.release()
+        fresh = [replica for replica in self._fresh if replica.breaker.state != OPEN]
+        if not fresh:
+            self.primary_reads += 1
+            return self.primary
+        self.replica_reads += 1
+        return fresh[next(self._turn) % len(fresh)]
+
+    def check(self) -> None:
+        """Finds the replicas that are fresh enough to read from"""
+        self.checked_at = time.monotonic()
+        if self.discover:
+            try:
+                self.replicas = self.discover()
+            except RedisError as err:
+                logger.warning("Could not discover the replicas: %s", err)
+        fresh = [replica for replica in self.replicas.values() if replica_is_fresh(replica, self.max_lag)]
+        if len(fresh) < len(self._fresh) or (fresh and not self._fresh):
+            logger.info("Reading from %d of %d replicas", len(fresh), len(self.replicas))
+        self._fresh = fresh
+
+    def restart(self) -> None:
+        """Starts over in a forked process, whose lock may have been held by another thread"""
+        self._lock = threading.Lock()
+        self.checked_at = float("-inf")
+        self.replica_reads = 0
+        self.primary_reads = 0
+
+    def clients(self) -> List[Redis]:
+        """Returns the primary and every replica"""
+        return [self.primary] + list(self.replicas.values())
+
+    def stats(self) -> dict:
+        """Returns how many replicas are fresh and where reads went"""
+        return {
+            "replicas": len(self.replicas),
+            "fresh": len(self._fresh),
+            "replica_reads": self.replica_reads,
+            "primary_reads": self.primary_reads,
+        }
+
+
+def create_sentinel(sentinel_uris: List[str], settings: dict) -> Sentinel:
+    """Creates a Sentinel client from the uris of the Sentinels
+
+    Arguments:
+        sentinel_uris: e.g. ["redis://sentinel-1:26379", "redis://sentinel-2:26379"],
+            a password in the first uri is used for every Sentinel
+        settings: a mapping such as app.config
+    """
+    addresses: List[Tuple[str, int]] = []
+    for uri in sentinel_uris:
+        parts = urlsplit(uri)
+        addresses.append((parts.hostname or "localhost", parts.port or 26379))
+    password = urlsplit(sentinel_uris[0]).password if sentinel_uris else None
+    options = {
+        "socket_timeout": settings.get("REDIS_SOCKET_TIMEOUT"),
+        "socket_connect_timeout": settings.get("REDIS_SOCKET_CONNECT_TIMEOUT"),
+        "password": password or None,
+    }
+    options = {key: value for key, value in options.items() if value is not None}
+    return Sentinel(addresses, sentinel_kwargs=options)
+
+
+def sentinel_discovery(sentinel: Sentinel, service: str, connect: Callable[[str], Redis]) -> Callable[[], Dict[str, Redis]]:
+    """Returns a function that asks Sentinel for the replicas of a service
+
+    Arguments:
+        sentinel: the Sentinel client to ask
+        service: the name the primary is monitored under (e.g. "mymaster")
+        connect: makes a client for a replica's "host:port", once per replica
+    """
+    clients: Dict[str, Redis] = {}
+
+    def discover() -> Dict[str, Redis]:
+        addresses = [f"{host}:{port}" for host, port in sentinel.discover_slaves(service)]
+        for address in addresses:
+            if address not in clients:
+                clients[address] = connect(address)
+        return {address: clients[address] for address in addresses}
+
+    return discover
+
+
+def with_address(uri: str, address: str) -> str:
+    """Returns uri with its host and port replaced by address, keeping the credentials and database"""
+    parts = urlsplit(uri)
+    credentials, _, _ = parts.netloc.rpartition("@")
+    return urlunsplit(parts._replace(netloc=f"{credentials}@{address}" if credentials else address))
@@ -0,0 +1,121 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Consistent Hash Ring
+
+This module spreads counters over several independent Redis servers.
+Each server is placed on a ring at many points (virtual nodes) and a
+counter belongs to the server at the first point after the hash of its
+name, so adding a server only moves about 1/n of the counters and every
+process that is given the same servers agrees on where each counter is.
+
+The servers are named by host, port and database, not by their full
+URI, so that changing a password does not move any counters.
+"""
+import bisect
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Sequence, Tuple
+from urllib.parse import urlsplit
+
+# points each server is placed at on the ring, more points spread counters more evenly
+REPLICAS = 160
+THREAD_PREFIX = "hash-ring"
+
+
+def split_uris(database_uri: str) -> List[str]:
+    """Returns the URIs of a comma separated list of Redis servers"""
+    return [uri.strip() for uri in database_uri.split(",") if uri.strip()]
+
+
+def node_name(uri: str) -> str:
+    """Returns the name a server is placed on the ring with, e.g. "redis-1:6379/0" """
+    parts = urlsplit(uri)
+    return f"{parts.hostname or 'localhost'}:{parts.port or 6379}{parts.path or '/0'}"
+
+
+def ring_hash(key: str) -> int:
+    """Returns the position of a key on the ring (the same in every process)"""
+    return int.from_bytes(hashlib.md5(key.encode("utf-8"), usedforsecurity=False).digest()[:8], "big")
+
+
+class HashRing:
+    """Maps names to nodes with consistent hashing and calls nodes in parallel"""
+
+    def __init__(self, nodes: Dict[str, Any], replicas: int = REPLICAS, concurrency: int = 1):
+        """Constructor
+
+        :param nodes: the nodes (e.g. Redis clients) by their names
+        :param replicas: points each node is placed at on the ring
+        :param concurrency: calls that may fan out at the same time (e.g. the
+            request threads of the process), the workers are sized for them
+        """
+        if not nodes:
+            raise ValueError("A hash ring needs at least one node")
+        self.names = list(nodes)
+        self.nodes = list(nodes.values())
+        points = sorted(
+            (ring_hash(f"{name}#{replica}"), index) for index, name in enumerate(self.names) for replica in range(replicas)
+        )
+        self._hashes = [point for point, _ in points]
+        self._owners = [index for _, index in points]
+        # the caller handles one node itself, workers are only started when needed
+        self.max_workers = max(len(self.nodes) - 1, 1) * max(concurrency, 1)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=THREAD_PREFIX)
+
+    def index(self, key: str) -> int:
+        """Returns the index of the node that holds a key"""
+        position = bisect.bisect(self._hashes, ring_hash(key)) % len(self._hashes)
+        return self._owners[position]
+
+    def get(self, key: str) -> Any:
+        """Returns the node that holds a key"""
+        return self.nodes[self.index(key)]
+
+    def group(self, keys: Iterable[str]) -> List[Tuple[Any, List[str]]]:
+        """Groups keys by the node that holds them, keeping their order
+
+        Returns:
+            (node, keys) pairs in the order the nodes were given
+        """
+        groups: Dict[int, List[str]] = {}
+        for key in keys:
+            groups.setdefault(self.index(key), []).append(key)
+        return [(self.nodes[index], groups[index]) for index in sorted(groups)]
+
+    def map(self, function: Callable[[Any], Any], items: Sequence[Any]) -> list:
+        """Calls function with each item, in parallel when there are several
+
+        The first item is handled on the calling thread while the workers
+        handle the rest, so calls made at the same time only queue behind
+        each other once more than ``concurrency`` of them fan out. A call
+        made from one of the workers is handled on that worker, so a
+        worker never waits for itself.
+        """
+        if len(items) <= 1 or threading.current_thread().name.startswith(THREAD_PREFIX):
+            return [function(item) for item in items]
+        futures = [self.executor.submit(function, item) for item in items[1:]]
+        return [function(items[0])] + [future.result() for future in futures]
+
+    def restart(self) -> None:
+        """Replaces the worker threads (they do not survive a fork)"""
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=THREAD_PREFIX)
+
+    def close(self) -> None:
+        """Stops the worker threads"""
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,99 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Response Serializers
+
+This module replaces Flask's JSON provider with one that encodes with
+orjson, and answers in MessagePack instead when the client's Accept
+header prefers application/msgpack. Every jsonify() in the service goes
+through it, so the routes do not change. Request bodies are small and
+are still parsed with json, which keeps integers wider than 64 bits
+exact where orjson would turn them into floats.
+
+Both libraries are optional: without orjson the standard library json
+module is used, and without msgpack every response is JSON.
+"""
+import json
+from typing import Any
+from flask import Flask, Response, has_request_context, request
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+MSGPACK = "application/msgpack"
+MSGPACK_TYPES = (MSGPACK, "application/x-msgpack")
+
+
+def init_app(app: Flask) -> None:
+    """Makes the application serialize with FastJSONProvider"""
+    app.json = FastJSONProvider(app)
+
+
+def accepts_msgpack() -> bool:
+    """Returns True if the client of the current request prefers MessagePack to JSON"""
+    if msgpack is None or not has_request_context():
+        return False
+    return request.accept_mimetypes.best_match(("application/json",) + MSGPACK_TYPES) in MSGPACK_TYPES
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """A JSON provider that encodes with orjson and negotiates MessagePack"""
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return self.encode(obj).decode()
+
+    def encode(self, obj: Any) -> bytes:
+        """Returns obj as compact JSON"""
+        if orjson is not None:
+            # dates go through self.default so that they look the same as with json
+            options = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+            if self.sort_keys:
+                options |= orjson.OPT_SORT_KEYS
+            try:
+                return orjson.dumps(obj, default=self.default, option=options)
+            except TypeError:
+                pass  # e.g. integers wider than 64 bits, json can encode those
+        return json.dumps(
+            obj, default=self.default, ensure_ascii=self.ensure_ascii, sort_keys=self.sort_keys, separators=(",", ":")
+        ).encode()
+
+    def pack(self, obj: Any) -> bytes:
+        """Returns obj as MessagePack"""
+        return msgpack.packb(obj, default=self.default)
+
+    def response(self, *args: Any, **kwargs: Any) -> Response:
+        """Serializes the arguments as JSON, or MessagePack if the client prefers it"""
+        obj = self._prepare_response_obj(args, kwargs)
+        if accepts_msgpack():
+            response = self._app.response_class(self.pack(obj), mimetype=MSGPACK)
+        elif self.compact is False or (self.compact is None and self._app.debug):
+            response = super().response(obj)  # pretty printed
+        else:
+            response = self._app.response_class(self.encode(obj) + b"\n", mimetype=self.mimetype)
+        if msgpack is not None:
+            response.vary.add("Accept")
+        return response
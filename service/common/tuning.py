@@ -0,0 +1,139 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Worker Tuning
+
+This module sizes the gunicorn workers to the CPU and memory the
+container is actually allowed to use. Inside a pod os.cpu_count() is the
+number of cores on the node, not the CPU limit, so the limits are read
+from the cgroup (v2 or v1) instead.
+
+Workers are gevent when it is installed and gthread otherwise, since
+requests spend most of their time waiting on Redis. Every setting can be
+forced with an environment variable of the same name prefixed with
+GUNICORN_, e.g. GUNICORN_WORKERS=4 or GUNICORN_WORKER_CLASS=sync
+
+gunicorn.conf.py loads this file by its path, before anything imports
+the service package, so it must only import the standard library.
+"""
+import os
+import math
+import importlib.util
+from typing import Mapping, Optional, Tuple
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+# memory one worker needs to serve requests (the app, Redis pool and buffers)
+WORKER_MEMORY = int(os.environ.get("WORKER_MEMORY_MB", "40")) * 1024 * 1024
+# threads (or greenlets per CPU) for I/O bound workers that wait on Redis
+THREADS_PER_CPU = 4
+GREENLETS_PER_CPU = 100
+# cgroup v1 reports "no limit" as a very large number rather than "max"
+UNLIMITED = 1 << 60
+
+
+def read_file(path: str) -> Optional[str]:
+    """Returns the stripped contents of a file or None if it can't be read"""
+    try:
+        with open(path, encoding="utf-8") as file:
+            return file.read().strip()
+    except OSError:
+        return None
+
+
+def cpu_limit(root: str = CGROUP_ROOT) -> Optional[float]:
+    """Returns the CPUs the cgroup may use, or None when it is not limited"""
+    quota = read_file(os.path.join(root, "cpu.max"))  # cgroup v2: "<quota> <period>"
+    if quota:
+        quota, _, period = quota.partition(" ")
+    else:  # cgroup v1
+        quota = read_file(os.path.join(root, "cpu", "cpu.cfs_quota_us"))
+        period = read_file(os.path.join(root, "cpu", "cpu.cfs_period_us"))
+    if not quota or quota in ("max", "-1") or not period:
+        return None
+    return int(quota) / int(period)
+
+
+def memory_limit(root: str = CGROUP_ROOT) -> Optional[int]:
+    """Returns the bytes of memory the cgroup may use, or None when it is not limited"""
+    limit = read_file(os.path.join(root, "memory.max"))  # cgroup v2
+    if limit is None:
+        limit = read_file(os.path.join(root, "memory", "memory.limit_in_bytes"))  # cgroup v1
+    if not limit or limit == "max" or int(limit) >= UNLIMITED:
+        return None
+    return int(limit)
+
+
+def host_cpus() -> int:
+    """Returns the CPUs this process may be scheduled on"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # not available on every platform
+        return os.cpu_count() or 1
+
+
+def tune(cpus: float, memory: Optional[int], env: Mapping[str, str] = os.environ) -> dict:
+    """Returns gunicorn settings for the CPUs and memory available
+
+    Arguments:
+        cpus: CPUs the workers may use (may be fractional, e.g. 0.25)
+        memory: bytes of memory the workers may use, or None if unlimited
+        env: where GUNICORN_* overrides are read from
+
+    Returns:
+        a dict of gunicorn setting names to values
+    """
+    # the usual (2 x CPUs) + 1, but never more than fit in memory
+    workers = max(1, int(2 * cpus) + 1)
+    if memory:
+        workers = max(1, min(workers, memory // WORKER_MEMORY))
+
+    worker_class = env.get("GUNICORN_WORKER_CLASS")
+    if not worker_class:
+        if importlib.util.find_spec("gevent"):
+            worker_class = "gevent"
+        else:
+            worker_class = "gthread"
+    cpus_per_worker = max(1, math.ceil(cpus / workers))
+
+    settings = {
+        "workers": int(env.get("GUNICORN_WORKERS", workers)),
+        "worker_class": worker_class,
+        "threads": 1,
+        # a throttled (fractional CPU) worker answers heartbeats late, give it longer
+        "timeout": int(env.get("GUNICORN_TIMEOUT", 30 if cpus >= 1 else 60)),
+        "graceful_timeout": int(env.get("GUNICORN_GRACEFUL_TIMEOUT", 30)),
+        # longer than the sync default of 2s so load balancers can reuse connections
+        "keepalive": int(env.get("GUNICORN_KEEPALIVE", 5)),
+        # gevent must patch sockets before Redis is imported, which a preloaded app has already done.
+        # A preloaded master only builds the app, each worker connects and starts threads in post_fork
+        "preload_app": env.get("GUNICORN_PRELOAD_APP", str(worker_class != "gevent")).lower() in ["true", "yes", "1"],
+    }
+    if worker_class == "gthread":
+        settings["threads"] = int(env.get("GUNICORN_THREADS", THREADS_PER_CPU * cpus_per_worker))
+    elif worker_class == "gevent":
+        settings["worker_connections"] = int(env.get("GUNICORN_WORKER_CONNECTIONS", GREENLETS_PER_CPU * cpus_per_worker))
+    return settings
+
+
+def container_limits(root: str = CGROUP_ROOT) -> Tuple[float, Optional[int]]:
+    """Returns the (CPUs, bytes of memory) of the container this runs in
+
+    The memory is None when it is not limited
+    """
+    cpus = min(cpu_limit(root) or host_cpus(), host_cpus())
+    return cpus, memory_limit(root)
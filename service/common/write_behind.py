@@ -0,0 +1,274 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Write-Behind Buffer
+
+This module contains an in-process buffer that coalesces counter
+increments and writes them to Redis in the background as one
+pipelined INCRBY per counter
+"""
+import time
+import logging
+import threading
+from typing import Callable, Dict, List, Optional, Tuple, Union
+from redis import Redis
+from redis.exceptions import ResponseError
+
+logger = logging.getLogger(__name__)
+
+# the range of the integers Redis can increment
+MIN_VALUE = -(2**63)
+MAX_VALUE = 2**63 - 1
+
+
+class WriteBehindBuffer:
+    """Coalesces increments in memory and flushes them to Redis
+
+    Increments are added to a pending map and flushed every ``interval``
+    seconds, or sooner once ``max_pending`` increments are waiting. The
+    last value read from Redis for each counter is remembered for up to
+    ``staleness`` seconds, so the value returned to callers is that
+    snapshot plus whatever this process has not flushed yet.
+
+    Increments buffered in another process are invisible here until they
+    are flushed. Pass a ``write`` that only touches existing keys so that
+    a flush cannot re-create a counter another process deleted.
+
+    Increments are written at least once. ``write`` either raises or
+    reports which increments it could not write, and those are buffered
+    again. A failure after the MULTI/EXEC was sent (e.g. a timeout waiting
+    for its reply) cannot tell whether Redis applied it, so a retry may
+    add those increments a second time. Only reads of a counter that is
+    being flushed wait for the flush.
+    """
+
+    def __init__(
+        self,
+        connection: Callable[[], Redis],
+        interval: float = 0.05,
+        max_pending: int = 1000,
+        staleness: float = 1.0,
+        on_flush: Optional[Callable[[List[str]], None]] = None,
+        write: Optional[Callable[[Dict[str, int]], Dict[str, Union[int, None, Exception]]]] = None,
+        read: Optional[Callable[[str], Optional[int]]] = None,
+    ):
+        """Constructor
+
+        :param connection: returns the Redis client to flush to
+        :param interval: seconds between background flushes
+        :param max_pending: number of buffered increments that triggers an early flush
+        :param staleness: seconds a value read from Redis may be reused
+        :param on_flush: called with the names of the counters each flush changed
+        :param write: adds {name: amount} to Redis and returns the new values,
+            None for counters that no longer exist or refused the increment,
+            or the error for counters that were not written and should be
+            retried (default INCRBY in MULTI/EXEC)
+        :param read: returns the value of a counter or None (default GET)
+        """
+        self.connection = connection
+        self.interval = interval
+        self.max_pending = max_pending
+        self.staleness = staleness
+        self.on_flush = on_flush
+        self.write = write or self._incrby
+        self.read_value = read or self._get
+        self._lock = threading.Lock()
+        # held while flushing so that only one flush runs at a time
+        self._flush_lock = threading.Lock()
+        # notified whenever a flush has finished with its batch
+        self._flushed = threading.Condition(self._lock)
+        self._pending: Dict[str, int] = {}
+        self._inflight: Dict[str, int] = {}
+        self._known: Dict[str, Tuple[int, float]] = {}
+        self._buffered = 0
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """Starts the background flusher thread (unless it is already running)"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stops the background flusher and flushes what is left"""
+        self._stopping = True
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def increment(self, name: str, amount: int = 1) -> Optional[int]:
+        """Buffers an increment
+
+        Returns:
+            the expected value of the counter after the increment, or
+            None if the counter does not exist
+
+        Raises:
+            OverflowError: the increment would take the counter past a
+                signed 64 bit integer (nothing is buffered)
+        """
+        base = self._base(name)
+        if base is None:
+            return None
+        with self._lock:
+            value = base + self._unflushed(name) + amount
+            if not MIN_VALUE <= value <= MAX_VALUE:
+                raise OverflowError(f"Incrementing counter '{name}' by {amount} would overflow")
+            self._pending[name] = self._pending.get(name, 0) + amount
+            self._buffered += amount
+            full = self._buffered >= self.max_pending
+        if full:
+            self._wakeup.set()
+        return value
+
+    def read(self, name: str) -> Optional[int]:
+        """Returns the value of a counter including unflushed increments
+
+        Returns None if the counter does not exist
+        """
+        base = self._base(name)
+        if base is None:
+            return None
+        with self._lock:
+            return base + self._unflushed(name)
+
+    def discard(self, name: str) -> None:
+        """Drops everything buffered for a counter (e.g. when it is deleted)"""
+        with self._lock:
+            self._buffered -= self._pending.pop(name, 0)
+            self._known.pop(name, None)
+
+    def clear(self) -> None:
+        """Drops everything buffered and remembered"""
+        with self._lock:
+            self._pending = {}
+            self._known = {}
+            self._buffered = 0
+
+    def flush(self) -> None:
+        """Writes every pending increment to Redis in one pipeline
+
+        The increments that were not written are put back so that they
+        are retried on the next flush and no counts are lost
+        """
+        with self._flush_lock:
+            self._flush()
+
+    ######################################################################
+    #  P R I V A T E   M E T H O D S
+    ######################################################################
+
+    def _flush(self) -> None:
+        """Flushes the pending increments (caller holds the flush lock)"""
+        with self._lock:
+            if not self._pending:
+                return
+            self._inflight, self._pending = self._pending, {}
+            self._buffered = 0
+            batch = self._inflight
+        try:
+            values = self.write(batch)
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            # the write may or may not have reached Redis, retrying is at least once
+            logger.exception("Write-behind flush of %d counters failed, will retry", len(batch))
+            values = dict.fromkeys(batch, err)
+        failed = {name: batch[name] for name, value in values.items() if isinstance(value, Exception)}
+        now = time.monotonic()
+        with self._lock:
+            for name, value in values.items():
+                if name in failed:
+                    self._pending[name] = self._pending.get(name, 0) + failed[name]
+                    self._buffered += failed[name]
+                elif value is None:
+                    self._known.pop(name, None)
+                else:
+                    self._known[name] = (int(value), now)
+            self._inflight = {}
+            self._flushed.notify_all()
+        if failed and len(failed) < len(batch):
+            logger.error("Write-behind flush of %d of %d counters failed, will retry them", len(failed), len(batch))
+        written = [name for name in batch if name not in failed]
+        if written and self.on_flush:
+            self.on_flush(written)
+        logger.debug("Write-behind flushed %d counters", len(written))
+
+    def _run(self) -> None:
+        """Flushes the buffer until stopped"""
+        while not self._stopping:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def _unflushed(self, name: str) -> int:
+        """Returns increments not yet reflected in Redis (caller holds the lock)"""
+        return self._pending.get(name, 0) + self._inflight.get(name, 0)
+
+    def _base(self, name: str) -> Optional[int]:
+        """Returns the last value read from Redis if it is fresh enough
+
+        Redis may or may not hold the increments of a counter that is being
+        flushed, so a read of that counter waits for the flush and uses the
+        value it left. Reads of other counters go ahead during a flush.
+        """
+        while True:
+            with self._lock:
+                while name in self._inflight:
+                    self._flushed.wait()
+                entry = self._known.get(name)
+                start = time.monotonic()
+                if entry and start - entry[1] <= self.staleness:
+                    return entry[0]
+            value = self.read_value(name)
+            with self._lock:
+                if name in self._inflight:
+                    # a flush of the counter began during the read
+                    continue
+                entry = self._known.get(name)
+                if entry and entry[1] >= start:
+                    # a flush of the counter ended during the read and left a newer value
+                    return entry[0]
+                if value is not None:
+                    self._known[name] = (value, time.monotonic())
+                return value
+
+    def _incrby(self, batch: Dict[str, int]) -> Dict[str, Optional[int]]:
+        """Adds the batch to Redis with INCRBY in one MULTI/EXEC round trip
+
+        An INCRBY that Redis refuses (e.g. because it would overflow) is
+        dropped, since it would be refused again, and the rest still apply
+        """
+        pipeline = self.connection().pipeline()
+        for name, amount in batch.items():
+            pipeline.incrby(name, amount)
+        values = {}
+        for name, reply in zip(batch, pipeline.execute(raise_on_error=False)):
+            if isinstance(reply, ResponseError):
+                logger.error("Write-behind dropped an increment of %d to '%s': %s", batch[name], name, reply)
+                reply = None
+            values[name] = reply
+        return values
+
+    def _get(self, name: str) -> Optional[int]:
+        """Reads a counter with GET"""
+        value = self.connection().get(name)
+        return None if value is None else int(value)
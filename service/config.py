@@ -5,5 +5,75 @@ import os
 import logging
 
 # Get configuration from environment
+# a comma separated list of URIs spreads the counters over several servers (see service.common.ring)
 DATABASE_URI = os.getenv("DATABASE_URI", "redis://:@localhost:6379/0")
 LOGGING_LEVEL = logging.INFO
+
+# Set by gunicorn.conf.py when the app is preloaded in the master: create_app
+# then leaves connecting to Redis and starting threads to the workers (see service.start)
+DEFER_START = os.getenv("DEFER_START", "False").lower() in ["true", "yes", "1"]
+
+# Redis connection pool (see service.common.pool.create_pool)
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "50"))
+REDIS_POOL_BLOCKING = os.getenv("REDIS_POOL_BLOCKING", "True").lower() in ["true", "yes", "1"]
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", "2.0"))
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", "5.0"))
+REDIS_SOCKET_CONNECT_TIMEOUT = float(os.getenv("REDIS_SOCKET_CONNECT_TIMEOUT", "2.0"))
+REDIS_SOCKET_KEEPALIVE = os.getenv("REDIS_SOCKET_KEEPALIVE", "True").lower() in ["true", "yes", "1"]
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", "30"))
+
+# Read replicas (see service.common.replicas), either listed for a single
+# DATABASE_URI or discovered from Redis Sentinel, whose comma separated
+# services (one per server to spread the counters over) are then used in
+# place of the hosts in DATABASE_URI, which still gives the password and db
+REDIS_REPLICA_URIS = os.getenv("REDIS_REPLICA_URIS", "")
+REDIS_SENTINEL_URIS = os.getenv("REDIS_SENTINEL_URIS", "")
+REDIS_SENTINEL_SERVICES = os.getenv("REDIS_SENTINEL_SERVICES", "mymaster")
+# seconds a replica's link to its primary may be down before reads go elsewhere
+REDIS_REPLICA_MAX_LAG = float(os.getenv("REDIS_REPLICA_MAX_LAG", "5.0"))
+REDIS_REPLICA_CHECK_INTERVAL = float(os.getenv("REDIS_REPLICA_CHECK_INTERVAL", "1.0"))
+
+# Pagination of GET /counters
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", "100"))
+PAGE_SIZE_MAX = int(os.getenv("PAGE_SIZE_MAX", "1000"))
+
+# Largest number of counters POST /counters/batch accepts
+BATCH_SIZE_MAX = int(os.getenv("BATCH_SIZE_MAX", "1000"))
+
+# Counters read per round trip by GET /counters/export and written per
+# round trip by POST /counters/import
+EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", "1000"))
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "1000"))
+
+# Write-behind buffering of increments (see Counter.enable_write_behind)
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "False").lower() in ["true", "yes", "1"]
+WRITE_BEHIND_INTERVAL = float(os.getenv("WRITE_BEHIND_INTERVAL", "0.05"))
+WRITE_BEHIND_MAX_PENDING = int(os.getenv("WRITE_BEHIND_MAX_PENDING", "1000"))
+WRITE_BEHIND_STALENESS = float(os.getenv("WRITE_BEHIND_STALENESS", "1.0"))
+
+# Per-process read cache kept coherent by Redis (see Counter.enable_read_cache)
+READ_CACHE = os.getenv("READ_CACHE", "False").lower() in ["true", "yes", "1"]
+READ_CACHE_SIZE = int(os.getenv("READ_CACHE_SIZE", "10000"))
+# Seconds between checks that the cache still receives invalidations
+READ_CACHE_CHECK_INTERVAL = float(os.getenv("READ_CACHE_CHECK_INTERVAL", "1.0"))
+
+# POST /admin/purge?confirm=true deletes PURGE_BATCH_SIZE keys per round trip and
+# sleeps PURGE_PAUSE seconds in between. With REDIS_DEDICATED_DB the
+# databases hold nothing but counters and are emptied with FLUSHDB ASYNC.
+PURGE_BATCH_SIZE = int(os.getenv("PURGE_BATCH_SIZE", "500"))
+PURGE_PAUSE = float(os.getenv("PURGE_PAUSE", "0.01"))
+REDIS_DEDICATED_DB = os.getenv("REDIS_DEDICATED_DB", "False").lower() in ["true", "yes", "1"]
+
+# Most shards PUT /counters/<name>/shards may spread a counter over
+SHARDS_MAX = int(os.getenv("SHARDS_MAX", "64"))
+
+# Most counters GET /counters/top may return
+TOP_K_MAX = int(os.getenv("TOP_K_MAX", "1000"))
+
+# Redis circuit breaker (see service.common.breaker)
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))
+BREAKER_SLOW_CALL = float(os.getenv("BREAKER_SLOW_CALL", "1.0"))
+BREAKER_RESET_TIMEOUT = float(os.getenv("BREAKER_RESET_TIMEOUT", "5.0"))
+
+# Seconds /ready reuses the result of its Redis PING for
+READY_CHECK_INTERVAL = float(os.getenv("READY_CHECK_INTERVAL", "5.0"))
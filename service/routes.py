@@ -16,10 +16,44 @@
 """
 Redis Counter Demo in Docker
 """
-from flask import jsonify, abort, url_for
+import itertools
+from urllib.parse import quote
+from flask import Response, jsonify, abort, request, stream_with_context, url_for
 from flask import current_app as app
-from service.common import status  # HTTP Status Codes
-from .models import Counter
+from werkzeug.http import quote_etag
+from service.common import metrics, serializers, status  # HTTP Status Codes
+from service.common.health import CachedCheck
+from .models import (
+    SCAN_COUNT,
+    Counter,
+    DatabaseConnectionError,
+    parse_deltas,
+    parse_members,
+    parse_names,
+    parse_window,
+    validate_name,
+)
+
+# media type of a listing streamed as one JSON object per line
+NDJSON = "application/x-ndjson"
+
+
+# endpoints that answer without Redis
+NO_REDIS_ENDPOINTS = {"health", "ready", "stats", "metrics_endpoint", "index", "static"}
+
+
+@app.before_request
+def require_redis():
+    """Answers 503_SERVICE_UNAVAILABLE until Redis has been connected to"""
+    if Counter.redis is None and request.endpoint not in NO_REDIS_ENDPOINTS:
+        raise DatabaseConnectionError("Not connected to Redis yet")
+
+
+@app.url_value_preprocessor
+def check_name(endpoint, values):  # pylint: disable=unused-argument
+    """Answers 400_BAD_REQUEST for a counter name that could reach another counter's keys"""
+    if values and "name" in values:
+        validate_name(values["name"])
 
 
 ############################################################
@@ -27,10 +61,56 @@ from .models import Counter
 ############################################################
 @app.route("/health")
 def health():
-    """Health Status"""
+    """Health Status
+
+    Only says that the process is up, Redis is checked by /ready
+    """
     return {"status": "OK"}, status.HTTP_200_OK
 
 
+############################################################
+# Readiness Endpoint
+############################################################
+readiness = CachedCheck(Counter.ping, app.config["READY_CHECK_INTERVAL"])
+
+
+@app.route("/ready")
+def ready():
+    """Readiness Status
+
+    Ready once Redis answers. The answer is cached for READY_CHECK_INTERVAL
+    seconds so that probes never add load to Redis
+    """
+    healthy, age = readiness.status()
+    body = {"status": "OK" if healthy else "Redis is not reachable", "checked_seconds_ago": round(age, 3)}
+    return body, status.HTTP_200_OK if healthy else status.HTTP_503_SERVICE_UNAVAILABLE
+
+
+############################################################
+# Statistics Endpoint
+############################################################
+@app.route("/stats")
+def stats():
+    """Statistics of this worker's Redis access"""
+    return {
+        "pool": Counter.pool_stats(),
+        "cache": Counter.cache.stats() if Counter.cache else None,
+        "breaker": Counter.breaker_stats(),
+        "replicas": Counter.replica_stats(),
+        "startup": app.extensions["startup"],
+    }, status.HTTP_200_OK
+
+
+############################################################
+# Metrics Endpoint
+############################################################
+@app.route("/metrics")
+def metrics_endpoint():
+    """Prometheus metrics of every worker"""
+    body, content_type = metrics.render()
+    return body, status.HTTP_200_OK, {"Content-Type": content_type}
+
+
 ############################################################
 # Home Page
 ############################################################
@@ -50,15 +130,166 @@ def index():
 ############################################################
 @app.route("/counters", methods=["GET"])
 def list_counters():
-    """List counters"""
+    """List counters
+
+    Without query parameters every counter is streamed back (see
+    stream_counters). Passing a ``cursor`` and/or ``limit`` returns a
+    single page instead. The cursor is the last name of the previous page,
+    so counters created or deleted between pages never make a page skip
+    or repeat a counter. The cursor of the next page is sent back URL
+    encoded in the ``X-Next-Cursor`` header (left out on the last page)
+    and the number of counters in the ``X-Total-Count`` header
+
+    The ETag is the version of the whole namespace, so If-None-Match is
+    answered with 304_NOT_MODIFIED without reading any counter
+    """
     app.logger.info("Request to list all counters...")
 
-    counters = Counter.all()
+    streamed = "cursor" not in request.args and "limit" not in request.args
+    ndjson = streamed and request.accept_mimetypes.best_match(["application/json", NDJSON]) == NDJSON
+    etag = Counter.version() + "-ndjson" if ndjson else representation_etag(Counter.version())
+    if request.if_none_match.contains(etag):
+        app.logger.info("Counters not modified")
+        return not_modified(etag)
+
+    if streamed:
+        mimetype = NDJSON if ndjson else serializers.MSGPACK if serializers.accepts_msgpack() else "application/json"
+        return stream_counters(mimetype, {"ETag": quote_etag(etag), "Vary": "Accept"})
+
+    cursor = request.args.get("cursor", "")
+    limit = get_int_arg("limit", app.config["PAGE_SIZE"], minimum=1)
+    limit = min(limit, app.config["PAGE_SIZE_MAX"])
+
+    counters, next_cursor = Counter.page(cursor, limit)
+
+    headers = {"X-Total-Count": str(Counter.count()), "ETag": quote_etag(etag)}
+    if next_cursor:
+        headers["X-Next-Cursor"] = quote(next_cursor, safe="")
+        next_url = url_for("list_counters", cursor=next_cursor, limit=limit, _external=True)
+        headers["Link"] = f'<{next_url}>; rel="next"'
+    app.logger.info("Returning %d counters, next cursor %r...", len(counters), next_cursor)
+    return jsonify(counters), status.HTTP_200_OK, headers
+
+
+############################################################
+# Export and import counters
+############################################################
+@app.route("/counters/export", methods=["GET"])
+def export_counters():
+    """Export every counter as NDJSON
+
+    The counters are streamed EXPORT_PAGE_SIZE at a time, so memory stays
+    flat however many there are. The body can be posted back to
+    /counters/import as it is.
+    """
+    app.logger.info("Request to Export counters...")
+    headers = {"Content-Disposition": 'attachment; filename="counters.ndjson"'}
+    return stream_counters(NDJSON, headers, app.config["EXPORT_PAGE_SIZE"])
 
-    app.logger.info("Returning %d counters...", len(counters))
+
+@app.route("/counters/import", methods=["POST"])
+def import_counters():
+    """Import counters from an NDJSON body
+
+    The body is read and written IMPORT_CHUNK_SIZE counters at a time.
+    With ``mode=merge`` (the default) the imported values are added to
+    existing counters, with ``mode=overwrite`` they replace them.
+    """
+    app.logger.info("Request to Import counters...")
+
+    mode = request.args.get("mode", "merge")
+    if mode not in ("merge", "overwrite"):
+        abort(status.HTTP_400_BAD_REQUEST, "Query parameter 'mode' must be 'merge' or 'overwrite'")
+    count = Counter.import_counters(request.stream, mode == "overwrite", app.config["IMPORT_CHUNK_SIZE"])
+
+    app.logger.info("Imported %d counters", count)
+    return jsonify(imported=count, mode=mode)
+
+
+############################################################
+# Purge every counter
+############################################################
+@app.route("/admin/purge", methods=["POST"])
+def purge_counters():
+    """Delete every counter on a background thread
+
+    The request must confirm the purge with ``?confirm=true``. Only this
+    service's keys are deleted, PURGE_BATCH_SIZE at a time with
+    PURGE_PAUSE seconds in between so that Redis keeps answering other
+    clients. The response is 202_ACCEPTED with the progress and a
+    Location to follow it at, or 409_CONFLICT if a purge is running.
+    """
+    app.logger.info("Request to Purge all counters...")
+    if request.args.get("confirm", "").lower() != "true":
+        abort(status.HTTP_400_BAD_REQUEST, "Confirm the purge of every counter with ?confirm=true")
+
+    started = Counter.purge_in_background(
+        app.config["PURGE_BATCH_SIZE"], app.config["PURGE_PAUSE"], app.config["REDIS_DEDICATED_DB"]
+    )
+    if not started:
+        abort(status.HTTP_409_CONFLICT, "A purge is already running")
+
+    location = url_for("purge_progress", _external=True)
+    return jsonify(Counter.purge_progress()), status.HTTP_202_ACCEPTED, {"Location": location}
+
+
+@app.route("/admin/purge", methods=["GET"])
+def purge_progress():
+    """Read the progress of the running or last purge"""
+    return jsonify(Counter.purge_progress())
+
+
+############################################################
+# Migrate counters kept under bare key names
+############################################################
+@app.route("/admin/migrate", methods=["POST"])
+def migrate_counters():
+    """Move counters an older release kept under bare key names
+
+    Releases before KEY_PREFIX stored counter "foo" in the key "foo",
+    and those counters are invisible until they are moved under the
+    prefix. The request must confirm the migration with
+    ``?confirm=true``. Counters that already exist under the prefix are
+    never overwritten, their bare keys are listed as skipped.
+    """
+    app.logger.info("Request to Migrate bare counter keys...")
+    if request.args.get("confirm", "").lower() != "true":
+        abort(status.HTTP_400_BAD_REQUEST, "Confirm the migration of bare counter keys with ?confirm=true")
+
+    return jsonify(Counter.migrate_keys())
+
+
+############################################################
+# Leaderboard
+############################################################
+@app.route("/counters/top", methods=["GET"])
+def top_counters():
+    """List the counters with the highest values, highest first
+
+    The number of counters is given by the ``k`` query parameter
+    """
+    app.logger.info("Request for the top counters...")
+
+    k = min(get_int_arg("k", 10, minimum=1), app.config["TOP_K_MAX"])
+    counters = Counter.top(k)
+
+    app.logger.info("Returning the top %d counters...", len(counters))
     return jsonify(counters)
 
 
+@app.route("/counters/<name>/rank", methods=["GET"])
+def rank_counters(name):
+    """Read a counter's rank on the leaderboard (1 is the highest)"""
+    app.logger.info("Request for the rank of counter: '%s'...", name)
+
+    rank = Counter.rank(name)
+    if rank is None:
+        abort(status.HTTP_404_NOT_FOUND, f"Counter '{name}' does not exist")
+
+    app.logger.info("Counter '%s' is ranked %d", name, rank["rank"])
+    return jsonify(rank)
+
+
 ############################################################
 # Read counters
 ############################################################
@@ -67,13 +298,18 @@ def read_counters(name):
     """Read a counter"""
     app.logger.info("Request to Read counter: '%s'...", name)
 
-    counter = Counter.find(name)
-
-    if not counter:
+    count = Counter.read_behind(name) if Counter.buffer else Counter.read(name)
+    if count is None:
         abort(status.HTTP_404_NOT_FOUND, f"Counter '{name}' does not exist")
 
-    app.logger.info("Returning: %d...", counter.value)
-    return jsonify(counter.serialize())
+    # the body only depends on the value, so the value is a strong ETag
+    etag = representation_etag(str(count))
+    if request.if_none_match.contains(etag):
+        app.logger.info("Counter '%s' not modified", name)
+        return not_modified(etag)
+
+    app.logger.info("Returning: %d...", count)
+    return jsonify(name=name, counter=count), status.HTTP_200_OK, {"ETag": quote_etag(etag)}
 
 
 ############################################################
@@ -84,21 +320,38 @@ def create_counters(name):
     """Create a counter"""
     app.logger.info("Request to Create counter: '%s'...", name)
 
-    counter = Counter.find(name)
-    if counter is not None:
+    if not Counter.create(name):
         abort(status.HTTP_409_CONFLICT, f"Counter '{name}' already exists")
 
-    counter = Counter(name)
-
     location_url = url_for("read_counters", name=name, _external=True)
     app.logger.info("Counter '%s' created", name)
     return (
-        jsonify(counter.serialize()),
+        jsonify(name=name, counter=0),
         status.HTTP_201_CREATED,
         {"Location": location_url},
     )
 
 
+############################################################
+# Batch update counters
+############################################################
+@app.route("/counters/batch", methods=["POST"])
+def batch_update_counters():
+    """Increment many counters at once
+
+    The body is a list of {"name": "...", "delta": 1} objects (delta
+    defaults to 1). Either every counter is updated or, if any of them
+    does not exist, none are.
+    """
+    app.logger.info("Request to Batch update counters...")
+
+    deltas = parse_deltas(request.get_json(), app.config["BATCH_SIZE_MAX"])
+    counts = Counter.increment_many(deltas)
+
+    app.logger.info("Batch updated %d counters", len(counts))
+    return jsonify([{"name": name, "counter": count} for (name, _), count in zip(deltas, counts)])
+
+
 ############################################################
 # Update counters
 ############################################################
@@ -107,16 +360,122 @@ def update_counters(name):
     """Update a counter"""
     app.logger.info("Request to Update counter: '%s'...", name)
 
-    counter = Counter.find(name)
-    if counter is None:
+    count = Counter.increment_behind(name) if Counter.buffer else Counter.increment_existing(name)
+    if count is None:
         abort(status.HTTP_404_NOT_FOUND, f"Counter '{name}' does not exist")
 
-    count = counter.increment()
-
     app.logger.info("Counter '%s' updated to %d", name, count)
     return jsonify(name=name, counter=count)
 
 
+############################################################
+# Rate of counters
+############################################################
+@app.route("/counters/<name>/rate", methods=["GET"])
+def rate_counters(name):
+    """Read how much a counter was incremented in a recent window
+
+    The ``window`` query parameter is a number of seconds, minutes or
+    hours such as 30s, 5m or 1h (the default is 60s)
+    """
+    app.logger.info("Request for the rate of counter: '%s'...", name)
+
+    window = parse_window(request.args.get("window", "60s"))
+    count = Counter.rate(name, window)
+    if count is None:
+        abort(status.HTTP_404_NOT_FOUND, f"Counter '{name}' does not exist")
+
+    app.logger.info("Counter '%s' was incremented %d times in %d seconds", name, count, window)
+    return jsonify(name=name, window=window, count=count)
+
+
+############################################################
+# Unique members of counters
+############################################################
+@app.route("/counters/<name>/uniques", methods=["POST"])
+def add_uniques(name):
+    """Add members to a counter's unique count
+
+    The body is {"member": "..."} or {"members": ["...", ...]}
+    """
+    app.logger.info("Request to Add uniques to counter: '%s'...", name)
+
+    members = parse_members(request.get_json(), app.config["BATCH_SIZE_MAX"])
+    count = Counter.add_uniques(name, members)
+    if count is None:
+        abort(status.HTTP_404_NOT_FOUND, f"Counter '{name}' does not exist")
+
+    app.logger.info("Counter '%s' has about %d unique members", name, count)
+    return jsonify(name=name, uniques=count)
+
+
+@app.route("/counters/<name>/uniques", methods=["GET"])
+def read_uniques(name):
+    """Read the estimated number of unique members of a counter"""
+    app.logger.info("Request to Read uniques of counter: '%s'...", name)
+
+    count = Counter.uniques([name])
+
+    return jsonify(name=name, uniques=count)
+
+
+@app.route("/counters/uniques", methods=["GET"])
+def read_merged_uniques():
+    """Read the number of unique members across the counters in ``names``
+
+    ``names`` is a comma separated list of counters, a member seen by
+    several of them is only counted once
+    """
+    app.logger.info("Request to Read uniques of several counters...")
+
+    names = request.args.get("names", "")
+    names = parse_names(names.split(",") if names else None, app.config["BATCH_SIZE_MAX"])
+    count = Counter.uniques(names)
+
+    return jsonify(names=names, uniques=count)
+
+
+@app.route("/counters/<name>/uniques/merge", methods=["POST"])
+def merge_uniques(name):
+    """Merge the unique members of other counters into a counter
+
+    The body is {"names": ["...", ...]}
+    """
+    app.logger.info("Request to Merge uniques into counter: '%s'...", name)
+
+    data = request.get_json()
+    sources = parse_names(data.get("names") if isinstance(data, dict) else None, app.config["BATCH_SIZE_MAX"])
+    count = Counter.merge_uniques(name, sources)
+
+    app.logger.info("Counter '%s' has about %d unique members", name, count)
+    return jsonify(name=name, uniques=count)
+
+
+############################################################
+# Shard counters
+############################################################
+@app.route("/counters/<name>/shards", methods=["PUT"])
+def shard_counters(name):
+    """Promote a counter to a sharded layout or demote it to a plain one
+
+    The body is {"shards": N}. Increments of a sharded counter are spread
+    over N keys, a value of 0 or 1 makes it a plain counter again.
+    """
+    app.logger.info("Request to Shard counter: '%s'...", name)
+
+    data = request.get_json()
+    shards = data.get("shards") if isinstance(data, dict) else None
+    if not isinstance(shards, int) or isinstance(shards, bool) or not 0 <= shards <= app.config["SHARDS_MAX"]:
+        abort(status.HTTP_400_BAD_REQUEST, f"'shards' must be an integer from 0 to {app.config['SHARDS_MAX']}")
+
+    count = Counter.reshard(name, shards)
+    if count is None:
+        abort(status.HTTP_404_NOT_FOUND, f"Counter '{name}' does not exist")
+
+    app.logger.info("Counter '%s' resharded into %d shards", name, shards)
+    return jsonify(name=name, counter=count, shards=Counter.shards(name))
+
+
 ############################################################
 # Delete counters
 ############################################################
@@ -125,9 +484,91 @@ def delete_counters(name):
     """Delete a counter"""
     app.logger.info("Request to Delete counter: '%s'...", name)
 
-    counter = Counter.find(name)
-    if counter:
-        del counter.value
+    if Counter.buffer:
+        Counter.buffer.discard(name)
+
+    if Counter.delete(name):
         app.logger.info("Counter '%s' deleted", name)
 
     return "", status.HTTP_204_NO_CONTENT
+
+
+############################################################
+#  U T I L I T Y   F U N C T I O N S
+############################################################
+
+
+def not_modified(etag: str) -> Response:
+    """Returns an empty 304_NOT_MODIFIED response for the ETag"""
+    return Response(status=status.HTTP_304_NOT_MODIFIED, headers={"ETag": quote_etag(etag)})
+
+
+def representation_etag(etag: str) -> str:
+    """Returns the ETag of the representation (JSON or MessagePack) the client gets"""
+    return etag + "-msgpack" if serializers.accepts_msgpack() else etag
+
+
+def stream_counters(mimetype: str, headers: dict, limit: int = SCAN_COUNT):
+    """Streams every counter back a page at a time
+
+    The body is a JSON array, or one JSON object per line when the client
+    asks for application/x-ndjson, or one MessagePack map per counter
+    (read it with msgpack.Unpacker) when it asks for application/msgpack.
+    Each page is encoded with a single call as it arrives from Redis, so
+    memory stays flat however many counters there are. The first page is
+    read before the response starts so that an unreachable Redis is still
+    a 503. A failure after that is raised again, so the server aborts the
+    response without ending its chunked body and clients see the transfer
+    fail instead of a short listing or export.
+    """
+    pages = Counter.pages(limit)
+    first = next(pages)
+
+    def generate():
+        count = 0
+        if mimetype == "application/json":
+            yield b"["
+        try:
+            for page in itertools.chain([first], pages):
+                # a page may come back empty when its counters were just deleted
+                yield from encode_page(page, mimetype, continued=count > 0)
+                count += len(page)
+        except DatabaseConnectionError as err:
+            app.logger.error("Listing stopped after %d counters: %s", count, err)
+            raise
+        if mimetype == "application/json":
+            yield b"]"
+        app.logger.info("Returned %d counters", count)
+
+    return Response(stream_with_context(generate()), mimetype=mimetype, headers=headers)
+
+
+def encode_page(page: list, mimetype: str, continued: bool):
+    """Yields one page of a streamed listing
+
+    continued says that earlier pages have already written counters
+    """
+    if mimetype == NDJSON:
+        if page:
+            yield b"".join(app.json.encode(counter) + b"\n" for counter in page)
+        return
+    if mimetype == serializers.MSGPACK:
+        if page:
+            yield b"".join(app.json.pack(counter) for counter in page)
+        return
+    # the elements of the page's array without its brackets
+    body = app.json.encode(page)[1:-1]
+    if body:
+        yield (b"," + body) if continued else body
+
+
+def get_int_arg(name: str, default: int, minimum: int = 0) -> int:
+    """Returns an integer query parameter or aborts with 400_BAD_REQUEST"""
+    value = request.args.get(name, default)
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        abort(status.HTTP_400_BAD_REQUEST, f"Query parameter '{name}' must be an integer")
+    if value < minimum:
+        abort(status.HTTP_400_BAD_REQUEST, f"Query parameter '{name}' must be at least {minimum}")
+    return value
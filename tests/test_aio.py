@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# pylint: disable=too-many-public-methods
+
+"""
+Asyncio Counter Service Test Suite
+
+Test cases can be run with the following:
+  pytest tests/test_aio.py
+"""
+import os
+import asyncio
+import logging
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import patch
+from redis.asyncio import BlockingConnectionPool
+from redis.exceptions import ConnectionError as RedisConnectionError
+from asgi import app
+from service.aio.models import AsyncCounter
+from service.models import (
+    KEY_PREFIX,
+    SHARDS_KEY,
+    CounterNotFoundError,
+    CounterOverflowError,
+    DatabaseConnectionError,
+    DataValidationError,
+    counter_key,
+    shard_key,
+)
+from service.common import status
+
+DATABASE_URI = os.getenv("DATABASE_URI", "redis://:@localhost:6379/0")
+
+logging.disable(logging.CRITICAL)
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class AsyncServiceTest(IsolatedAsyncioTestCase):
+    """Asyncio REST API Server Tests"""
+
+    async def asyncSetUp(self):
+        """This runs before each test"""
+        app.testing = True
+        await AsyncCounter.connect(DATABASE_URI)
+        await AsyncCounter.remove_all()
+        self.client = app.test_client()
+
+    async def asyncTearDown(self):
+        """This runs after each test"""
+        await AsyncCounter.disconnect()
+
+    ######################################################################
+    #  M O D E L   T E S T   C A S E S
+    ######################################################################
+
+    async def test_create_find_increment(self):
+        """It should Create, Find and Increment a counter"""
+        counter = await AsyncCounter.create("foo")
+        self.assertEqual(counter.serialize(), {"name": "foo", "counter": 0})
+        self.assertIsNone(await AsyncCounter.create("foo"))
+        counter = await AsyncCounter.find("foo")
+        self.assertEqual(await counter.increment(), 1)
+        self.assertEqual((await AsyncCounter.find("foo")).value, 1)
+        self.assertTrue(await AsyncCounter.delete("foo"))
+        self.assertFalse(await AsyncCounter.delete("foo"))
+        self.assertIsNone(await AsyncCounter.find("foo"))
+        with self.assertRaises(CounterNotFoundError):
+            await counter.increment()
+        self.assertIsNone(await AsyncCounter.increment_existing("foo"))
+        self.assertIsNone(await AsyncCounter.redis.get(counter_key("foo")))
+        with self.assertRaises(DataValidationError):
+            await AsyncCounter.create("foo:shard:0")
+
+    async def test_all_and_page(self):
+        """It should List counters all at once and by page"""
+        for i in range(12):
+            await AsyncCounter.create(f"foo{i}")
+        self.assertEqual(len(await AsyncCounter.all()), 12)
+        names = []
+        cursor = ""
+        while True:
+            counters, cursor = await AsyncCounter.page(cursor, 5)
+            names.extend(counter["name"] for counter in counters)
+            if not cursor:
+                break
+        self.assertEqual(len(set(names)), 12)
+
+    async def test_remove_all(self):
+        """It should Remove every counter, and nothing else, a batch at a time"""
+        for i in range(5):
+            await AsyncCounter.create(f"foo{i}")
+        await AsyncCounter.redis.set("unrelated", 1)
+        with patch("service.aio.models.SCAN_COUNT", 2):
+            await AsyncCounter.remove_all()
+        self.assertEqual(await AsyncCounter.count(), 0)
+        self.assertEqual(await AsyncCounter.redis.keys(f"{KEY_PREFIX}*"), [])
+        self.assertEqual(await AsyncCounter.redis.get("unrelated"), "1")
+        await AsyncCounter.redis.delete("unrelated")
+
+    async def test_increment_many(self):
+        """It should Increment many counters at once"""
+        await AsyncCounter.create("foo")
+        self.assertEqual(await AsyncCounter.increment_many([("foo", 2), ("foo", 3)]), [2, 5])
+        with self.assertRaises(CounterNotFoundError):
+            await AsyncCounter.increment_many([("foo", 1), ("bar", 1)])
+        with self.assertRaises(CounterOverflowError):
+            await AsyncCounter.increment_many([("foo", 2**62), ("foo", 2**62)])
+        self.assertEqual((await AsyncCounter.find("foo")).value, 5)
+
+    async def test_sharded_counters(self):
+        """It should Read, Increment and Delete a counter with its shards"""
+        await AsyncCounter.create("foo")
+        await AsyncCounter.create("bar")
+        await AsyncCounter.redis.hset(SHARDS_KEY, "foo", 2)
+        await AsyncCounter.redis.set(shard_key("foo", 0), 3)
+        await AsyncCounter.redis.set(shard_key("foo", 1), 4)
+        AsyncCounter.layout_expires = 0.0
+        self.assertEqual((await AsyncCounter.find("foo")).value, 7)
+        self.assertEqual(await AsyncCounter.increment_existing("foo"), 8)
+        self.assertEqual(await AsyncCounter.increment_many([("foo", 2), ("bar", 1)]), [10, 1])
+        counters, _ = await AsyncCounter.page()
+        self.assertEqual(counters, [{"name": "bar", "counter": 1}, {"name": "foo", "counter": 10}])
+        self.assertTrue(await AsyncCounter.delete("foo"))
+        self.assertEqual(await AsyncCounter.redis.exists(counter_key("foo"), shard_key("foo", 0), shard_key("foo", 1)), 0)
+        self.assertIsNone(await AsyncCounter.redis.hget(SHARDS_KEY, "foo"))
+
+    async def test_demoted_counter(self):
+        """It should Increment a counter demoted since the layout was loaded"""
+        await AsyncCounter.create("foo")
+        AsyncCounter.layout = {"foo": 2}
+        AsyncCounter.layout_expires = float("inf")
+        self.assertEqual(await AsyncCounter.increment_existing("foo"), 1)
+        self.assertEqual(AsyncCounter.layout, {})
+
+    async def test_single_server_only(self):
+        """It should refuse several Redis servers and Sentinel"""
+        with self.assertRaises(DatabaseConnectionError):
+            await AsyncCounter.connect(f"{DATABASE_URI},{DATABASE_URI}")
+        with self.assertRaises(DatabaseConnectionError):
+            await AsyncCounter.connect(DATABASE_URI, {"REDIS_SENTINEL_URIS": "redis://localhost:26379"})
+        await AsyncCounter.connect(DATABASE_URI)
+
+    async def test_pool_settings(self):
+        """It should size the pool and time out sockets from the REDIS_* settings"""
+        settings = {
+            "REDIS_MAX_CONNECTIONS": 7,
+            "REDIS_POOL_BLOCKING": True,
+            "REDIS_POOL_TIMEOUT": 1.5,
+            "REDIS_SOCKET_TIMEOUT": 3.0,
+            "REDIS_SOCKET_CONNECT_TIMEOUT": 0.5,
+        }
+        await AsyncCounter.connect(DATABASE_URI, settings)
+        pool = AsyncCounter.pool
+        self.assertIsInstance(pool, BlockingConnectionPool)
+        self.assertEqual(pool.max_connections, 7)
+        self.assertEqual(pool.timeout, 1.5)
+        self.assertEqual(pool.connection_kwargs["socket_timeout"], 3.0)
+        self.assertEqual(pool.connection_kwargs["socket_connect_timeout"], 0.5)
+        await AsyncCounter.connect(DATABASE_URI, {"REDIS_MAX_CONNECTIONS": 9})
+        self.assertNotIsInstance(AsyncCounter.pool, BlockingConnectionPool)
+        self.assertEqual(AsyncCounter.pool.max_connections, 9)
+
+    async def test_connection_errors(self):
+        """It should raise DatabaseConnectionError when Redis fails"""
+        counter = AsyncCounter("foo")
+        with patch.object(AsyncCounter.redis, "execute_command", side_effect=RedisConnectionError()):
+            with self.assertRaises(DatabaseConnectionError):
+                await AsyncCounter.find("foo")
+            with self.assertRaises(DatabaseConnectionError):
+                await AsyncCounter.create("foo")
+            with self.assertRaises(DatabaseConnectionError):
+                await AsyncCounter.page()
+            with self.assertRaises(DatabaseConnectionError):
+                await AsyncCounter.count()
+            with self.assertRaises(DatabaseConnectionError):
+                await AsyncCounter.remove_all()
+            with self.assertRaises(DatabaseConnectionError):
+                await AsyncCounter.increment_many([("foo", 1)])
+            with self.assertRaises(DatabaseConnectionError):
+                await AsyncCounter.delete("foo")
+            with self.assertRaises(DatabaseConnectionError):
+                await counter.increment()
+
+    async def test_no_connection(self):
+        """It should Handle a failed connection"""
+        with patch("redis.asyncio.Redis.ping", side_effect=RedisConnectionError()):
+            with patch("service.aio.models.RETRY_COUNT", 2), patch("service.aio.models.RETRY_DELAY", 0):
+                with self.assertRaises(DatabaseConnectionError):
+                    await AsyncCounter.connect(DATABASE_URI)
+        self.assertIsNone(AsyncCounter.redis)
+
+    async def test_connect_in_background(self):
+        """It should keep connecting in the background until Redis answers"""
+        await AsyncCounter.disconnect()
+        with patch("service.aio.models.RETRY_DELAY", 0.01):
+            with patch("redis.asyncio.Redis.ping", side_effect=RedisConnectionError()):
+                connector = AsyncCounter.connect_in_background(DATABASE_URI)
+                await asyncio.sleep(0.05)
+                self.assertFalse(connector.done())
+                self.assertIsNone(AsyncCounter.redis)
+                self.assertFalse(await AsyncCounter.ping())
+            await asyncio.wait_for(connector, 5)
+        self.assertTrue(await AsyncCounter.ping())
+        with self.assertRaises(DatabaseConnectionError):
+            AsyncCounter.connect_in_background(f"{DATABASE_URI},{DATABASE_URI}")
+
+    async def test_disconnect_stops_connecting(self):
+        """It should stop connecting in the background when disconnected"""
+        await AsyncCounter.disconnect()
+        with patch("redis.asyncio.Redis.ping", side_effect=RedisConnectionError()):
+            connector = AsyncCounter.connect_in_background(DATABASE_URI)
+            await asyncio.sleep(0.01)
+            await AsyncCounter.disconnect()
+        self.assertTrue(connector.cancelled())
+        self.assertIsNone(AsyncCounter.connector)
+        self.assertIsNone(AsyncCounter.redis)
+
+    async def test_missing_environment_creds(self):
+        """It should detect Missing environment credentials"""
+        with patch.dict(os.environ, {"DATABASE_URI": ""}):
+            with self.assertRaises(DatabaseConnectionError):
+                await AsyncCounter.connect()
+
+    ######################################################################
+    #  R O U T E   T E S T   C A S E S
+    ######################################################################
+
+    async def test_index_and_health(self):
+        """It should return the home page and health"""
+        resp = await self.client.get("/")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = await self.client.get("/health")
+        self.assertEqual((await resp.get_json())["status"], "OK")
+
+    async def test_counter_lifecycle(self):
+        """It should Create, Read, Update, List and Delete a counter"""
+        resp = await self.client.post("/counters/foo")
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertIn("/counters/foo", resp.headers["Location"])
+        resp = await self.client.post("/counters/foo")
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        resp = await self.client.put("/counters/foo")
+        self.assertEqual((await resp.get_json())["counter"], 1)
+        resp = await self.client.get("/counters/foo")
+        self.assertEqual((await resp.get_json())["counter"], 1)
+        resp = await self.client.get("/counters")
+        self.assertEqual(len(await resp.get_json()), 1)
+        resp = await self.client.delete("/counters/foo")
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        resp = await self.client.delete("/counters/foo")
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        resp = await self.client.get("/counters/foo")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = await self.client.put("/counters/foo")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = await self.client.post("/counters/foo:uniques")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    async def test_list_counters_paginated(self):
+        """It should Get the counters one page at a time"""
+        for i in range(8):
+            await self.client.post(f"/counters/foo{i}")
+        names = []
+        cursor = ""
+        while True:
+            resp = await self.client.get(f"/counters?cursor={cursor}&limit=3")
+            self.assertEqual(resp.headers["X-Total-Count"], "8")
+            names.extend(counter["name"] for counter in await resp.get_json())
+            if "X-Next-Cursor" not in resp.headers:
+                break
+            cursor = resp.headers["X-Next-Cursor"]
+            self.assertIn('rel="next"', resp.headers["Link"])
+        self.assertEqual(names, sorted(f"foo{i}" for i in range(8)))
+        resp = await self.client.get("/counters?limit=abc")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = await self.client.get("/counters?limit=0")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    async def test_batch_update_counters(self):
+        """It should Increment many counters in one request"""
+        await self.client.post("/counters/foo")
+        resp = await self.client.post("/counters/batch", json=[{"name": "foo", "delta": 4}])
+        self.assertEqual(await resp.get_json(), [{"name": "foo", "counter": 4}])
+        resp = await self.client.post("/counters/batch", json=[{"name": "bar"}])
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = await self.client.post("/counters/batch", json=[])
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    async def test_method_not_allowed(self):
+        """It should not allow unsupported Methods"""
+        resp = await self.client.post("/counters")
+        self.assertEqual(resp.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+
+    async def test_not_connected_yet(self):
+        """It should answer 503 and not be ready until Redis is connected"""
+        await AsyncCounter.disconnect()
+        with patch.dict("service.aio.routes.readiness", checked=None):
+            resp = await self.client.get("/ready")
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        resp = await self.client.get("/counters")
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        resp = await self.client.get("/health")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    async def test_ready_and_stats(self):
+        """It should report readiness and the circuit breaker"""
+        with patch.dict("service.aio.routes.readiness", checked=None):
+            resp = await self.client.get("/ready")
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            with patch.object(AsyncCounter.redis, "ping", side_effect=RedisConnectionError()):
+                resp = await self.client.get("/ready")
+                self.assertEqual(resp.status_code, status.HTTP_200_OK)
+                with patch.dict(app.config, READY_CHECK_INTERVAL=0):
+                    resp = await self.client.get("/ready")
+            self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        resp = await self.client.get("/stats")
+        self.assertEqual((await resp.get_json())["breaker"]["state"], "closed")
+
+    async def test_circuit_open(self):
+        """It should fail fast with Retry-After while the circuit is open"""
+        breaker = AsyncCounter.breaker
+        breaker.failures = 1
+        try:
+            with patch.object(AsyncCounter.pool, "get_connection", side_effect=RedisConnectionError()):
+                resp = await self.client.get("/counters/foo")
+            self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            self.assertNotIn("Retry-After", resp.headers)
+            resp = await self.client.get("/counters/foo")
+            self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            self.assertEqual(resp.headers["Retry-After"], "5")
+            with patch.object(AsyncCounter.pool, "get_connection", side_effect=RedisConnectionError()):
+                self.assertFalse(await AsyncCounter.ping())
+        finally:
+            breaker.reset()
+
+    async def test_database_errors(self):
+        """It should return 503 when Redis fails"""
+        with patch.object(AsyncCounter.redis, "execute_command", side_effect=RedisConnectionError()):
+            resp = await self.client.get("/counters/foo")
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+
+    async def test_internal_server_error(self):
+        """It should return 500 for unexpected errors"""
+        with patch.object(AsyncCounter, "find", side_effect=ValueError("boom")):
+            resp = await self.client.get("/counters/foo")
+        self.assertEqual(resp.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    async def test_serving_lifecycle(self):
+        """It should connect before serving and disconnect after"""
+        await AsyncCounter.disconnect()
+        async with app.test_app():
+            await asyncio.wait_for(AsyncCounter.connector, 5)
+            self.assertIsNotNone(AsyncCounter.redis)
+        self.assertIsNone(AsyncCounter.redis)
+        self.assertIsNone(AsyncCounter.connector)
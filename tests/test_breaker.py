@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the Circuit Breaker
+"""
+import os
+import logging
+from unittest import TestCase
+from unittest.mock import patch
+from redis.exceptions import ConnectionError as RedisConnectionError, ResponseError
+from service.common.breaker import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    CircuitBreaker,
+    CircuitOpenError,
+    GuardedRedis,
+    bulk_calls,
+    create_breaker,
+)
+from service.common.metrics import BREAKER_STATE, BREAKER_TRIPS
+from service.common.pool import create_pool
+
+DATABASE_URI = os.getenv("DATABASE_URI", "redis://:@localhost:6379/0")
+
+logging.disable(logging.CRITICAL)
+
+
+def fail(breaker: CircuitBreaker, error: Exception = RedisConnectionError()) -> None:
+    """Makes one call through the breaker that raises error"""
+    try:
+        with breaker.guard():
+            raise error
+    except (RedisConnectionError, ResponseError):
+        pass
+
+
+def succeed(breaker: CircuitBreaker) -> None:
+    """Makes one call through the breaker that succeeds"""
+    with breaker.guard():
+        pass
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class CircuitBreakerTests(TestCase):
+    """Circuit Breaker Tests"""
+
+    def test_opens_after_failures(self):
+        """It should Open after consecutive failures and fail fast"""
+        breaker = CircuitBreaker(failures=3, reset_timeout=10)
+        fail(breaker)
+        fail(breaker)
+        succeed(breaker)
+        fail(breaker)
+        fail(breaker)
+        self.assertEqual(breaker.state, CLOSED)
+        fail(breaker)
+        self.assertEqual(breaker.state, OPEN)
+        with self.assertRaises(CircuitOpenError) as context:
+            succeed(breaker)
+        self.assertGreater(context.exception.retry_after, 9)
+        self.assertEqual(breaker.stats()["trips"], 1)
+        self.assertGreater(breaker.retry_after(), 9)
+
+    def test_ignores_redis_replies(self):
+        """It should not count error replies from a healthy Redis as failures"""
+        breaker = CircuitBreaker(failures=1)
+        fail(breaker, ResponseError("WRONGTYPE"))
+        self.assertEqual(breaker.state, CLOSED)
+
+    def test_slow_calls(self):
+        """It should count slow calls as failures"""
+        breaker = CircuitBreaker(failures=2, slow_call=1.0)
+        with patch("service.common.breaker.time.monotonic", side_effect=[0, 2, 10, 12, 12]):
+            succeed(breaker)
+            succeed(breaker)
+        self.assertEqual(breaker.state, OPEN)
+
+    def test_bulk_calls(self):
+        """It should not count slow calls made by bulk operations"""
+        breaker = CircuitBreaker(failures=1, slow_call=1.0)
+        with patch("service.common.breaker.time.monotonic", side_effect=[0, 2, 10, 12, 12]):
+            with bulk_calls():
+                succeed(breaker)
+            self.assertEqual(breaker.state, CLOSED)
+            succeed(breaker)
+        self.assertEqual(breaker.state, OPEN)
+        breaker.reset()
+        # failures still count
+        with bulk_calls():
+            fail(breaker)
+        self.assertEqual(breaker.state, OPEN)
+
+    def test_metrics_by_server(self):
+        """It should label the state and trips of each breaker with its server"""
+        breaker = CircuitBreaker(failures=1, name="redis-1:6379/0")
+        other = CircuitBreaker(failures=1, name="redis-2:6379/0")
+        trips = BREAKER_TRIPS.labels(server="redis-1:6379/0")._value.get()
+        fail(breaker)
+        self.assertEqual(BREAKER_STATE.labels(server="redis-1:6379/0")._value.get(), 2)
+        self.assertEqual(BREAKER_STATE.labels(server="redis-2:6379/0")._value.get(), 0)
+        self.assertEqual(BREAKER_TRIPS.labels(server="redis-1:6379/0")._value.get(), trips + 1)
+        other.reset()
+
+    def test_half_open(self):
+        """It should let one trial call through once the reset timeout passes"""
+        breaker = CircuitBreaker(failures=1, reset_timeout=5)
+        with patch("service.common.breaker.time.monotonic", return_value=100):
+            fail(breaker)
+        with patch("service.common.breaker.time.monotonic", return_value=106):
+            with breaker.guard():
+                self.assertEqual(breaker.state, HALF_OPEN)
+                # a second call while the trial is running still fails fast
+                self.assertRaises(CircuitOpenError, succeed, breaker)
+            self.assertEqual(breaker.state, CLOSED)
+            fail(breaker)
+        with patch("service.common.breaker.time.monotonic", return_value=112):
+            fail(breaker)
+        self.assertEqual(breaker.state, OPEN)
+        self.assertEqual(breaker.stats()["trips"], 3)
+        breaker.reset()
+        self.assertEqual(breaker.stats(), {"state": CLOSED, "consecutive_failures": 0, "trips": 3, "retry_after": 0.0})
+
+    def test_create_breaker(self):
+        """It should Create a breaker from the configuration settings"""
+        breaker = create_breaker({"BREAKER_FAILURES": 2, "BREAKER_SLOW_CALL": 0.5}, "redis-1:6379/0")
+        self.assertEqual(breaker.name, "redis-1:6379/0")
+        self.assertEqual(breaker.failures, 2)
+        self.assertEqual(breaker.slow_call, 0.5)
+        self.assertEqual(breaker.reset_timeout, 5.0)
+
+    def test_guarded_redis(self):
+        """It should Guard commands and pipelines with the breaker"""
+        redis = GuardedRedis(connection_pool=create_pool(DATABASE_URI, {}))
+        self.assertTrue(redis.ping())
+        pipeline = redis.pipeline()
+        pipeline.ping()
+        self.assertEqual(pipeline.execute(), [True])
+        redis.breaker.failures = 1
+        fail(redis.breaker)
+        self.assertRaises(CircuitOpenError, redis.ping)
+        self.assertRaises(CircuitOpenError, redis.pipeline().ping().execute)
+        redis.connection_pool.disconnect()
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the Cached Health Checks
+"""
+from unittest import TestCase
+from unittest.mock import Mock, patch
+from service.common.health import CachedCheck
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class CachedCheckTests(TestCase):
+    """Cached Health Check Tests"""
+
+    def test_cached(self):
+        """It should Run the check at most once per interval"""
+        check = Mock(return_value=True)
+        cached = CachedCheck(check, interval=60)
+        self.assertEqual(cached.status()[0], True)
+        self.assertEqual(cached.status()[0], True)
+        self.assertEqual(check.call_count, 1)
+        check.return_value = False
+        cached.reset()
+        self.assertEqual(cached.status()[0], False)
+        self.assertEqual(check.call_count, 2)
+
+    def test_refresh(self):
+        """It should Run the check again once the result is too old"""
+        check = Mock(return_value=True)
+        cached = CachedCheck(check, interval=5)
+        with patch("service.common.health.time.monotonic", side_effect=[100, 100, 103, 103, 106, 106, 106]):
+            cached.status()
+            self.assertEqual(cached.status(), (True, 3))
+            cached.status()
+        self.assertEqual(check.call_count, 2)
+
+    def test_refresh_in_progress(self):
+        """It should return the last result while another caller refreshes"""
+        check = Mock(return_value=True)
+        cached = CachedCheck(check, interval=0)
+        cached.status()
+        with cached._lock:
+            self.assertEqual(cached.status()[0], True)
+        self.assertEqual(check.call_count, 1)
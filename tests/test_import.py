@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable=disallowed-name
+"""
+Test cases for importing Counters
+
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color
+  coverage report -m
+"""
+import os
+import logging
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+from redis.exceptions import ConnectionError as RedisConnectionError
+from service.models import (
+    Counter,
+    CounterOverflowError,
+    DatabaseConnectionError,
+    DataValidationError,
+)
+
+DATABASE_URI = os.getenv("DATABASE_URI", "redis://:@localhost:6379/0")
+
+logging.disable(logging.CRITICAL)
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class ImportTests(TestCase):
+    """Counter Import Tests"""
+
+    def setUp(self):
+        """This runs before each test"""
+        Counter.connect(DATABASE_URI)
+        Counter.remove_all()
+        Counter().save()
+
+    def test_import_merge(self):
+        """It should Import counters in chunks adding to existing counters"""
+        Counter.create("foo")
+        Counter.increment_existing("foo", 5)
+        lines = [
+            b'{"name": "foo", "counter": 2}\n',
+            b"\n",
+            b'{"name": "bar", "counter": 3}\n',
+            b'{"name": "foo", "counter": 1}',
+        ]
+        with patch.object(Counter, "_import_chunk", wraps=Counter._import_chunk) as import_chunk:
+            self.assertEqual(Counter.import_counters(lines, chunk_size=2), 3)
+        self.assertEqual(import_chunk.call_count, 2)
+        self.assertEqual([counter["counter"] for counter in Counter.all()], [3, 8, 0])
+        self.assertEqual(Counter.top(1), [{"name": "foo", "counter": 8}])
+
+    def test_import_overwrite(self):
+        """It should Import counters replacing existing ones and emptying their shards"""
+        Counter.create("foo")
+        Counter.reshard("foo", 2)
+        Counter.increment_existing("foo", 5)
+        version = Counter.version()
+        lines = [b'{"name": "foo", "counter": 2}', b'{"name": "bar", "counter": 3}', b'{"name": "bar", "counter": 4}']
+        self.assertEqual(Counter.import_counters(lines, overwrite=True), 3)
+        self.assertNotEqual(Counter.version(), version)
+        self.assertEqual(Counter.read("foo"), 2)
+        self.assertEqual(Counter.shards("foo"), 2)
+        self.assertEqual([counter["name"] for counter in Counter.top(3)], ["bar", "foo", "hits"])
+        self.assertEqual(Counter.read("bar"), 4)
+
+    def test_import_bad_lines(self):
+        """It should stop an import at a bad line keeping the chunks before it"""
+        bad = [b"{", b"[1]", b'{"counter": 1}', b'{"name": "x", "counter": true}', b'{"name": "x", "counter": 2e3}']
+        bad.append(b'{"name": "x", "counter": 9223372036854775808}')
+        bad.append(b'{"name": "x:shard:0", "counter": 1}')
+        for line in bad:
+            lines = [b'{"name": "foo", "counter": 1}', line]
+            with self.assertRaises(DataValidationError) as context:
+                Counter.import_counters(lines, chunk_size=1)
+            self.assertIn("Line 2", str(context.exception))
+            self.assertIn("1 counters were imported", str(context.exception))
+        self.assertEqual(Counter.read("foo"), len(bad))
+        self.assertIsNone(Counter.read("x"))
+        with patch.dict(Counter.scripts, {"import_merge": MagicMock(side_effect=RedisConnectionError())}):
+            self.assertRaises(DatabaseConnectionError, Counter.import_counters, [b'{"name": "foo", "counter": 1}'])
+        with patch.object(Counter.redis, "pipeline", side_effect=RedisConnectionError()):
+            self.assertRaises(
+                DatabaseConnectionError, Counter.import_counters, [b'{"name": "foo", "counter": 1}'], overwrite=True
+            )
+
+    def test_import_merge_overflow(self):
+        """It should reject a whole chunk when merging it would overflow a counter"""
+        Counter("foo", 2**63 - 2).save()
+        lines = [f'{{"name": "{name}", "counter": 1}}'.encode() for name in ("baz", "qux", "quux", "bar", "foo", "foo")]
+        with self.assertRaises(CounterOverflowError) as context:
+            Counter.import_counters(lines, chunk_size=3)
+        self.assertIn("3 counters were imported", str(context.exception))
+        self.assertEqual(Counter.read("baz"), 1)
+        self.assertEqual(Counter.read("foo"), 2**63 - 2)
+        self.assertIsNone(Counter.read("bar"))
+        self.assertIsNone(Counter.rank("bar"))
+        self.assertEqual(Counter.top(1), [{"name": "foo", "counter": 2**63 - 2}])
+
+
+# three databases of the test server stand in for three Redis servers
+SERVERS = [DATABASE_URI.rsplit("/", 1)[0] + f"/{db}" for db in (1, 2, 3)]
+NAMES = [f"counter-{i:02d}" for i in range(30)]
+
+
+class ShardedImportTests(TestCase):
+    """Tests of importing Counters spread over several Redis servers"""
+
+    def setUp(self):
+        """This runs before each test"""
+        Counter.connect(",".join(SERVERS))
+        Counter.remove_all()
+
+    def tearDown(self):
+        """This runs after each test"""
+        Counter.connect(DATABASE_URI)
+
+    def test_import(self):
+        """It should Import counters onto the servers that hold them"""
+        lines = [f'{{"name": "{name}", "counter": 2}}'.encode() for name in NAMES]
+        self.assertEqual(Counter.import_counters(lines, chunk_size=8), len(NAMES))
+        self.assertEqual(Counter.import_counters(lines[:1], overwrite=True), 1)
+        self.assertEqual([counter["counter"] for counter in Counter.all()], [2] * len(NAMES))
+
+    def test_import_merge_overflow(self):
+        """It should reject a chunk spread over several servers before writing any of it"""
+        Counter("counter-01", 2**63 - 1).save()
+        lines = [f'{{"name": "{name}", "counter": 1}}'.encode() for name in NAMES]
+        self.assertRaises(CounterOverflowError, Counter.import_counters, lines)
+        self.assertEqual(Counter.read("counter-01"), 2**63 - 1)
+        self.assertEqual(Counter.all(), [{"name": "counter-01", "counter": 2**63 - 1}])
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the Prometheus Metrics
+"""
+import os
+import logging
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+from prometheus_client import REGISTRY
+from wsgi import app
+from service.common import metrics, status
+from service.models import Counter, DatabaseConnectionError
+
+DATABASE_URI = os.getenv("DATABASE_URI", "redis://:@localhost:6379/0")
+
+logging.disable(logging.CRITICAL)
+
+
+def sample(name: str, **labels) -> float:
+    """Returns the current value of a sample or 0"""
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class MetricsTests(TestCase):
+    """Prometheus Metrics Tests"""
+
+    def setUp(self):
+        self.app = app.test_client()
+        Counter.connect(DATABASE_URI)
+        Counter.remove_all()
+
+    def test_request_metrics(self):
+        """It should Count and time requests by route and status"""
+        labels = {"method": "GET", "route": "/counters/<name>"}
+        found = sample("http_requests_total", status="200", **labels)
+        missing = sample("http_requests_total", status="404", **labels)
+        timed = sample("http_request_duration_seconds_count", **labels)
+        Counter("foo", 1).save()
+        self.app.get("/counters/foo")
+        self.app.get("/counters/bar")
+        self.assertEqual(sample("http_requests_total", status="200", **labels), found + 1)
+        self.assertEqual(sample("http_requests_total", status="404", **labels), missing + 1)
+        self.assertEqual(sample("http_request_duration_seconds_count", **labels), timed + 2)
+        self.assertEqual(sample("http_requests_in_flight"), 0)
+
+    def test_unmatched_route(self):
+        """It should label requests for unknown URLs as unmatched"""
+        before = sample("http_requests_total", method="GET", route="unmatched", status="404")
+        self.app.get("/no/such/page")
+        self.assertEqual(sample("http_requests_total", method="GET", route="unmatched", status="404"), before + 1)
+
+    def test_error_metrics(self):
+        """It should Count errors by exception type"""
+        before = sample("errors_total", type="DatabaseConnectionError")
+        with patch.object(Counter, "read", side_effect=DatabaseConnectionError()):
+            resp = self.app.get("/counters/foo")
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(sample("errors_total", type="DatabaseConnectionError"), before + 1)
+
+    def test_rejected_before_the_view(self):
+        """It should Count requests answered by the routes' own hooks"""
+        labels = {"method": "GET", "route": "/counters/<name>"}
+        unavailable = sample("http_requests_total", status="503", **labels)
+        bad = sample("http_requests_total", status="400", **labels)
+        redis, Counter.redis = Counter.redis, None
+        try:
+            resp = self.app.get("/counters/foo")
+        finally:
+            Counter.redis = redis
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        resp = self.app.get("/counters/foo:shard:0")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(sample("http_requests_total", status="503", **labels), unavailable + 1)
+        self.assertEqual(sample("http_requests_total", status="400", **labels), bad + 1)
+        self.assertEqual(sample("http_requests_in_flight"), 0)
+
+    def test_redis_metrics(self):
+        """It should Count and time Redis commands and pipelines"""
+        gets = sample("redis_commands_total", command="GET")
+        pipelines = sample("redis_round_trip_seconds_count", command="PIPELINE")
+        Counter.redis.get("foo")
+        pipeline = Counter.redis.pipeline()
+        pipeline.get("foo")
+        pipeline.get("bar")
+        pipeline.execute()
+        self.assertEqual(sample("redis_commands_total", command="GET"), gets + 3)
+        self.assertEqual(sample("redis_round_trip_seconds_count", command="PIPELINE"), pipelines + 1)
+
+    def test_metrics_endpoint(self):
+        """It should Expose the metrics in the Prometheus text format"""
+        self.app.get("/health")
+        resp = self.app.get("/metrics")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertIn("text/plain", resp.headers["Content-Type"])
+        body = resp.get_data(as_text=True)
+        for name in ("http_requests_total", "http_request_duration_seconds", "http_requests_in_flight",
+                     "redis_commands_total", "redis_round_trip_seconds"):
+            self.assertIn(name, body)
+
+    def test_multiprocess(self):
+        """It should Add up the metrics of every worker from the shared directory"""
+        with tempfile.TemporaryDirectory() as directory:
+            with patch.dict(os.environ, {metrics.MULTIPROCESS_DIR_ENV: directory}):
+                body, _ = metrics.render()
+                metrics.mark_process_dead(12345)
+        self.assertEqual(body, b"")
@@ -13,7 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-# pylint: disable=disallowed-name
+# pylint: disable=disallowed-name, too-many-public-methods
 """
 Test cases for Counter Model
 
@@ -22,11 +22,33 @@ Test cases can be run with the following:
   coverage report -m
 """
 import os
+import time
 import logging
 from unittest import TestCase
-from unittest.mock import patch
+from unittest.mock import MagicMock, Mock, patch
 from redis.exceptions import ConnectionError as RedisConnectionError
-from service.models import Counter, DatabaseConnectionError
+from service.common.ring import node_name
+from service.models import (
+    INDEX_KEY,
+    KEY_PREFIX,
+    LEADERBOARD_KEY,
+    PURGE_KEY,
+    PURGE_LOCK_KEY,
+    SERVICE_KEYS,
+    SHARD_SEPARATOR,
+    SHARDS_KEY,
+    Counter,
+    CounterNotFoundError,
+    CounterOverflowError,
+    DatabaseConnectionError,
+    DataValidationError,
+    counter_key,
+    parse_deltas,
+    parse_members,
+    parse_window,
+    shard_key,
+    uniques_key,
+)
 
 DATABASE_URI = os.getenv("DATABASE_URI", "redis://:@localhost:6379/0")
 
@@ -48,7 +70,8 @@ class CounterTests(TestCase):
         """This runs before each test"""
         Counter.connect(DATABASE_URI)
         Counter.remove_all()
-        self.counter = Counter()
+        Counter.redis.delete("unrelated", PURGE_KEY, PURGE_LOCK_KEY)
+        self.counter = Counter().save()
 
     def tearDown(self):
         """This runs after each test"""
@@ -64,6 +87,59 @@ class CounterTests(TestCase):
         self.assertIsNotNone(counter)
         self.assertEqual(counter.name, "foo")
         self.assertEqual(counter.value, 0)
+        self.assertEqual(repr(counter), "<Counter 'foo' value=0>")
+
+    def test_snapshot(self):
+        """It should only go to Redis when a counter is saved, refreshed or incremented"""
+        counter = Counter("foo", 5)
+        self.assertIsNone(Counter.find("foo"))
+        self.assertRaises(AttributeError, setattr, counter, "other", 1)
+        self.assertIs(counter.save(), counter)
+        Counter.increment_existing("foo", 2)
+        self.assertEqual(counter.value, 5)
+        self.assertEqual(counter.serialize(), {"name": "foo", "counter": 5})
+        self.assertEqual(counter.refresh().value, 7)
+        Counter.reshard("foo", 2)
+        Counter.increment_existing("foo")
+        self.assertEqual(Counter.find("foo").value, 8)
+        Counter.delete("foo")
+        self.assertRaises(CounterNotFoundError, counter.refresh)
+        self.assertEqual(counter.value, 8 - 1)
+
+    def test_snapshot_sharded(self):
+        """It should Increment and Save a sharded counter through its snapshot"""
+        counter = Counter("foo", 10).save()
+        Counter.reshard("foo", 2)
+        self.assertEqual(counter.increment(), 11)
+        self.assertEqual(Counter.find("foo").value, 11)
+        Counter.increment_existing("foo", 10)
+        # the saved value replaces the shards, which are deleted
+        counter.save()
+        self.assertEqual(Counter.read("foo"), 11)
+        self.assertEqual(Counter.shards("foo"), 0)
+        self.assertIsNone(Counter.redis.hget(SHARDS_KEY, "foo"))
+        self.assertEqual(Counter.redis.keys(shard_key("foo", "*")), [])
+        Counter.delete("foo")
+        self.assertRaises(CounterNotFoundError, counter.increment)
+        self.assertIsNone(Counter.redis.get(counter_key("foo")))
+
+    def test_snapshot_connection_errors(self):
+        """It should raise DatabaseConnectionError when a snapshot cannot reach Redis"""
+        with patch.object(Counter.redis, "pipeline", side_effect=RedisConnectionError()):
+            self.assertRaises(DatabaseConnectionError, self.counter.save)
+            self.assertRaises(DatabaseConnectionError, self.counter.increment)
+        with patch.object(Counter.redis, "get", side_effect=RedisConnectionError()):
+            self.assertRaises(DatabaseConnectionError, self.counter.refresh)
+            self.assertRaises(DatabaseConnectionError, Counter.find, "hits")
+
+    def test_create_counter_separator(self):
+        """It should not Create a counter whose name could reach another counter's keys"""
+        Counter.reshard("hits", 2)
+        for name in ("hits:shard:0", "hits:uniques", "", "top", "import"):
+            self.assertRaises(DataValidationError, Counter.create, name)
+            self.assertRaises(DataValidationError, Counter(name).save)
+        self.assertRaises(DataValidationError, parse_deltas, [{"name": "hits:shard:1"}], 10)
+        self.assertEqual(Counter.count(), 1)
 
     def test_create_counter_no_name(self):
         """It should not Create a counter without a name"""
@@ -80,15 +156,163 @@ class CounterTests(TestCase):
 
     def test_set_list_counters(self):
         """It should List all of the counters"""
-        _ = Counter("foo")
-        _ = Counter("bar")
+        Counter("foo").save()
+        Counter("bar").save()
         counters = Counter.all()
         self.assertEqual(len(counters), 3)
 
+    def test_page_counters(self):
+        """It should List the counters one page at a time"""
+        for i in range(25):
+            Counter(f"foo{i}").save()
+        names = set()
+        cursor = ""
+        while True:
+            counters, cursor = Counter.page(cursor, 10)
+            names.update(counter["name"] for counter in counters)
+            if not cursor:
+                break
+        self.assertEqual(len(names), 26)
+        self.assertIn("foo24", names)
+
+    def test_index_ignores_other_keys(self):
+        """It should List and count only the counters in the index"""
+        Counter.redis.set("unrelated", 1)
+        Counter.redis.set(f"{KEY_PREFIX}unindexed", 2)
+        Counter.create("foo")
+        self.assertEqual(Counter.count(), 2)
+        self.assertEqual(Counter.all(), [{"name": "foo", "counter": 0}, {"name": "hits", "counter": 0}])
+        Counter.delete("foo")
+        self.assertEqual(Counter.count(), 1)
+
+    def test_remove_all(self):
+        """It should Remove every counter and nothing else"""
+        Counter.redis.set("unrelated", 1)
+        Counter.create("foo")
+        Counter.reshard("foo", 2)
+        Counter.increment_existing("foo")
+        Counter.add_uniques("foo", ["a"])
+        version = Counter.version()
+        Counter.remove_all()
+        self.assertEqual(Counter.redis.keys(f"{KEY_PREFIX}*"), [])
+        self.assertEqual(Counter.redis.exists(*SERVICE_KEYS), 0)
+        self.assertEqual(Counter.redis.get("unrelated"), "1")
+        self.assertEqual(Counter.count(), 0)
+        self.assertEqual(Counter.shards("foo"), 0)
+        self.assertIsNone(Counter.redis.hget(SHARDS_KEY, "foo"))
+        self.assertNotEqual(Counter.version(), version)
+
+    def test_purge(self):
+        """It should Purge the counters a batch at a time and record the progress"""
+        self.assertEqual(Counter.purge_progress(), {"state": "idle"})
+        for i in range(24):
+            Counter.create(f"foo{i}")
+        Counter.redis.set("unrelated", 1)
+        keys = 25 + Counter.redis.exists(*SERVICE_KEYS)
+        with patch("service.models.time.sleep") as sleep:
+            self.assertEqual(Counter.purge(batch_size=10, pause=0.5), keys)
+        # every full batch is followed by a pause
+        self.assertEqual(sleep.call_count, 2)
+        sleep.assert_called_with(0.5)
+        progress = Counter.purge_progress()
+        self.assertEqual({key: progress[key] for key in ("state", "deleted", "done", "servers")},
+                         {"state": "done", "deleted": keys, "done": 1, "servers": 1})
+        self.assertLessEqual(progress["started"], progress["finished"])
+        self.assertEqual(Counter.redis.keys(f"{KEY_PREFIX}*"), [])
+        self.assertEqual(Counter.redis.get("unrelated"), "1")
+        self.assertEqual(Counter.all(), [])
+
+    def test_purge_dedicated(self):
+        """It should Empty a dedicated database with FLUSHDB ASYNC"""
+        Counter.redis.set("unrelated", 1)
+        # the lock and the progress are emptied too, and then written again
+        keys = Counter.redis.dbsize() + 2
+        self.assertEqual(Counter.purge(dedicated=True), keys)
+        self.assertEqual(Counter.purge_progress()["state"], "done")
+        self.assertEqual(Counter.redis.keys(), [PURGE_KEY])
+
+    def test_purge_running(self):
+        """It should run only one purge at a time"""
+        Counter.redis.set(PURGE_LOCK_KEY, "other", ex=30)
+        self.assertIsNone(Counter.purge())
+        self.assertFalse(Counter.purge_in_background())
+        self.assertIsNotNone(Counter.find("hits"))
+
+    def test_purge_in_background(self):
+        """It should Purge on a background thread"""
+        self.assertTrue(Counter.purge_in_background(batch_size=10))
+        deadline = time.monotonic() + 5
+        while Counter.purge_progress()["state"] == "running" and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(Counter.purge_progress()["state"], "done")
+        self.assertIsNone(Counter.find("hits"))
+        self.assertIsNone(Counter.redis.get(PURGE_LOCK_KEY))
+
+    def test_purge_errors(self):
+        """It should record a purge that failed and let the next one start"""
+        with patch.object(Counter.redis, "unlink", side_effect=RedisConnectionError("gone")):
+            self.assertRaises(DatabaseConnectionError, Counter.purge)
+        progress = Counter.purge_progress()
+        self.assertEqual((progress["state"], progress["error"]), ("failed", "gone"))
+        self.assertIsNone(Counter.redis.get(PURGE_LOCK_KEY))
+        with patch.object(Counter.redis, "set", side_effect=RedisConnectionError()):
+            self.assertRaises(DatabaseConnectionError, Counter.purge)
+        with patch.object(Counter.redis, "hgetall", side_effect=RedisConnectionError()):
+            self.assertRaises(DatabaseConnectionError, Counter.purge_progress)
+        with patch.object(Counter.redis, "scan_iter", side_effect=RedisConnectionError()):
+            self.assertRaises(DatabaseConnectionError, Counter.remove_all)
+        # a failure to record the end is logged, the purge itself is done
+        with patch.object(Counter.redis, "get", side_effect=RedisConnectionError()):
+            self.assertIsNotNone(Counter.purge())
+        self.assertIsNone(Counter.find("hits"))
+        Counter.redis.delete(PURGE_LOCK_KEY)
+
+    def test_reindex(self):
+        """It should Rebuild the index from the keys under the prefix"""
+        Counter.reshard("hits", 2)
+        Counter.redis.set("unrelated", 1)
+        Counter.redis.set(f"{KEY_PREFIX}unindexed", 2)
+        Counter.redis.delete(INDEX_KEY)
+        self.assertEqual(Counter.count(), 0)
+        self.assertEqual(Counter.reindex(), 2)
+        self.assertEqual(Counter.all(), [{"name": "hits", "counter": 0}, {"name": "unindexed", "counter": 2}])
+        self.assertEqual(Counter.top(1), [{"name": "unindexed", "counter": 2}])
+
+    def test_migrate_keys(self):
+        """It should Move counters kept under bare names without overwriting any"""
+        Counter.redis.flushdb()
+        Counter("hits", 1).save()
+        Counter.redis.mset({"old": 5, "hits": 3, "text": "abc", "top": 4, "a:b": 6})
+        Counter.redis.sadd("members", "x")
+        self.assertEqual(Counter.migrate_keys(), {"migrated": 1, "skipped": ["hits"]})
+        self.assertEqual(Counter.all(), [{"name": "hits", "counter": 1}, {"name": "old", "counter": 5}])
+        self.assertEqual(Counter.rank("old")["rank"], 1)
+        self.assertEqual(Counter.redis.mget("old", "hits", "text", "top", "a:b"), [None, "3", "abc", "4", "6"])
+        self.assertEqual(Counter.migrate_keys(), {"migrated": 0, "skipped": ["hits"]})
+        Counter.redis.delete("hits", "text", "top", "a:b", "members")
+        with patch.object(Counter.redis, "scan_iter", side_effect=RedisConnectionError()):
+            self.assertRaises(DatabaseConnectionError, Counter.migrate_keys)
+
+    def test_fetch_skips_deleted_keys(self):
+        """It should skip counters that vanish between reading the index and MGET"""
+        Counter("foo").save()
+        counters = Counter._fetch(["foo", "gone"])
+        self.assertEqual(counters, [{"name": "foo", "counter": 0}])
+        self.assertEqual(Counter._fetch([]), [])
+
+    def test_page_connection_error(self):
+        """It should raise DatabaseConnectionError when reading the index fails"""
+        with patch.object(Counter.redis, "zrangebylex", side_effect=RedisConnectionError()):
+            self.assertRaises(DatabaseConnectionError, Counter.page)
+        with patch.object(Counter.redis, "zcard", side_effect=RedisConnectionError()):
+            self.assertRaises(DatabaseConnectionError, Counter.count)
+        with patch.object(Counter.redis, "scan_iter", side_effect=RedisConnectionError()):
+            self.assertRaises(DatabaseConnectionError, Counter.reindex)
+
     def test_set_find_counter(self):
         """It should Find a counter"""
-        _ = Counter("foo")
-        _ = Counter("bar")
+        Counter("foo").save()
+        Counter("bar").save()
         foo = Counter.find("foo")
         self.assertEqual(foo.name, "foo")
 
@@ -100,13 +324,15 @@ class CounterTests(TestCase):
     def test_set_get_counter(self):
         """It should Set and then Get the counter"""
         self.counter.value = 13
+        self.counter.save()
         self.assertEqual(self.counter.value, 13)
+        self.assertEqual(Counter.find("hits").value, 13)
 
     def test_delete_counter(self):
         """It should Delete a counter"""
-        counter = Counter("foo")
+        counter = Counter("foo").save()
         self.assertEqual(counter.value, 0)
-        del counter.value
+        Counter.delete(counter.name)
         found = Counter.find("foo")
         self.assertIsNone(found)
 
@@ -134,13 +360,602 @@ class CounterTests(TestCase):
         counter.increment()
         self.assertEqual(counter.value, 2)
 
+    def test_create_only_once(self):
+        """It should Create a counter only if it does not exist"""
+        self.assertTrue(Counter.create("foo"))
+        self.assertFalse(Counter.create("foo"))
+        self.assertFalse(Counter.create("hits"))
+        self.assertEqual(Counter.find("foo").value, 0)
+
+    def test_increment_existing(self):
+        """It should Increment a counter only if it exists"""
+        self.assertEqual(Counter.increment_existing("hits"), 1)
+        self.assertEqual(Counter.increment_existing("hits", 5), 6)
+        self.assertIsNone(Counter.increment_existing("foo"))
+        self.assertIsNone(Counter.find("foo"))
+
+    def test_delete_by_name(self):
+        """It should Delete a counter by name"""
+        self.assertTrue(Counter.delete("hits"))
+        self.assertFalse(Counter.delete("hits"))
+        self.assertIsNone(Counter.find("hits"))
+
+    def test_single_round_trip_connection_errors(self):
+        """It should raise DatabaseConnectionError when a single round trip fails"""
+        with patch.dict(Counter.scripts, {"create": Mock(side_effect=RedisConnectionError())}):
+            self.assertRaises(DatabaseConnectionError, Counter.create, "foo")
+        with patch.dict(Counter.scripts, {"delete": Mock(side_effect=RedisConnectionError())}):
+            self.assertRaises(DatabaseConnectionError, Counter.delete, "hits")
+        with patch.dict(Counter.scripts, {"increment_existing": Mock(side_effect=RedisConnectionError())}):
+            self.assertRaises(DatabaseConnectionError, Counter.increment_existing, "hits")
+
+    def test_increment_many(self):
+        """It should Increment many counters at once"""
+        Counter("foo").save()
+        values = Counter.increment_many([("hits", 1), ("foo", 5), ("hits", 2)])
+        self.assertEqual(values, [1, 5, 3])
+        self.assertEqual(self.counter.refresh().value, 3)
+        self.assertEqual(Counter.find("foo").value, 5)
+
+    def test_increment_many_not_found(self):
+        """It should not Increment any counter when one is missing"""
+        with self.assertRaises(CounterNotFoundError) as context:
+            Counter.increment_many([("hits", 1), ("foo", 1), ("bar", 1)])
+        self.assertEqual(context.exception.names, ["foo", "bar"])
+        self.assertEqual(self.counter.refresh().value, 0)
+
+    def test_increment_overflow(self):
+        """It should not Increment anything past a signed 64 bit integer"""
+        Counter("foo", 2**62).save()
+        with self.assertRaises(CounterOverflowError):
+            Counter.increment_many([("hits", 5), ("foo", 2**62)])
+        self.assertRaises(CounterOverflowError, Counter.increment_existing, "foo", 2**62)
+        self.assertEqual(Counter.read("hits"), 0)
+        self.assertEqual(Counter.read("foo"), 2**62)
+        self.assertEqual(Counter.rank("hits")["counter"], 0)
+        self.assertRaises(DataValidationError, parse_deltas, [{"name": "foo", "delta": 2**63}], 10)
+        self.assertEqual(parse_deltas([{"name": "foo", "delta": -(2**63)}], 10), [("foo", -(2**63))])
+
+    def test_increment_many_connection_error(self):
+        """It should raise DatabaseConnectionError when a batch fails"""
+        with patch.dict(Counter.scripts, {"increment_many": Mock(side_effect=RedisConnectionError())}):
+            self.assertRaises(DatabaseConnectionError, Counter.increment_many, [("hits", 1)])
+
+    def test_version(self):
+        """It should Change the version whenever a counter is written"""
+        versions = [Counter.version()]
+
+        def changed():
+            versions.append(Counter.version())
+            return versions[-1] != versions[-2]
+
+        Counter.read("hits")
+        Counter.all()
+        self.assertFalse(changed())
+        Counter.create("foo")
+        self.assertTrue(changed())
+        Counter.create("foo")
+        self.assertFalse(changed())
+        Counter.increment_existing("foo")
+        self.assertTrue(changed())
+        Counter.increment_existing("bar")
+        self.assertFalse(changed())
+        Counter.increment_many([("foo", 1), ("hits", 2)])
+        self.assertTrue(changed())
+        self.counter.increment()
+        self.assertTrue(changed())
+        Counter("bar", 5).save()
+        self.assertTrue(changed())
+        Counter.reindex()
+        self.assertTrue(changed())
+        Counter.delete("bar")
+        self.assertTrue(changed())
+        Counter.delete("bar")
+        self.assertFalse(changed())
+        Counter.remove_all()
+        self.assertNotIn(Counter.version(), versions)
+
+    def test_version_connection_error(self):
+        """It should raise DatabaseConnectionError when the version can not be read"""
+        with patch.object(Counter.redis, "mget", side_effect=RedisConnectionError()):
+            self.assertRaises(DatabaseConnectionError, Counter.version)
+
+    def test_leaderboard(self):
+        """It should Rank counters by value as they are written"""
+        Counter.create("foo")
+        Counter.create("bar")
+        Counter.increment_existing("foo", 5)
+        Counter.increment_many([("bar", 2), ("hits", 1)])
+        self.counter.increment()
+        Counter.reshard("bar", 2)
+        Counter.increment_existing("bar", 2)
+        self.assertEqual(
+            Counter.top(),
+            [{"name": "foo", "counter": 5}, {"name": "bar", "counter": 4}, {"name": "hits", "counter": 2}],
+        )
+        self.assertEqual(Counter.top(1), [{"name": "foo", "counter": 5}])
+        self.assertEqual(Counter.rank("hits"), {"name": "hits", "counter": 2, "rank": 3})
+        Counter.delete("foo")
+        self.assertEqual(Counter.rank("bar")["rank"], 1)
+        self.assertIsNone(Counter.rank("foo"))
+
+    def test_leaderboard_exact_values(self):
+        """It should return the exact values of counters too large for a double"""
+        Counter("big", 2**63 - 1).save()
+        Counter("sharded", 2**53 + 1).save()
+        Counter.reshard("sharded", 2)
+        Counter.increment_existing("sharded", 2)
+        self.assertEqual(
+            Counter.top(2), [{"name": "big", "counter": 2**63 - 1}, {"name": "sharded", "counter": 2**53 + 3}]
+        )
+        self.assertEqual(Counter.rank("big"), {"name": "big", "counter": 2**63 - 1, "rank": 1})
+        self.assertEqual(Counter.rank("sharded"), {"name": "sharded", "counter": 2**53 + 3, "rank": 2})
+
+    def test_leaderboard_connection_error(self):
+        """It should raise DatabaseConnectionError when the leaderboard fails"""
+        with patch.dict(Counter.scripts, {"top": MagicMock(side_effect=RedisConnectionError())}):
+            self.assertRaises(DatabaseConnectionError, Counter.top)
+        with patch.object(Counter.redis, "pipeline", side_effect=RedisConnectionError()):
+            self.assertRaises(DatabaseConnectionError, Counter.rank, "hits")
+
+    def test_rate(self):
+        """It should Sum the increments of a recent window"""
+        start = 6000 * 60 + 10
+        with patch("service.models.time.time") as time_mock:
+            for seconds_ago, amount in ((70, 1), (30, 2), (5, 4)):
+                time_mock.return_value = start - seconds_ago
+                Counter.increment_existing("hits", amount)
+            time_mock.return_value = start
+            Counter.increment_many([("hits", 8)])
+            self.counter.increment()
+            self.assertEqual(Counter.rate("hits", 1), 9)
+            self.assertEqual(Counter.rate("hits", 10), 13)
+            self.assertEqual(Counter.rate("hits", 60), 15)
+            self.assertEqual(Counter.rate("hits", 61), 16)
+            self.assertEqual(Counter.rate("hits", 3600), 16)
+            self.assertIsNone(Counter.rate("foo", 60))
+        self.assertEqual(Counter.all(), [{"name": "hits", "counter": 16}])
+
+    def test_rate_connection_error(self):
+        """It should raise DatabaseConnectionError when reading a rate fails"""
+        with patch.object(Counter.redis, "pipeline", side_effect=RedisConnectionError()):
+            self.assertRaises(DatabaseConnectionError, Counter.rate, "hits", 60)
+
+    def test_parse_window(self):
+        """It should Parse windows in seconds, minutes and hours"""
+        self.assertEqual(parse_window("30"), 30)
+        self.assertEqual(parse_window("60s"), 60)
+        self.assertEqual(parse_window("5m"), 300)
+        self.assertEqual(parse_window("1h"), 3600)
+        for window in ("", "0s", "2h", "1d", "-5", "m"):
+            self.assertRaises(DataValidationError, parse_window, window)
+
+    def test_uniques(self):
+        """It should Estimate the unique members of counters"""
+        Counter.create("foo")
+        self.assertEqual(Counter.add_uniques("hits", ["a", "b", "a"]), 2)
+        self.assertEqual(Counter.add_uniques("foo", ["b", "c"]), 2)
+        self.assertIsNone(Counter.add_uniques("bar", ["a"]))
+        self.assertEqual(Counter.uniques(["hits"]), 2)
+        self.assertEqual(Counter.uniques(["hits", "foo"]), 3)
+        with self.assertRaises(CounterNotFoundError) as context:
+            Counter.uniques(["hits", "bar"])
+        self.assertEqual(context.exception.names, ["bar"])
+        self.assertEqual(Counter.merge_uniques("hits", ["foo"]), 3)
+        self.assertEqual(Counter.uniques(["foo"]), 2)
+        with self.assertRaises(CounterNotFoundError) as context:
+            Counter.merge_uniques("hits", ["bar"])
+        self.assertEqual(context.exception.names, ["bar"])
+        self.assertEqual(Counter.all(), [{"name": "foo", "counter": 0}, {"name": "hits", "counter": 0}])
+        Counter.delete("foo")
+        self.assertEqual(Counter.redis.exists(uniques_key("foo")), 0)
+
+    def test_uniques_connection_error(self):
+        """It should raise DatabaseConnectionError when unique counts fail"""
+        with patch.dict(Counter.scripts, {"add_uniques": Mock(side_effect=RedisConnectionError())}):
+            self.assertRaises(DatabaseConnectionError, Counter.add_uniques, "hits", ["a"])
+        with patch.dict(Counter.scripts, {"merge_uniques": Mock(side_effect=RedisConnectionError())}):
+            self.assertRaises(DatabaseConnectionError, Counter.merge_uniques, "hits", ["foo"])
+        with patch.object(Counter.redis, "pipeline", side_effect=RedisConnectionError()):
+            self.assertRaises(DatabaseConnectionError, Counter.uniques, ["hits"])
+
+    def test_parse_members(self):
+        """It should Parse one member or a list of members"""
+        self.assertEqual(parse_members({"member": "a"}, 10), ["a"])
+        self.assertEqual(parse_members({"members": ["a", "b"]}, 10), ["a", "b"])
+        for data in (None, ["a"], {}, {"member": ""}, {"members": []}, {"members": [1]}, {"members": ["a"] * 11}):
+            self.assertRaises(DataValidationError, parse_members, data, 10)
+
+    def test_shard_counter(self):
+        """It should Spread the increments of a sharded counter over its shards"""
+        self.counter.increment()
+        self.assertEqual(Counter.reshard("hits", 4), 1)
+        self.assertEqual(Counter.shards("hits"), 4)
+        for count in range(2, 42):
+            self.assertEqual(Counter.increment_existing("hits"), count)
+        self.assertEqual(Counter.read("hits"), 41)
+        self.assertEqual(Counter.redis.get(counter_key("hits")), "1")
+        shards = Counter.redis.mget([shard_key("hits", index) for index in range(4)])
+        self.assertEqual(sum(int(value) for value in shards), 40)
+        self.assertEqual(Counter.all(), [{"name": "hits", "counter": 41}])
+        self.assertEqual(Counter.increment_many([("hits", 1), ("hits", 1)]), [42, 43])
+
+    def test_demote_counter(self):
+        """It should Fold the shards back into a plain counter"""
+        Counter.reshard("hits", 3)
+        for _ in range(10):
+            Counter.increment_existing("hits")
+        self.assertEqual(Counter.reshard("hits", 8), 10)
+        self.assertEqual(Counter.redis.get(counter_key("hits")), "10")
+        Counter.increment_existing("hits", 5)
+        self.assertEqual(Counter.reshard("hits", 0), 15)
+        self.assertEqual(Counter.shards("hits"), 0)
+        self.assertEqual(Counter.redis.keys(f"{KEY_PREFIX}*{SHARD_SEPARATOR}*"), [])
+        self.assertIsNone(Counter.reshard("foo", 2))
+
+    def test_stale_shard_layout(self):
+        """It should Increment the counter's own key when its shards are gone"""
+        Counter.reshard("hits", 2)
+        Counter.redis.delete(SHARDS_KEY, shard_key("hits", 0), shard_key("hits", 1))
+        self.assertEqual(Counter.increment_existing("hits"), 1)
+        self.assertEqual(Counter.shards("hits"), 0)
+
+    def test_delete_sharded_counter(self):
+        """It should Delete a sharded counter with its shards"""
+        Counter.reshard("hits", 2)
+        self.assertTrue(Counter.delete("hits"))
+        self.assertEqual(Counter.redis.keys(f"{KEY_PREFIX}*"), [])
+        self.assertEqual(Counter.count(), 0)
+        self.assertIsNone(Counter.increment_existing("hits"))
+
+    def test_shard_connection_error(self):
+        """It should raise DatabaseConnectionError when resharding fails"""
+        with patch.object(Counter.redis, "hgetall", side_effect=RedisConnectionError()):
+            self.assertRaises(DatabaseConnectionError, Counter.reshard, "hits", 2)
+            Counter.layout_expires = 0.0
+            self.assertRaises(DatabaseConnectionError, Counter.shards, "hits")
+
+    def test_read_cache(self):
+        """It should Read counters through the read cache"""
+        Counter.enable_read_cache(max_size=10)
+        try:
+            self.assertEqual(Counter.read("hits"), 0)
+            self.assertEqual(Counter.read("hits"), 0)
+            self.assertEqual(Counter.cache.stats()["hits"], 1)
+            self.counter.increment()
+            self.assertEqual(Counter.read("hits"), 1)
+            Counter.increment_many([("hits", 2)])
+            self.assertEqual(Counter.read("hits"), 3)
+            Counter.reshard("hits", 2)
+            self.assertEqual(Counter.read("hits"), 3)
+            self.assertEqual(Counter.read("hits"), 3)
+            self.assertEqual(Counter.cache.stats()["size"], 0)
+            Counter.remove_all()
+            self.assertIsNone(Counter.read("hits"))
+        finally:
+            Counter.disable_read_cache()
+
+    def test_read_cache_resharded_elsewhere(self):
+        """It should not cache a counter another process sharded after the layout was loaded"""
+        Counter.enable_read_cache(max_size=10)
+        try:
+            self.assertEqual(Counter.shards("hits"), 0)
+            # what reshard does in another process, this one keeps its layout
+            Counter.redis.hset(SHARDS_KEY, "hits", 2)
+            Counter.redis.mset({shard_key("hits", 0): 4, shard_key("hits", 1): 1})
+            self.assertEqual(Counter.read("hits"), 5)
+            self.assertEqual(Counter.read("hits"), 5)
+            self.assertEqual(Counter.cache.stats()["size"], 0)
+            self.assertEqual(Counter.shards("hits"), 2)
+        finally:
+            Counter.disable_read_cache()
+
+    def test_read_cache_connection_error(self):
+        """It should not enable the read cache without Redis"""
+        with patch.object(Counter.redis, "pubsub", side_effect=RedisConnectionError()):
+            self.assertRaises(DatabaseConnectionError, Counter.enable_read_cache)
+        self.assertIsNone(Counter.cache)
+
+    def test_ping(self):
+        """It should Ping Redis without raising"""
+        self.assertTrue(Counter.ping())
+        with patch.object(Counter.redis, "ping", side_effect=RedisConnectionError()):
+            self.assertFalse(Counter.ping())
+        redis, Counter.redis = Counter.redis, None
+        try:
+            self.assertFalse(Counter.ping())
+        finally:
+            Counter.redis = redis
+
+    @patch("service.models.time.sleep")
+    def test_connect_in_background(self, sleep_mock):
+        """It should Keep connecting in the background until Redis answers"""
+        connected = Mock()
+        failures = [DatabaseConnectionError("down")] * 2
+        connect = Counter._connect.__func__
+
+        def flaky(cls, *args):
+            if failures:
+                raise failures.pop()
+            return connect(cls, *args)
+
+        with patch.object(Counter, "_connect", classmethod(flaky)):
+            Counter.connect_in_background(DATABASE_URI, {}, connected).join(5)
+        self.assertEqual(sleep_mock.call_count, 2)
+        connected.assert_called_once_with()
+        self.assertTrue(Counter.ping())
+        Counter.connect_in_background(DATABASE_URI).join(5)
+        self.assertTrue(Counter.ping())
+
     @patch("redis.Redis.ping")
     def test_no_connection(self, ping_mock):
         """It should Handle a failed connection"""
         ping_mock.side_effect = RedisConnectionError()
         self.assertRaises(DatabaseConnectionError, self.counter.connect, DATABASE_URI)
 
+    @patch("service.common.metrics.InstrumentedPipeline.execute")
+    def test_script_load_failed(self, execute_mock):
+        """It should Handle a connection that fails while loading the scripts"""
+        execute_mock.side_effect = RedisConnectionError()
+        self.assertRaises(DatabaseConnectionError, Counter._connect, DATABASE_URI)
+        self.assertIsNone(Counter.redis)
+
     @patch.dict(os.environ, {"DATABASE_URI": ""})
     def test_missing_environment_creds(self):
         """It should detect Missing environment credentials"""
         self.assertRaises(DatabaseConnectionError, self.counter.connect)
+
+
+######################################################################
+#  S E V E R A L   R E D I S   S E R V E R S
+######################################################################
+# three databases of the test server stand in for three Redis servers
+SERVERS = [DATABASE_URI.rsplit("/", 1)[0] + f"/{db}" for db in (1, 2, 3)]
+NAMES = [f"counter-{i:02d}" for i in range(30)]
+
+
+class ShardedCounterTests(TestCase):
+    """Tests of Counters spread over several Redis servers"""
+
+    def setUp(self):
+        """This runs before each test"""
+        Counter.connect(",".join(SERVERS))
+        Counter.remove_all()
+        for name in NAMES:
+            Counter.create(name)
+
+    def tearDown(self):
+        """This runs after each test"""
+        Counter.connect(DATABASE_URI)
+
+    def test_spread(self):
+        """It should Spread the counters over every server"""
+        self.assertEqual(len(Counter.ring.nodes), 3)
+        sizes = [node.zcard(INDEX_KEY) for node in Counter.ring.nodes]
+        self.assertTrue(all(sizes))
+        self.assertEqual(sum(sizes), len(NAMES))
+        self.assertEqual(Counter.count(), len(NAMES))
+        self.assertTrue(Counter.ping())
+        self.assertEqual(len(Counter.pool_stats()), 3)
+        self.assertEqual(len(Counter.breaker_stats()), 3)
+
+    def test_list(self):
+        """It should List the counters of every server in name order"""
+        Counter.increment_existing("counter-05", 5)
+        counters = Counter.all()
+        self.assertEqual([counter["name"] for counter in counters], NAMES)
+        self.assertEqual(counters[5], {"name": "counter-05", "counter": 5})
+        pages = list(Counter.pages(7))
+        self.assertEqual([len(page) for page in pages], [7, 7, 7, 7, 2])
+        self.assertEqual([counter for page in pages for counter in page], counters)
+        self.assertEqual(Counter.page("counter-06", 7), (counters[7:14], "counter-13"))
+        self.assertEqual(Counter.page("counter-27", 7), (counters[28:], ""))
+        Counter.remove_all()
+        self.assertEqual(list(Counter.pages(7)), [[]])
+
+    def test_version(self):
+        """It should Change the version when a counter on any server changes"""
+        version = Counter.version()
+        self.assertEqual(len(version.split(".")), 3)
+        Counter.increment_existing("counter-17")
+        self.assertNotEqual(Counter.version(), version)
+
+    def test_increment_many(self):
+        """It should Increment a batch that spans servers all or nothing"""
+        deltas = [("counter-01", 1), ("counter-02", 2), ("counter-01", 3), ("counter-29", 4)]
+        self.assertEqual(Counter.increment_many(deltas), [1, 2, 4, 4])
+        with self.assertRaises(CounterNotFoundError) as context:
+            Counter.increment_many([("counter-01", 1), ("missing", 1)])
+        self.assertEqual(context.exception.names, ["missing"])
+        self.assertEqual(Counter.read("counter-01"), 4)
+        Counter.reshard("counter-02", 2)
+        self.assertEqual(Counter.increment_many([("counter-02", 1), ("counter-03", 1)]), [3, 1])
+        self.assertEqual(Counter.shards("counter-02"), 2)
+
+    def test_deleted_while_incrementing(self):
+        """It should report a counter deleted after the batch was checked"""
+        with patch.object(Counter, "_missing", return_value=[]):
+            Counter.delete("counter-02")
+            self.assertRaises(CounterNotFoundError, Counter.increment_many, [("counter-01", 1), ("counter-02", 1)])
+
+    def test_leaderboard(self):
+        """It should Rank counters across servers like a single leaderboard"""
+        for i, name in enumerate(NAMES):
+            Counter.increment_existing(name, i % 4)
+        expected = sorted(Counter.all(), key=lambda counter: (counter["counter"], counter["name"]), reverse=True)
+        self.assertEqual(Counter.top(5), expected[:5])
+        for rank, counter in enumerate(expected, start=1):
+            self.assertEqual(Counter.rank(counter["name"]), dict(counter, rank=rank))
+        self.assertIsNone(Counter.rank("missing"))
+
+    def test_uniques(self):
+        """It should Count and merge unique members of counters on different servers"""
+        Counter.add_uniques("counter-01", ["a", "b"])
+        Counter.add_uniques("counter-02", ["b", "c"])
+        self.assertEqual(Counter.uniques(NAMES[:5]), 3)
+        self.assertRaises(CounterNotFoundError, Counter.uniques, ["counter-01", "missing"])
+        self.assertEqual(Counter.merge_uniques("counter-03", NAMES[:3]), 3)
+        self.assertEqual(Counter.uniques(["counter-03"]), 3)
+        self.assertRaises(CounterNotFoundError, Counter.merge_uniques, "counter-03", ["missing"])
+        self.assertEqual(Counter.merge_uniques("counter-04", ["counter-05"]), 0)
+
+    def test_purge(self):
+        """It should Purge the counters of every server"""
+        keys = len(NAMES) + sum(node.exists(*SERVICE_KEYS) for node in Counter.ring.nodes)
+        self.assertEqual(Counter.purge(batch_size=7), keys)
+        progress = Counter.purge_progress()
+        self.assertEqual((progress["state"], progress["done"], progress["servers"]), ("done", 3, 3))
+        self.assertEqual(Counter.count(), 0)
+
+    def test_reindex(self):
+        """It should Rebuild the index of every server"""
+        for node in Counter.ring.nodes:
+            node.delete(INDEX_KEY)
+        self.assertEqual(Counter.reindex(), len(NAMES))
+        self.assertEqual(Counter.count(), len(NAMES))
+
+    def test_rebalance(self):
+        """It should Move counters to a server that was added"""
+        Counter.remove_all()
+        Counter.connect(",".join(SERVERS[:2]))
+        for name in NAMES:
+            Counter.create(name)
+            Counter.increment_existing(name, 3)
+        Counter.reshard("counter-07", 2)
+        Counter.increment_existing("counter-07", 2)
+        Counter.add_uniques("counter-08", ["a", "b"])
+        self.assertEqual(Counter.rebalance(), 0)
+
+        Counter.connect(",".join(SERVERS))
+        moved = [name for name in NAMES if Counter.read(name) is None]
+        self.assertTrue(moved)
+        with patch.object(Counter, "_node", side_effect=lambda name: Counter.ring.nodes[2]):
+            # a counter created on its new server before the move keeps both counts
+            Counter.create(moved[0])
+            Counter.increment_existing(moved[0], 1)
+        self.assertEqual(Counter.rebalance(), len(moved))
+        self.assertEqual(Counter.count(), len(NAMES))
+        self.assertEqual(Counter.ring.nodes[2].zcard(INDEX_KEY), len(moved))
+        values = {counter["name"]: counter["counter"] for counter in Counter.all()}
+        self.assertEqual(values, {name: 4 if name == moved[0] else 5 if name == "counter-07" else 3 for name in NAMES})
+        self.assertEqual(Counter.uniques(["counter-08"]), 2)
+        self.assertEqual(Counter.rebalance(), 0)
+        Counter.connect(DATABASE_URI)
+        self.assertEqual(Counter.rebalance(), 0)
+
+    def test_read_cache(self):
+        """It should not Enable the read cache with several servers"""
+        Counter.enable_read_cache()
+        self.assertIsNone(Counter.cache)
+
+    def test_after_fork(self):
+        """It should Give a forked process its own ring workers"""
+        executor = Counter.ring.executor
+        Counter.after_fork()
+        self.assertIsNot(Counter.ring.executor, executor)
+        self.assertEqual(Counter.count(), len(NAMES))
+
+    def test_connection_error(self):
+        """It should raise DatabaseConnectionError when a server fails"""
+        node = Counter.ring.nodes[1]
+        with patch.object(node, "zcard", side_effect=RedisConnectionError()):
+            self.assertRaises(DatabaseConnectionError, Counter.count)
+        with patch.object(node, "zrangebylex", side_effect=RedisConnectionError()):
+            self.assertRaises(DatabaseConnectionError, list, Counter.pages(7))
+            self.assertRaises(DatabaseConnectionError, Counter.rebalance)
+        with patch.object(node, "ping", side_effect=RedisConnectionError()):
+            self.assertFalse(Counter.ping())
+
+
+######################################################################
+#  R E A D   R E P L I C A S
+######################################################################
+# another database of the test server stands in for a replica, which lets
+# the tests tell which of the two a read went to
+REPLICA_URI = DATABASE_URI.rsplit("/", 1)[0] + "/1"
+
+
+class ReplicaCounterTests(TestCase):
+    """Tests of Counters read from replicas"""
+
+    def setUp(self):
+        """This runs before each test"""
+        self.fresh = patch("service.common.replicas.replica_is_fresh", return_value=True)
+        self.fresh.start()
+        Counter.connect(DATABASE_URI, {"REDIS_REPLICA_URIS": REPLICA_URI, "REDIS_REPLICA_CHECK_INTERVAL": 60})
+        Counter.remove_all()
+        Counter.create("foo")
+        Counter.increment_existing("foo", 2)
+        self.replica = Counter.replicas[0].replicas[node_name(REPLICA_URI)]
+        self.replica.flushdb()
+        # the replica has not caught up with the last increment yet
+        self.replica.set(counter_key("foo"), 1)
+        self.replica.zadd(INDEX_KEY, {"foo": 0})
+        self.replica.zadd(LEADERBOARD_KEY, {"foo": 1})
+
+    def tearDown(self):
+        """This runs after each test"""
+        self.fresh.stop()
+        Counter.connect(DATABASE_URI)
+
+    def test_read_replica(self):
+        """It should Read counters from a replica"""
+        self.assertEqual(Counter.read("foo"), 1)
+        self.assertEqual(Counter.find("foo").serialize(), {"name": "foo", "counter": 1})
+        self.assertIsNone(Counter.find("bar"))
+        self.assertEqual(Counter.all(), [{"name": "foo", "counter": 1}])
+        self.assertEqual(Counter.top(1), [{"name": "foo", "counter": 1}])
+        self.assertEqual(Counter.rank("foo"), {"name": "foo", "counter": 1, "rank": 1})
+        # serialize() answers from the snapshot find() read
+        self.assertEqual(Counter.replica_stats()["replica_reads"], 7)
+        # finding a counter does not write the replica's value back
+        self.assertEqual(Counter.redis.get(counter_key("foo")), "2")
+
+    def test_read_primary(self):
+        """It should Read pages and writes from the primary"""
+        self.assertEqual(Counter.page("", 10), ([{"name": "foo", "counter": 2}], ""))
+        self.assertEqual(Counter.increment_existing("foo"), 3)
+        self.assertEqual(Counter.replica_stats()["replica_reads"], 0)
+
+    def test_stale_replica(self):
+        """It should Read from the primary when the replica is too far behind"""
+        Counter.replicas[0].check_interval = 0
+        with patch("service.common.replicas.replica_is_fresh", return_value=False):
+            self.assertEqual(Counter.read("foo"), 2)
+        self.assertEqual(Counter.replica_stats(), {"replicas": 1, "fresh": 0, "replica_reads": 0, "primary_reads": 1})
+
+    def test_read_cache(self):
+        """It should Fill the read cache from the primary"""
+        Counter.enable_read_cache(max_size=10)
+        try:
+            self.assertEqual(Counter.read("foo"), 2)
+        finally:
+            Counter.disable_read_cache()
+
+    def test_after_fork(self):
+        """It should Give a forked process new replica connections"""
+        Counter.read("foo")
+        Counter.after_fork()
+        self.assertEqual(Counter.replica_stats()["replica_reads"], 0)
+        self.assertEqual(Counter.read("foo"), 1)
+
+    def test_several_servers(self):
+        """It should Ignore listed replicas with several servers"""
+        Counter.connect(",".join(SERVERS), {"REDIS_REPLICA_URIS": REPLICA_URI})
+        self.assertEqual(Counter.replicas, [])
+        self.assertIsNone(Counter.replica_stats())
+
+    def test_sentinel(self):
+        """It should Find the primaries and replicas with Sentinel"""
+        address = Counter.redis.connection_pool.connection_kwargs
+        sentinel = Mock()
+        sentinel.discover_master.return_value = (address["host"], address["port"])
+        sentinel.discover_slaves.return_value = [(address["host"], address["port"])]
+        settings = {"REDIS_SENTINEL_URIS": "redis://sentinel:26379", "REDIS_SENTINEL_SERVICES": "one,two"}
+        with patch("service.models.create_sentinel", return_value=sentinel):
+            Counter.connect(REPLICA_URI, settings)
+        self.assertEqual(Counter.ring.names, ["one", "two"])
+        self.assertEqual(Counter.read("foo"), 1)
+        self.assertEqual(set(Counter.replica_stats()), {"one", "two"})
+        sentinel.discover_master.assert_any_call("one")
+        sentinel.discover_slaves.assert_called_with(Counter.ring.names[Counter.ring.index("foo")])
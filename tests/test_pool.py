@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the Connection Pools
+"""
+import os
+import logging
+from unittest import TestCase
+from unittest.mock import Mock, patch
+from redis import Redis
+from redis.exceptions import ConnectionError as RedisConnectionError, ResponseError
+from service.common.pool import (
+    StatsBlockingConnectionPool,
+    StatsConnectionPool,
+    StatsSentinelConnectionPool,
+    create_pool,
+    create_sentinel_pool,
+)
+from service import config, create_app, start
+from service.models import Counter
+
+DATABASE_URI = os.getenv("DATABASE_URI", "redis://:@localhost:6379/0")
+
+logging.disable(logging.CRITICAL)
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class PoolTests(TestCase):
+    """Connection Pool Tests"""
+
+    def test_create_pool(self):
+        """It should Create a pool from the configuration settings"""
+        pool = create_pool(DATABASE_URI, {"REDIS_MAX_CONNECTIONS": 7, "REDIS_SOCKET_TIMEOUT": 1.5})
+        self.assertIsInstance(pool, StatsConnectionPool)
+        self.assertEqual(pool.max_connections, 7)
+        self.assertEqual(pool.connection_kwargs["socket_timeout"], 1.5)
+        self.assertNotIn("socket_keepalive", pool.connection_kwargs)
+
+        pool = create_pool(DATABASE_URI, {"REDIS_POOL_BLOCKING": True, "REDIS_POOL_TIMEOUT": 0.5})
+        self.assertIsInstance(pool, StatsBlockingConnectionPool)
+        self.assertEqual(pool.timeout, 0.5)
+
+    def test_create_sentinel_pool(self):
+        """It should Create a pool to the primary that Sentinel knows"""
+        redis = Redis.from_url(DATABASE_URI)
+        address = redis.connection_pool.connection_kwargs
+        sentinel = Mock()
+        sentinel.discover_master.return_value = (address["host"], address["port"])
+        pool = create_sentinel_pool("mymaster", sentinel, "redis://:@unused:1/0", {"REDIS_MAX_CONNECTIONS": 3})
+        self.assertIsInstance(pool, StatsSentinelConnectionPool)
+        self.assertEqual(pool.max_connections, 3)
+        self.assertNotIn("host", pool.connection_kwargs)
+        self.assertTrue(Redis(connection_pool=pool).ping())
+        sentinel.discover_master.assert_called_with("mymaster")
+        self.assertEqual(pool.stats()["idle"], 1)
+        pool.disconnect()
+
+    def test_pool_stats(self):
+        """It should count connections in use and idle"""
+        for settings in ({}, {"REDIS_POOL_BLOCKING": True}):
+            pool = create_pool(DATABASE_URI, settings)
+            first = pool.get_connection()
+            second = pool.get_connection()
+            pool.release(first)
+            stats = pool.stats()
+            self.assertEqual(stats["created"], 2)
+            self.assertEqual(stats["in_use"], 1)
+            self.assertEqual(stats["idle"], 1)
+            self.assertEqual(stats["acquired"], 2)
+            self.assertGreaterEqual(stats["wait_max_ms"], stats["wait_avg_ms"])
+            pool.release(second)
+            pool.reset_stats()
+            self.assertEqual(pool.stats()["acquired"], 0)
+            pool.disconnect()
+
+    def test_exhausted_pool(self):
+        """It should count connections it could not hand out"""
+        pool = create_pool(DATABASE_URI, {"REDIS_MAX_CONNECTIONS": 1, "REDIS_POOL_BLOCKING": True, "REDIS_POOL_TIMEOUT": 0.01})
+        connection = pool.get_connection()
+        self.assertRaises(RedisConnectionError, pool.get_connection)
+        self.assertEqual(pool.stats()["failed"], 1)
+        pool.release(connection)
+        pool.disconnect()
+
+    def test_counter_pool(self):
+        """It should Connect the Counter with the pool settings"""
+        Counter.connect(DATABASE_URI, {"REDIS_MAX_CONNECTIONS": 5, "REDIS_POOL_BLOCKING": True})
+        Counter.redis.ping()
+        stats = Counter.pool_stats()
+        self.assertEqual(stats["max_connections"], 5)
+        self.assertGreaterEqual(stats["acquired"], 1)
+        Counter.connect(DATABASE_URI)
+        redis, Counter.redis = Counter.redis, None
+        self.assertIsNone(Counter.pool_stats())
+        Counter.redis = redis
+
+    def test_after_fork(self):
+        """It should give a forked process fresh connections and threads"""
+        Counter.connect(DATABASE_URI)
+        Counter.remove_all()
+        Counter("foo", 1).save()
+        Counter.enable_write_behind(interval=60, max_pending=1000, staleness=60)
+        Counter.enable_read_cache(max_size=10)
+        try:
+            Counter.increment_behind("foo")
+            cache = Counter.cache
+            Counter.after_fork()
+            # the new pool starts empty, only a pub/sub cache listener takes a
+            # connection from it (CLIENT TRACKING opens its own outside the pool)
+            listeners = 1 if Counter.cache.mode == "pubsub" else 0
+            self.assertEqual(Counter.pool_stats()["created"], listeners)
+            self.assertIsNot(Counter.cache, cache)
+            Counter.buffer.flush()
+            self.assertEqual(Counter.read("foo"), 1)
+        finally:
+            Counter.disable_write_behind()
+            Counter.disable_read_cache()
+
+    def test_after_fork_pubsub(self):
+        """It should give a forked process fresh connections when the cache uses pub/sub"""
+        with patch("service.common.read_cache.ReadCache._start_tracking", side_effect=ResponseError("unknown command")):
+            self.test_after_fork()
+
+    def test_after_fork_error(self):
+        """It should not raise when reinitializing after a fork fails"""
+        redis, Counter.redis = Counter.redis, Redis.from_url(DATABASE_URI)
+        try:
+            Counter.after_fork()
+        finally:
+            Counter.redis = redis
+
+    def test_after_fork_while_connecting(self):
+        """It should keep connecting in a process forked before Redis answered"""
+        redis, Counter.redis = Counter.redis, None
+        connector = Counter.connector
+        Counter.connect_args = (DATABASE_URI, {}, None)
+        Counter.connector = Mock()
+        try:
+            with patch.object(Counter, "connect_in_background") as connect_mock:
+                Counter.after_fork()
+            connect_mock.assert_called_once_with(DATABASE_URI, {}, None)
+        finally:
+            Counter.redis = redis
+            Counter.connector = connector
+
+    def test_deferred_start(self):
+        """It should leave connecting and starting threads to start() when DEFER_START is set"""
+        with patch.object(config, "DEFER_START", True), patch.object(Counter, "connect_in_background") as connect_mock:
+            app = create_app()
+            connect_mock.assert_not_called()
+            start(app)
+        connect_mock.assert_called_once()
+        with patch.object(Counter, "enable_read_cache") as cache_mock:
+            app.config["READ_CACHE"] = True
+            on_connect = connect_mock.call_args[0][2]
+            on_connect()
+        cache_mock.assert_called_once()
+        self.assertIsNotNone(app.extensions["startup"]["redis_seconds"])
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the Read Cache
+"""
+import os
+import time
+import threading
+import logging
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+from redis import Redis
+from redis.exceptions import ConnectionError as RedisConnectionError, ResponseError
+from service.common.read_cache import ReadCache, TRACKING_CHANNEL
+
+DATABASE_URI = os.getenv("DATABASE_URI", "redis://:@localhost:6379/0")
+
+logging.disable(logging.CRITICAL)
+
+
+def wait_for(condition, timeout: float = 2.0) -> bool:
+    """Polls condition until it is true or the timeout expires"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class ReadCacheTests(TestCase):
+    """Read Cache Tests"""
+
+    def setUp(self):
+        """This runs before each test"""
+        self.redis = Redis.from_url(DATABASE_URI, decode_responses=True)
+        self.cache = ReadCache(lambda: self.redis, max_size=2)
+        self.cache.mode = "test"
+
+    def tearDown(self):
+        """This runs after each test"""
+        self.cache.stop()
+        self.redis.close()
+
+    def fill(self, cache: ReadCache, name: str, value: int) -> None:
+        """Caches a value the way a reader would"""
+        cache.fill(name, value, cache.begin(name))
+
+    def test_hit_and_miss(self):
+        """It should count Hits and Misses"""
+        self.assertIsNone(self.cache.get("foo"))
+        self.fill(self.cache, "foo", 1)
+        self.assertEqual(self.cache.get("foo"), 1)
+        stats = self.cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["size"], 1)
+
+    def test_lru_eviction(self):
+        """It should Evict the least recently used value"""
+        self.fill(self.cache, "foo", 1)
+        self.fill(self.cache, "bar", 2)
+        self.cache.get("foo")
+        self.fill(self.cache, "baz", 3)
+        self.assertEqual(self.cache.get("foo"), 1)
+        self.assertIsNone(self.cache.get("bar"))
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+    def test_invalidated_while_loading(self):
+        """It should not cache a value invalidated while it was being read"""
+        token = self.cache.begin("foo")
+        self.cache.invalidate(["foo"])
+        self.cache.fill("foo", 1, token)
+        self.assertIsNone(self.cache.get("foo"))
+
+    def test_invalidate(self):
+        """It should Invalidate one or all values"""
+        self.fill(self.cache, "foo", 1)
+        self.fill(self.cache, "bar", 2)
+        self.cache.invalidate(["foo", "other"])
+        self.assertIsNone(self.cache.get("foo"))
+        self.assertEqual(self.cache.get("bar"), 2)
+        self.cache.invalidate()
+        self.assertIsNone(self.cache.get("bar"))
+        self.assertEqual(self.cache.stats()["invalidations"], 2)
+
+    def test_disabled_cache(self):
+        """It should not cache anything while it is not listening"""
+        self.cache.mode = None
+        self.fill(self.cache, "foo", 1)
+        self.assertIsNone(self.cache.get("foo"))
+
+    def test_pubsub_fallback(self):
+        """It should Invalidate other caches through pub/sub"""
+        self.cache.mode = None
+        other = ReadCache(lambda: self.redis, max_size=10)
+        with patch.object(ReadCache, "_start_tracking", side_effect=ResponseError()):
+            self.cache.start()
+            other.start()
+        try:
+            self.assertEqual(other.mode, "pubsub")
+            self.fill(other, "foo", 1)
+            self.fill(other, "bar", 2)
+            self.cache.written(["foo"])
+            self.assertTrue(wait_for(lambda: other.stats()["size"] == 1))
+            self.cache.written()
+            self.assertTrue(wait_for(lambda: other.stats()["size"] == 0))
+        finally:
+            other.stop()
+
+    def test_publish_error_is_ignored(self):
+        """It should still invalidate locally when publishing fails"""
+        self.cache.mode = "pubsub"
+        self.fill(self.cache, "foo", 1)
+        with patch.object(self.redis, "publish", side_effect=RedisConnectionError()):
+            self.cache.written(["foo"])
+        self.assertIsNone(self.cache.get("foo"))
+
+    def test_client_tracking(self):
+        """It should redirect CLIENT TRACKING invalidations to pub/sub"""
+        self.cache.mode = None
+        connection = MagicMock()
+        connection.read_response.side_effect = [42, "OK"]
+        pool = MagicMock()
+        pool.connection_class.return_value = connection
+        redis = MagicMock()
+        redis.connection_pool = pool
+        cache = ReadCache(lambda: redis, prefix="counter:")
+        cache.start()
+        self.assertEqual(cache.mode, "tracking")
+        connection.send_command.assert_any_call("CLIENT", "TRACKING", "ON", "REDIRECT", 42, "BCAST", "PREFIX", "counter:")
+        pubsub = redis.pubsub.return_value
+        handler = pubsub.subscribe.call_args.kwargs[TRACKING_CHANNEL]
+
+        self.fill(cache, "foo", 1)
+        self.fill(cache, "bar", 2)
+        handler({"data": ["foo"]})
+        self.assertIsNone(cache.get("foo"))
+        self.assertEqual(cache.get("bar"), 2)
+        handler({"data": None})
+        self.assertIsNone(cache.get("bar"))
+
+        cache._on_reconnect(connection)
+        self.assertIsNone(cache.mode)
+        cache.stop()
+        connection.disconnect.assert_called()
+
+    def test_client_tracking_refused(self):
+        """It should give up the tracking connection when tracking is refused"""
+        connection = MagicMock()
+        connection.read_response.side_effect = [42, ResponseError("nope")]
+        pool = MagicMock()
+        pool.connection_class.return_value = connection
+        redis = MagicMock()
+        redis.connection_pool = pool
+        cache = ReadCache(lambda: redis)
+        cache.start()
+        self.assertEqual(cache.mode, "pubsub")
+        connection.disconnect.assert_called()
+        cache.stop()
+
+    def test_listener_error(self):
+        """It should stop caching when the listener fails"""
+        pubsub = MagicMock()
+        thread = MagicMock()
+        self.fill(self.cache, "foo", 1)
+        self.cache._on_listener_error(RedisConnectionError(), pubsub, thread)
+        self.assertIsNone(self.cache.mode)
+        self.assertIsNone(self.cache.get("foo"))
+        pubsub.close.assert_called_once()
+        thread.stop.assert_called_once()
+
+    def test_watchdog_resubscribes(self):
+        """It should empty the cache and subscribe again when the listener stops"""
+        cache = ReadCache(lambda: self.redis, check_interval=0.01)
+        with patch.object(cache, "_start_tracking", side_effect=ResponseError("unknown command")):
+            cache.start()
+            self.fill(cache, "foo", 1)
+            cache._thread.stop()
+            self.assertTrue(wait_for(lambda: cache.restarts == 1))
+        self.assertIsNone(cache.get("foo"))
+        self.assertTrue(wait_for(lambda: cache.stats()["listening"]))
+        self.assertEqual(cache.stats()["mode"], "pubsub")
+        self.assertFalse(cache.stats()["tracking"])
+        cache.stop()
+        self.assertFalse(cache.stats()["listening"])
+
+    def test_tracking_connection_lost(self):
+        """It should not be listening once the tracking connection stops answering"""
+        self.assertFalse(self.cache.listening())
+        self.cache._thread = MagicMock()
+        self.cache._tracker = MagicMock()
+        self.assertTrue(self.cache.listening())
+        self.cache._tracker.read_response.side_effect = RedisConnectionError()
+        self.assertFalse(self.cache.listening())
+        self.cache._tracker = None
+
+    def test_resubscribe_fails(self):
+        """It should keep caching off while it cannot subscribe again"""
+        redis = MagicMock()
+        redis.pubsub.side_effect = RedisConnectionError()
+        cache = ReadCache(lambda: redis, check_interval=0.01)
+        cache.mode = "pubsub"
+        with patch.object(cache, "listening", return_value=False):
+            watchdog = threading.Thread(target=cache._watch)
+            watchdog.start()
+            self.assertTrue(wait_for(lambda: redis.pubsub.call_count >= 2))
+            cache._stopping.set()
+            watchdog.join()
+        self.assertIsNone(cache.mode)
+        self.assertEqual(cache.restarts, 0)
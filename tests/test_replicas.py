@@ -0,0 +1,115 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the Read Replicas
+"""
+import logging
+from unittest import TestCase
+from unittest.mock import Mock
+from redis.exceptions import ConnectionError as RedisConnectionError
+from service.common.breaker import CLOSED, OPEN
+from service.common.replicas import ReplicaSet, create_sentinel, replica_is_fresh, sentinel_discovery, with_address
+
+logging.disable(logging.CRITICAL)
+
+UP = {"role": "slave", "master_link_status": "up"}
+
+
+def replica(info: dict = None) -> Mock:
+    """Returns a mock replica whose INFO replication is info"""
+    mock = Mock()
+    mock.info.return_value = UP if info is None else info
+    mock.breaker.state = CLOSED
+    return mock
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class ReplicaTests(TestCase):
+    """Read Replica Tests"""
+
+    def test_fresh(self):
+        """It should only read from replicas that are replicating and not too far behind"""
+        self.assertTrue(replica_is_fresh(replica(), 5))
+        down = {"role": "slave", "master_link_status": "down", "master_link_down_since_seconds": 3}
+        self.assertTrue(replica_is_fresh(replica(down), 5))
+        self.assertFalse(replica_is_fresh(replica(down), 2))
+        self.assertFalse(replica_is_fresh(replica({"role": "slave", "master_link_status": "down"}), 2))
+        self.assertFalse(replica_is_fresh(replica({"role": "master"}), 5))
+        failed = replica()
+        failed.info.side_effect = RedisConnectionError()
+        self.assertFalse(replica_is_fresh(failed, 5))
+
+    def test_reader(self):
+        """It should Spread reads over the fresh replicas"""
+        primary, first, second, stale = Mock(), replica(), replica(), replica({"role": "master"})
+        replicas = ReplicaSet(primary, {"a": first, "b": second, "c": stale}, check_interval=60)
+        self.assertTrue(replicas.has_replicas)
+        readers = [replicas.reader() for _ in range(4)]
+        self.assertEqual(readers, [first, second, first, second])
+        self.assertEqual(first.info.call_count, 1)
+        second.breaker.state = OPEN
+        self.assertIs(replicas.reader(), first)
+        self.assertEqual(replicas.stats(), {"replicas": 3, "fresh": 2, "replica_reads": 5, "primary_reads": 0})
+        self.assertEqual(replicas.clients(), [primary, first, second, stale])
+
+    def test_primary(self):
+        """It should Read from the primary when no replica is fresh"""
+        primary, lagging = Mock(), replica({"role": "slave", "master_link_status": "down"})
+        replicas = ReplicaSet(primary, {"a": lagging}, check_interval=0)
+        self.assertIs(replicas.reader(), primary)
+        lagging.info.return_value = UP
+        self.assertIs(replicas.reader(), lagging)
+        self.assertEqual(replicas.stats()["primary_reads"], 1)
+        replicas.restart()
+        self.assertEqual(replicas.stats()["replica_reads"], 0)
+        self.assertFalse(ReplicaSet(primary).has_replicas)
+
+    def test_discover(self):
+        """It should Ask Sentinel for the replicas at every check"""
+        sentinel = Mock()
+        sentinel.discover_slaves.return_value = [("10.0.0.1", 6379)]
+        connect = Mock(side_effect=lambda address: replica())
+        replicas = ReplicaSet(Mock(), discover=sentinel_discovery(sentinel, "mymaster", connect), check_interval=0)
+        self.assertTrue(replicas.has_replicas)
+        first = replicas.reader()
+        self.assertIs(first, replicas.replicas["10.0.0.1:6379"])
+        sentinel.discover_slaves.return_value = [("10.0.0.1", 6379), ("10.0.0.2", 6379)]
+        replicas.reader()
+        self.assertEqual(list(replicas.replicas), ["10.0.0.1:6379", "10.0.0.2:6379"])
+        self.assertIs(replicas.replicas["10.0.0.1:6379"], first)
+        self.assertEqual(connect.call_count, 2)
+        sentinel.discover_slaves.assert_called_with("mymaster")
+
+        sentinel.discover_slaves.side_effect = RedisConnectionError()
+        replicas.reader()
+        self.assertEqual(len(replicas.replicas), 2)
+
+    def test_create_sentinel(self):
+        """It should Create a Sentinel client from the uris of the Sentinels"""
+        sentinel = create_sentinel(["redis://:secret@sentinel-1:26380", "redis://sentinel-2"], {"REDIS_SOCKET_TIMEOUT": 1.5})
+        addresses = [sentinel.connection_pool.connection_kwargs for sentinel in sentinel.sentinels]
+        hosts = [(kwargs["host"], kwargs["port"]) for kwargs in addresses]
+        self.assertEqual(hosts, [("sentinel-1", 26380), ("sentinel-2", 26379)])
+        self.assertEqual(addresses[1]["password"], "secret")
+        self.assertEqual(addresses[1]["socket_timeout"], 1.5)
+
+    def test_with_address(self):
+        """It should Point a uri at another server keeping its credentials and database"""
+        self.assertEqual(with_address("redis://:secret@redis-0:6379/2", "10.0.0.1:6380"), "redis://:secret@10.0.0.1:6380/2")
+        self.assertEqual(with_address("redis://redis-0:6379/2", "10.0.0.1:6380"), "redis://10.0.0.1:6380/2")
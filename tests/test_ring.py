@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the Consistent Hash Ring
+"""
+import threading
+from unittest import TestCase
+from service.common.ring import HashRing, node_name, split_uris
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class HashRingTests(TestCase):
+    """Consistent Hash Ring Tests"""
+
+    def test_split_uris(self):
+        """It should Split a comma separated list of servers"""
+        self.assertEqual(split_uris("redis://a:6379/0, redis://b:6380/1,"), ["redis://a:6379/0", "redis://b:6380/1"])
+        self.assertEqual(node_name("redis://:secret@redis-1:6380/2"), "redis-1:6380/2")
+        self.assertEqual(node_name("redis://redis-1"), "redis-1:6379/0")
+
+    def test_spread(self):
+        """It should Spread keys evenly and the same way every time"""
+        ring = HashRing({"a": "A", "b": "B", "c": "C"})
+        keys = [f"counter-{i}" for i in range(3000)]
+        owners = [ring.get(key) for key in keys]
+        for node in "ABC":
+            self.assertGreater(owners.count(node), 800)
+        self.assertEqual(owners, [HashRing({"a": "A", "b": "B", "c": "C"}).get(key) for key in keys])
+        ring.close()
+
+    def test_adding_a_node(self):
+        """It should only move keys to a node that is added"""
+        before = HashRing({"a": "A", "b": "B"})
+        after = HashRing({"a": "A", "b": "B", "c": "C"})
+        keys = [f"counter-{i}" for i in range(3000)]
+        moved = [key for key in keys if before.get(key) != after.get(key)]
+        self.assertTrue(all(after.get(key) == "C" for key in moved))
+        self.assertLess(len(moved), 1300)
+
+    def test_group(self):
+        """It should Group keys by node keeping their order"""
+        ring = HashRing({"a": "A", "b": "B"})
+        keys = [f"counter-{i}" for i in range(20)]
+        groups = ring.group(keys)
+        self.assertEqual(sorted(key for _, members in groups for key in members), sorted(keys))
+        for node, members in groups:
+            self.assertEqual(members, [key for key in keys if ring.get(key) == node])
+        self.assertEqual(ring.group([]), [])
+        self.assertRaises(ValueError, HashRing, {})
+
+    def test_map(self):
+        """It should Call every node in parallel and a single one inline"""
+        ring = HashRing({"a": "A", "b": "B"})
+        self.assertEqual(ring.map(str.lower, ["A", "B"]), ["a", "b"])
+        self.assertEqual(ring.map(lambda _: threading.current_thread(), ["A"]), [threading.current_thread()])
+        ring.restart()
+        self.assertEqual(ring.map(str.lower, ring.nodes), ["a", "b"])
+        # a worker that maps again does not wait for the other workers
+        nested = ring.map(lambda node: ring.map(str.lower, [node, node]), ring.nodes)
+        self.assertEqual(nested, [["a", "a"], ["b", "b"]])
+        self.assertEqual(ring.map(str.lower, []), [])
+        ring.close()
+
+    def test_concurrent_maps(self):
+        """It should not queue calls that fan out at the same time behind each other"""
+        ring = HashRing({"a": "A", "b": "B", "c": "C"}, concurrency=2)
+        self.assertEqual(ring.max_workers, 4)
+        # every node of both calls must be called at once to get past the barrier
+        barrier = threading.Barrier(6, timeout=5)
+
+        def call(node):
+            barrier.wait()
+            return node.lower()
+
+        results = []
+        callers = [threading.Thread(target=lambda: results.append(ring.map(call, ring.nodes))) for _ in range(2)]
+        for caller in callers:
+            caller.start()
+        for caller in callers:
+            caller.join(10)
+        self.assertEqual(results, [["a", "b", "c"], ["a", "b", "c"]])
+        ring.close()
@@ -13,6 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+# pylint: disable=too-many-public-methods
 """
 Counter API Service Test Suite
 
@@ -21,17 +22,60 @@ Test cases can be run with the following:
   coverage report -m
 """
 import os
+import json
+import time
 import logging
+from io import BytesIO
+from urllib.parse import quote
 from unittest import TestCase
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
+import msgpack
+from prometheus_client import REGISTRY
+from redis.exceptions import ConnectionError as RedisConnectionError
 from wsgi import app
-from service.models import Counter, DatabaseConnectionError
+from service.models import PURGE_KEY, PURGE_LOCK_KEY, Counter, DatabaseConnectionError, counter_key
 from service.common import status
+from service.routes import readiness
 
 # logging.disable(logging.CRITICAL)
 
 DATABASE_URI = os.getenv("DATABASE_URI", "redis://:@localhost:6379/0")
 
+# (method, url, body, Redis commands, Redis round trips) of each route
+REDIS_TRAFFIC = [
+    ("GET", "/counters", None, 3, 3),
+    ("GET", "/counters?limit=10", None, 4, 4),
+    ("GET", "/counters/export", None, 2, 2),
+    ("GET", "/counters/foo", None, 1, 1),
+    ("GET", "/counters/nope", None, 1, 1),
+    ("POST", "/counters/baz", None, 1, 1),
+    ("PUT", "/counters/foo", None, 1, 1),
+    ("POST", "/counters/batch", [{"name": "foo", "delta": 1}, {"name": "bar", "delta": 2}], 1, 1),
+    ("GET", "/counters/top", None, 1, 1),
+    ("GET", "/counters/foo/rank", None, 3, 1),
+    ("GET", "/counters/foo/rate", None, 3, 1),
+    ("POST", "/counters/foo/uniques", {"members": ["a", "b"]}, 1, 1),
+    ("GET", "/counters/foo/uniques", None, 2, 1),
+    ("GET", "/counters/uniques?names=foo,bar", None, 3, 1),
+    ("POST", "/counters/bar/uniques/merge", {"names": ["foo"]}, 1, 1),
+    ("PUT", "/counters/bar/shards", {"shards": 2}, 7, 3),
+    ("DELETE", "/counters/baz", None, 1, 1),
+    ("GET", "/ready", None, 1, 1),
+    ("GET", "/stats", None, 0, 0),
+]
+
+
+def redis_traffic() -> tuple:
+    """Returns the number of Redis commands and round trips sent so far"""
+    commands = round_trips = 0.0
+    for metric in REGISTRY.collect():
+        for sample in metric.samples:
+            if sample.name == "redis_commands_total":
+                commands += sample.value
+            elif sample.name == "redis_round_trip_seconds_count":
+                round_trips += sample.value
+    return commands, round_trips
+
 
 ######################################################################
 #  T E S T   C A S E S
@@ -53,6 +97,7 @@ class ServiceTest(TestCase):
         """This runs before each test"""
         Counter.connect(DATABASE_URI)
         Counter.remove_all()
+        Counter.redis.delete(PURGE_KEY, PURGE_LOCK_KEY)
         self.app = app.test_client()
 
     def tearDown(self):
@@ -99,6 +144,237 @@ class ServiceTest(TestCase):
         data = resp.get_json()
         self.assertEqual(len(data), 2)
 
+    def test_ready(self):
+        """It should be Ready only while Redis answers"""
+        readiness.reset()
+        resp = self.app.get("/ready")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["status"], "OK")
+        readiness.reset()
+        with patch.object(readiness, "check", return_value=False):
+            resp = self.app.get("/ready")
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        readiness.reset()
+
+    def test_not_connected(self):
+        """It should answer 503 until Redis is connected but stay healthy"""
+        redis, Counter.redis = Counter.redis, None
+        try:
+            resp = self.app.get("/counters/foo")
+            self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            self.assertIn("Not connected", resp.get_json()["message"])
+            resp = self.app.get("/health")
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        finally:
+            Counter.redis = redis
+
+    def test_circuit_open(self):
+        """It should fail fast with Retry-After while the circuit is open"""
+        breaker = Counter.redis.breaker
+        breaker.failures = 1
+        try:
+            with patch.object(Counter.redis.connection_pool, "get_connection", side_effect=RedisConnectionError()):
+                resp = self.app.get("/counters/foo")
+            self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            self.assertNotIn("Retry-After", resp.headers)
+            resp = self.app.get("/counters/foo")
+            self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            self.assertEqual(resp.headers["Retry-After"], "5")
+            self.assertEqual(self.app.get("/stats").get_json()["breaker"]["state"], "open")
+        finally:
+            breaker.reset()
+
+    def test_startup_stats(self):
+        """It should report how long start up took"""
+        resp = self.app.get("/stats")
+        self.assertGreater(resp.get_json()["startup"]["app_seconds"], 0)
+
+    def test_list_counters_streamed(self):
+        """It should Stream every counter as JSON or NDJSON a page at a time"""
+        for i in range(7):
+            self.app.post(f"/counters/foo{i}")
+        names = [f"foo{i}" for i in range(7)]
+        pages = Counter.pages
+        with patch.object(Counter, "pages", lambda _limit: pages(3)):
+            resp = self.app.get("/counters")
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(resp.mimetype, "application/json")
+            self.assertTrue(resp.is_streamed)
+            self.assertEqual(sorted(counter["name"] for counter in resp.get_json()), sorted(names))
+            resp = self.app.get("/counters", headers={"Accept": "application/x-ndjson"})
+            self.assertEqual(resp.mimetype, "application/x-ndjson")
+            lines = resp.get_data(as_text=True).splitlines()
+            self.assertEqual(sorted(json.loads(line)["name"] for line in lines), sorted(names))
+
+    def test_list_counters_empty(self):
+        """It should Stream an empty list when there are no counters"""
+        Counter.remove_all()
+        resp = self.app.get("/counters")
+        self.assertEqual(resp.get_json(), [])
+        resp = self.app.get("/counters", headers={"Accept": "application/x-ndjson"})
+        self.assertEqual(resp.get_data(as_text=True), "")
+
+    def test_list_counters_empty_pages(self):
+        """It should Stream valid JSON when pages come back empty after deletes"""
+        pages = [[], [{"name": "foo", "counter": 1}], [], [{"name": "bar", "counter": 2}]]
+        with patch.object(Counter, "pages", lambda _limit: iter(pages)):
+            resp = self.app.get("/counters")
+        self.assertEqual(resp.get_json(), [{"name": "foo", "counter": 1}, {"name": "bar", "counter": 2}])
+        with patch.object(Counter, "pages", lambda _limit: iter([[], []])):
+            resp = self.app.get("/counters")
+        self.assertEqual(resp.get_json(), [])
+
+    def test_list_counters_interrupted(self):
+        """It should abort a streamed list or export when Redis fails part way"""
+        self.app.post("/counters/foo")
+
+        def failing(_limit):
+            yield [{"name": "foo", "counter": 0}]
+            raise DatabaseConnectionError("gone")
+
+        for url in ("/counters", "/counters/export"):
+            with patch.object(Counter, "pages", failing):
+                resp = self.app.get(url)
+                self.assertEqual(resp.status_code, status.HTTP_200_OK)
+                # the body must not end as if it were complete
+                self.assertRaises(DatabaseConnectionError, resp.get_data)
+
+    def test_export_import(self):
+        """It should Export every counter as NDJSON and Import them back"""
+        for i in range(5):
+            self.app.post(f"/counters/foo{i}")
+            self.app.put(f"/counters/foo{i}")
+        resp = self.app.get("/counters/export")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        self.assertIn("attachment", resp.headers["Content-Disposition"])
+        export = resp.get_data()
+        self.assertEqual(len(export.splitlines()), 5)
+
+        resp = self.app.post("/counters/import", data=export, content_type="application/x-ndjson")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"imported": 5, "mode": "merge"})
+        self.assertEqual(self.app.get("/counters/foo0").get_json()["counter"], 2)
+
+        Counter.remove_all()
+        resp = self.app.post("/counters/import?mode=overwrite", data=export, content_type="application/x-ndjson")
+        self.assertEqual(resp.get_json()["imported"], 5)
+        self.assertEqual(self.app.get("/counters/foo0").get_json()["counter"], 1)
+        self.assertEqual(self.app.get("/counters/export").get_data(), export)
+
+    def test_import_bad_request(self):
+        """It should not Import with a bad mode or a bad line"""
+        resp = self.app.post("/counters/import?mode=replace", data=b"")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post("/counters/import", data=b'{"name": "foo", "counter": 1}\nfoo\n')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("Line 2", resp.get_json()["message"])
+        Counter("foo", 2**63 - 1).save()
+        resp = self.app.post("/counters/import", data=b'{"name": "bar", "counter": 1}\n{"name": "foo", "counter": 1}\n')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIsNone(Counter.read("bar"))
+
+    def test_msgpack(self):
+        """It should answer in MessagePack when the client asks for it"""
+        self.test_create_counter()
+        headers = {"Accept": "application/msgpack"}
+        resp = self.app.get("/counters/foo", headers=headers)
+        self.assertEqual(resp.mimetype, "application/msgpack")
+        self.assertEqual(msgpack.unpackb(resp.get_data()), {"name": "foo", "counter": 0})
+        self.assertNotEqual(resp.headers["ETag"], self.app.get("/counters/foo").headers["ETag"])
+        resp = self.app.get("/counters/bar", headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(msgpack.unpackb(resp.get_data())["error"], "Not Found")
+        resp = self.app.get("/counters?limit=10", headers=headers)
+        self.assertEqual(msgpack.unpackb(resp.get_data()), [{"name": "foo", "counter": 0}])
+
+    def test_msgpack_streamed(self):
+        """It should Stream every counter as MessagePack maps"""
+        for i in range(7):
+            self.app.post(f"/counters/foo{i}")
+        pages = Counter.pages
+        with patch.object(Counter, "pages", lambda _limit: pages(3)):
+            resp = self.app.get("/counters", headers={"Accept": "application/msgpack"})
+        self.assertEqual(resp.mimetype, "application/msgpack")
+        self.assertTrue(resp.headers["ETag"].endswith('-msgpack"'))
+        counters = list(msgpack.Unpacker(BytesIO(resp.get_data())))
+        self.assertEqual(sorted(counter["name"] for counter in counters), [f"foo{i}" for i in range(7)])
+
+    def test_get_counter_etag(self):
+        """It should answer a conditional GET of an unchanged counter with 304"""
+        self.test_create_counter()
+        resp = self.app.get("/counters/foo")
+        etag = resp.headers["ETag"]
+        resp = self.app.get("/counters/foo", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(resp.headers["ETag"], etag)
+        self.assertEqual(resp.get_data(), b"")
+        self.app.put("/counters/foo")
+        resp = self.app.get("/counters/foo", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+
+    def test_list_counters_etag(self):
+        """It should answer a conditional GET of unchanged listings with 304"""
+        self.test_create_counter()
+        resp = self.app.get("/counters")
+        etag = resp.headers["ETag"]
+        self.assertEqual(resp.headers["Vary"], "Accept")
+        resp = self.app.get("/counters", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        resp = self.app.get("/counters", headers={"If-None-Match": etag, "Accept": "application/x-ndjson"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.get("/counters?limit=10")
+        self.assertEqual(resp.headers["ETag"], etag)
+        resp = self.app.get("/counters?limit=10", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.app.put("/counters/foo")
+        resp = self.app.get("/counters", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+
+    def test_list_counters_paginated(self):
+        """It should Get the counters one page at a time"""
+        for i in range(15):
+            resp = self.app.post(f"/counters/foo{i}")
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        names = []
+        cursor = ""
+        while True:
+            resp = self.app.get(f"/counters?cursor={cursor}&limit=5")
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(resp.headers["X-Total-Count"], "15")
+            names.extend(counter["name"] for counter in resp.get_json())
+            if "X-Next-Cursor" not in resp.headers:
+                self.assertNotIn("Link", resp.headers)
+                break
+            cursor = resp.headers["X-Next-Cursor"]
+            self.assertIn('rel="next"', resp.headers["Link"])
+        self.assertEqual(sorted(names), sorted(f"foo{i}" for i in range(15)))
+
+    def test_list_counters_cursor(self):
+        """It should resume a listing after the last name of the previous page"""
+        for name in ["a", "b", "c", "z\u00e4hler"]:
+            resp = self.app.post(f"/counters/{quote(name)}")
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        resp = self.app.get("/counters?limit=2")
+        self.assertEqual(resp.headers["X-Next-Cursor"], "b")
+        # deleting a counter that was already listed does not shift the next page
+        self.app.delete("/counters/a")
+        resp = self.app.get("/counters?cursor=b&limit=2")
+        self.assertEqual([counter["name"] for counter in resp.get_json()], ["c", "z\u00e4hler"])
+        self.assertEqual(resp.headers["X-Next-Cursor"], "z%C3%A4hler")
+        resp = self.app.get(f"/counters?cursor={resp.headers['X-Next-Cursor']}&limit=2")
+        self.assertEqual(resp.get_json(), [])
+        self.assertNotIn("X-Next-Cursor", resp.headers)
+
+    def test_list_counters_bad_page(self):
+        """It should not Get counters with a bad limit"""
+        resp = self.app.get("/counters?limit=abc")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get("/counters?limit=0")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_get_counter(self):
         """It should Get a counter"""
         self.test_create_counter()
@@ -137,11 +413,282 @@ class ServiceTest(TestCase):
         resp = self.app.delete("/counters/foo")
         self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
 
+    def test_purge_counters(self):
+        """It should Purge every counter in the background"""
+        self.test_create_counter()
+        resp = self.app.get("/admin/purge")
+        self.assertEqual(resp.get_json(), {"state": "idle"})
+        resp = self.app.post("/admin/purge")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post("/admin/purge?confirm=true")
+        self.assertEqual(resp.status_code, status.HTTP_202_ACCEPTED)
+        self.assertTrue(resp.headers["Location"].endswith("/admin/purge"))
+        self.assertIn(resp.get_json()["state"], ("running", "done"))
+        deadline = time.monotonic() + 5
+        while resp.get_json()["state"] == "running" and time.monotonic() < deadline:
+            time.sleep(0.01)
+            resp = self.app.get("/admin/purge")
+        self.assertEqual(resp.get_json()["state"], "done")
+        self.assertEqual(resp.get_json()["done"], 1)
+        resp = self.app.get("/counters/foo")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        # a counter may be named purge again
+        resp = self.app.post("/counters/purge")
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.app.get("/admin/purge").get_json()["state"], "done")
+
+    def test_purge_running(self):
+        """It should not start a purge while another is running"""
+        Counter.redis.set(PURGE_LOCK_KEY, "other", ex=30)
+        resp = self.app.post("/admin/purge?confirm=true")
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+
+    def test_migrate_counters(self):
+        """It should Move counters kept under bare key names once confirmed"""
+        resp = self.app.post("/admin/migrate")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        with patch.object(Counter, "migrate_keys", return_value={"migrated": 2, "skipped": ["foo"]}):
+            resp = self.app.post("/admin/migrate?confirm=true")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"migrated": 2, "skipped": ["foo"]})
+
+    def test_name_separator(self):
+        """It should not let one counter's name reach another counter's keys"""
+        self.test_create_counter()
+        self.app.put("/counters/foo/shards", json={"shards": 2})
+        for method in (self.app.post, self.app.put, self.app.get, self.app.delete):
+            resp = method("/counters/foo:shard:0")
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post("/counters/foo:uniques")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post("/counters/foo/uniques", json={"member": "a"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.app.get("/counters/foo").get_json()["counter"], 0)
+
+    def test_reserved_names(self):
+        """It should not Create counters named after the routes under /counters"""
+        for name in ("export", "top", "uniques"):
+            resp = self.app.post(f"/counters/{name}")
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, name)
+            self.assertIsNone(Counter.find(name))
+        resp = self.app.post("/counters/batch", json=[{"name": "top"}])
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post("/counters/import", data=b'{"name": "import", "counter": 1}\n')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_method_not_allowed(self):
         """It should not allow usuported Methods"""
         resp = self.app.post("/counters")
         self.assertEqual(resp.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
 
+    def test_batch_update_counters(self):
+        """It should Increment many counters in one request"""
+        self.app.post("/counters/foo")
+        self.app.post("/counters/bar")
+        batch = [{"name": "foo"}, {"name": "bar", "delta": 10}, {"name": "foo", "delta": 2}]
+        resp = self.app.post("/counters/batch", json=batch)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(
+            data,
+            [
+                {"name": "foo", "counter": 1},
+                {"name": "bar", "counter": 10},
+                {"name": "foo", "counter": 3},
+            ],
+        )
+
+    def test_batch_update_not_found(self):
+        """It should not Increment a batch holding a missing counter"""
+        self.app.post("/counters/foo")
+        resp = self.app.post("/counters/batch", json=[{"name": "foo"}, {"name": "bar"}])
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertIn("bar", resp.get_json()["message"])
+        resp = self.app.get("/counters/foo")
+        self.assertEqual(resp.get_json()["counter"], 0)
+
+    def test_batch_update_overflow(self):
+        """It should answer 400 for deltas that do not fit in a signed 64 bit integer"""
+        self.app.post("/counters/foo")
+        resp = self.app.post("/counters/batch", json=[{"name": "foo", "delta": 2**70}])
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post("/counters/batch", json=[{"name": "foo", "delta": 2**62}] * 2)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.app.get("/counters/foo").get_json()["counter"], 0)
+        self.assertEqual(Counter.redis.breaker.state, "closed")
+
+    def test_batch_update_bad_request(self):
+        """It should not Increment a malformed batch"""
+        for batch in ([], {"name": "foo"}, ["foo"], [{"name": ""}], [{"name": "foo", "delta": "1"}], [{"name": "foo:shard:0"}],
+                      [{"name": "foo", "delta": True}], [{"name": "foo"}] * 1001):
+            resp = self.app.post("/counters/batch", json=batch)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, batch)
+        resp = self.app.post("/counters/batch", data="foo", content_type="text/plain")
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+    def test_write_behind_mode(self):
+        """It should Read, Update and Delete counters with write-behind enabled"""
+        self.test_create_counter()
+        Counter.enable_write_behind(interval=60, max_pending=1000, staleness=60)
+        try:
+            for expected in (1, 2, 3):
+                resp = self.app.put("/counters/foo")
+                self.assertEqual(resp.status_code, status.HTTP_200_OK)
+                self.assertEqual(resp.get_json()["counter"], expected)
+            resp = self.app.get("/counters/foo")
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(resp.get_json()["counter"], 3)
+            self.assertEqual(Counter.redis.get(counter_key("foo")), "0")
+            Counter.buffer.flush()
+            self.assertEqual(Counter.redis.get(counter_key("foo")), "3")
+
+            resp = self.app.put("/counters/bar")
+            self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+            resp = self.app.get("/counters/bar")
+            self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+            resp = self.app.delete("/counters/foo")
+            self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        finally:
+            Counter.disable_write_behind()
+        self.assertIsNone(Counter.buffer)
+        self.assertIsNone(Counter.redis.get(counter_key("foo")))
+
+    def test_write_behind_overflow(self):
+        """It should answer 400 for an increment that would overflow with write-behind enabled"""
+        Counter("big", 2**63 - 1).save()
+        Counter("other", 0).save()
+        Counter.enable_write_behind(interval=60, max_pending=1000, staleness=60)
+        try:
+            resp = self.app.put("/counters/big")
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+            resp = self.app.put("/counters/other")
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            Counter.buffer.flush()
+            Counter.buffer.flush()
+        finally:
+            Counter.disable_write_behind()
+        self.assertEqual(Counter.redis.get(counter_key("big")), str(2**63 - 1))
+        self.assertEqual(Counter.redis.get(counter_key("other")), "1")
+
+    def test_read_cache_mode(self):
+        """It should serve Reads from the read cache when it is enabled"""
+        resp = self.app.get("/stats")
+        self.assertIsNone(resp.get_json()["cache"])
+        self.assertIn("in_use", resp.get_json()["pool"])
+        self.test_create_counter()
+        Counter.enable_read_cache(max_size=100)
+        try:
+            for _ in range(3):
+                resp = self.app.get("/counters/foo")
+                self.assertEqual(resp.get_json()["counter"], 0)
+            resp = self.app.put("/counters/foo")
+            self.assertEqual(resp.get_json()["counter"], 1)
+            resp = self.app.get("/counters/foo")
+            self.assertEqual(resp.get_json()["counter"], 1)
+            resp = self.app.get("/counters/bar")
+            self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+            resp = self.app.get("/stats")
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            cache = resp.get_json()["cache"]
+            self.assertEqual(cache["hits"], 2)
+            self.assertEqual(cache["misses"], 3)
+            self.assertEqual(cache["invalidations"], 1)
+        finally:
+            Counter.disable_read_cache()
+        self.assertIsNone(Counter.cache)
+
+    def test_top_counters(self):
+        """It should List the top counters and the rank of one"""
+        for name, hits in (("foo", 3), ("bar", 1), ("baz", 2)):
+            self.app.post(f"/counters/{name}")
+            for _ in range(hits):
+                self.app.put(f"/counters/{name}")
+        resp = self.app.get("/counters/top?k=2")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), [{"name": "foo", "counter": 3}, {"name": "baz", "counter": 2}])
+        resp = self.app.get("/counters/top")
+        self.assertEqual(len(resp.get_json()), 3)
+        resp = self.app.get("/counters/top?k=0")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get("/counters/bar/rank")
+        self.assertEqual(resp.get_json(), {"name": "bar", "counter": 1, "rank": 3})
+        resp = self.app.get("/counters/qux/rank")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_rate_counter(self):
+        """It should Read how much a counter was incremented recently"""
+        self.test_create_counter()
+        self.app.put("/counters/foo")
+        self.app.post("/counters/batch", json=[{"name": "foo", "delta": 4}])
+        resp = self.app.get("/counters/foo/rate")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"name": "foo", "window": 60, "count": 5})
+        resp = self.app.get("/counters/foo/rate?window=1h")
+        self.assertEqual(resp.get_json()["count"], 5)
+        resp = self.app.get("/counters/foo/rate?window=forever")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get("/counters/bar/rate")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_uniques(self):
+        """It should Count unique members of counters"""
+        self.test_create_counter()
+        self.app.post("/counters/bar")
+        resp = self.app.post("/counters/foo/uniques", json={"member": "alice"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"name": "foo", "uniques": 1})
+        resp = self.app.post("/counters/foo/uniques", json={"members": ["alice", "bob"]})
+        self.assertEqual(resp.get_json()["uniques"], 2)
+        self.app.post("/counters/bar/uniques", json={"members": ["bob", "carol"]})
+        resp = self.app.get("/counters/foo/uniques")
+        self.assertEqual(resp.get_json(), {"name": "foo", "uniques": 2})
+        resp = self.app.get("/counters/uniques?names=foo,bar")
+        self.assertEqual(resp.get_json(), {"names": ["foo", "bar"], "uniques": 3})
+        resp = self.app.post("/counters/foo/uniques/merge", json={"names": ["bar"]})
+        self.assertEqual(resp.get_json(), {"name": "foo", "uniques": 3})
+
+    def test_uniques_bad_request(self):
+        """It should not Count unique members of missing counters or bad requests"""
+        self.test_create_counter()
+        resp = self.app.post("/counters/foo/uniques", json={"members": "alice"})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get("/counters/uniques")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post("/counters/foo/uniques/merge", json=["bar"])
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post("/counters/qux/uniques", json={"member": "alice"})
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.get("/counters/qux/uniques")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.post("/counters/foo/uniques/merge", json={"names": ["qux"]})
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_shard_counter(self):
+        """It should Promote and demote a counter between plain and sharded"""
+        self.test_create_counter()
+        self.app.put("/counters/foo")
+        resp = self.app.put("/counters/foo/shards", json={"shards": 4})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {"name": "foo", "counter": 1, "shards": 4})
+        for count in range(2, 10):
+            resp = self.app.put("/counters/foo")
+            self.assertEqual(resp.get_json()["counter"], count)
+        resp = self.app.put("/counters/foo/shards", json={"shards": 0})
+        self.assertEqual(resp.get_json(), {"name": "foo", "counter": 9, "shards": 0})
+        resp = self.app.get("/counters/foo")
+        self.assertEqual(resp.get_json()["counter"], 9)
+
+    def test_shard_counter_bad_request(self):
+        """It should not Shard a missing counter or an invalid number of shards"""
+        self.test_create_counter()
+        for body in ({"shards": -1}, {"shards": 65}, {"shards": "2"}, {"shards": True}, [2], {}):
+            resp = self.app.put("/counters/foo/shards", json=body)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.put("/counters/bar/shards", json={"shards": 2})
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
     ######################################################################
     #  T E S T   E R R O R   H A N D L E R S
     ######################################################################
@@ -154,24 +701,22 @@ class ServiceTest(TestCase):
         resp = self.app.get("/counters/foo")
         self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
 
-    @patch("service.models.Counter.increment")
-    def test_failed_update_request(self, value_mock):
+    def test_failed_update_request(self):
         """It should handle Error for failed UPDATE"""
-        value_mock.return_value = 0
-        value_mock.side_effect = DatabaseConnectionError()
         self.test_create_counter()
-        resp = self.app.put("/counters/foo")
+        script = MagicMock(side_effect=DatabaseConnectionError())
+        with patch.dict(Counter.scripts, {"increment_existing": script}):
+            resp = self.app.put("/counters/foo")
         self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
 
-    @patch("service.models.Counter.__init__")
-    def test_failed_post_request(self, value_mock):
+    def test_failed_post_request(self):
         """It should handle Error for failed POST"""
-        value_mock.return_value = 0
-        value_mock.side_effect = DatabaseConnectionError()
-        resp = self.app.post("/counters/foo")
+        script = MagicMock(side_effect=DatabaseConnectionError())
+        with patch.dict(Counter.scripts, {"create": script}):
+            resp = self.app.post("/counters/foo")
         self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
 
-    @patch("service.routes.Counter.redis.keys")
+    @patch("service.routes.Counter.redis.zrangebylex")
     def test_failed_list_request(self, redis_mock):
         """It should handle Error for failed LIST"""
         redis_mock.return_value = 0
@@ -179,11 +724,41 @@ class ServiceTest(TestCase):
         resp = self.app.get("/counters")
         self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
 
+    def test_failed_write_behind_requests(self):
+        """It should handle Errors with write-behind enabled"""
+        self.test_create_counter()
+        Counter.enable_write_behind(interval=60, max_pending=1000, staleness=0)
+        try:
+            with patch("service.routes.Counter.redis.get") as redis_mock:
+                redis_mock.side_effect = DatabaseConnectionError()
+                resp = self.app.put("/counters/foo")
+                self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+                resp = self.app.get("/counters/foo")
+                self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        finally:
+            Counter.disable_write_behind()
+
     def test_failed_delete_request(self):
         """It should handle Error for failed DELETE"""
         self.test_create_counter()
-        with patch("service.routes.Counter.redis.get") as redis_mock:
-            redis_mock.return_value = 0
-            redis_mock.side_effect = DatabaseConnectionError()
+        script = MagicMock(side_effect=DatabaseConnectionError())
+        with patch.dict(Counter.scripts, {"delete": script}):
             resp = self.app.delete("/counters/foo")
             self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+
+    def test_redis_traffic(self):
+        """It should send each route's Redis commands in the fewest round trips"""
+        Counter.create("foo")
+        Counter.create("bar")
+        Counter.version()  # the first version after emptying the database also sets its epoch
+        readiness.reset()
+        # the shard layout is cached, so no route reloads it here
+        with patch.object(Counter, "layout_expires", float("inf")):
+            for method, url, body, commands, round_trips in REDIS_TRAFFIC:
+                with self.subTest(f"{method} {url}"):
+                    before = redis_traffic()
+                    resp = self.app.open(url, method=method, json=body)
+                    resp.get_data()
+                    after = redis_traffic()
+                    self.assertLess(resp.status_code, 500)
+                    self.assertEqual((after[0] - before[0], after[1] - before[1]), (commands, round_trips))
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the Response Serializers
+"""
+from datetime import date
+from unittest import TestCase
+from unittest.mock import patch
+import msgpack
+from flask import Flask, jsonify
+from service.common import serializers
+from service.common.serializers import MSGPACK, FastJSONProvider
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class SerializersTests(TestCase):
+    """Response Serializers Tests"""
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        serializers.init_app(self.app)
+        self.provider = self.app.json
+
+    def test_init_app(self):
+        """It should install the fast provider"""
+        self.assertIsInstance(self.provider, FastJSONProvider)
+
+    def test_encode(self):
+        """It should encode compact JSON with sorted keys"""
+        self.assertEqual(self.provider.encode({"name": "foo", "counter": 1}), b'{"counter":1,"name":"foo"}')
+        self.assertEqual(self.provider.dumps({1: date(2024, 1, 2)}), '{"1":"Tue, 02 Jan 2024 00:00:00 GMT"}')
+        self.assertEqual(self.provider.dumps([1], indent=2), "[\n  1\n]")
+
+    def test_wide_integers(self):
+        """It should fall back to json for integers wider than 64 bits"""
+        self.assertEqual(self.provider.encode([2**70]), b"[1180591620717411303424]")
+        self.assertEqual(self.provider.loads("[1180591620717411303424]"), [2**70])
+
+    def test_without_orjson(self):
+        """It should use json when orjson is not installed"""
+        with patch.object(serializers, "orjson", None):
+            self.assertEqual(self.provider.encode({"b": 1, "a": [1]}), b'{"a":[1],"b":1}')
+
+    def test_negotiation(self):
+        """It should answer in MessagePack only when the client prefers it"""
+        with self.app.test_request_context(headers={"Accept": MSGPACK}):
+            resp = jsonify(name="foo", counter=1)
+            self.assertEqual(resp.mimetype, MSGPACK)
+            self.assertEqual(msgpack.unpackb(resp.get_data()), {"name": "foo", "counter": 1})
+            self.assertIn("Accept", resp.vary)
+        with self.app.test_request_context(headers={"Accept": "application/json, application/msgpack;q=0.5"}):
+            resp = jsonify([1, 2])
+            self.assertEqual(resp.mimetype, "application/json")
+            self.assertEqual(resp.get_data(), b"[1,2]\n")
+        with self.app.test_request_context(headers={"Accept": MSGPACK}):
+            with patch.object(serializers, "msgpack", None):
+                self.assertFalse(serializers.accepts_msgpack())
+        self.assertFalse(serializers.accepts_msgpack())
+
+    def test_pretty_print(self):
+        """It should pretty print JSON in debug mode"""
+        self.app.debug = True
+        with self.app.test_request_context():
+            self.assertEqual(jsonify(a=1).get_data(), b'{\n  "a": 1\n}\n')
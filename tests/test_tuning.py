@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the Worker Tuning
+"""
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+from service.common import tuning
+
+MEBIBYTE = 1024 * 1024
+
+
+def write(root: str, path: str, text: str) -> None:
+    """Writes a fake cgroup file"""
+    path = os.path.join(root, path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as file:
+        file.write(text + "\n")
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TuningTests(TestCase):
+    """Worker Tuning Tests"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def test_cgroup_v2_limits(self):
+        """It should Read the CPU and memory limits of a cgroup v2"""
+        write(self.root, "cpu.max", "25000 100000")
+        write(self.root, "memory.max", str(64 * MEBIBYTE))
+        self.assertEqual(tuning.cpu_limit(self.root), 0.25)
+        self.assertEqual(tuning.memory_limit(self.root), 64 * MEBIBYTE)
+
+    def test_cgroup_v1_limits(self):
+        """It should Read the CPU and memory limits of a cgroup v1"""
+        write(self.root, "cpu/cpu.cfs_quota_us", "200000")
+        write(self.root, "cpu/cpu.cfs_period_us", "100000")
+        write(self.root, "memory/memory.limit_in_bytes", str(512 * MEBIBYTE))
+        self.assertEqual(tuning.cpu_limit(self.root), 2.0)
+        self.assertEqual(tuning.memory_limit(self.root), 512 * MEBIBYTE)
+
+    def test_unlimited(self):
+        """It should Treat missing or unlimited cgroup values as no limit"""
+        self.assertIsNone(tuning.cpu_limit(self.root))
+        self.assertIsNone(tuning.memory_limit(self.root))
+        write(self.root, "cpu.max", "max 100000")
+        write(self.root, "memory.max", "max")
+        self.assertIsNone(tuning.cpu_limit(self.root))
+        self.assertIsNone(tuning.memory_limit(self.root))
+        write(self.root, "memory/memory.limit_in_bytes", str(1 << 62))
+        os.remove(os.path.join(self.root, "memory.max"))
+        self.assertIsNone(tuning.memory_limit(self.root))
+
+    def test_container_limits(self):
+        """It should Never use more CPUs than the host has"""
+        write(self.root, "cpu.max", "6400000 100000")
+        with patch.object(tuning, "host_cpus", return_value=2):
+            self.assertEqual(tuning.container_limits(self.root), (2, None))
+            self.assertEqual(tuning.container_limits(tempfile.mkdtemp()), (2, None))
+        with patch("os.sched_getaffinity", side_effect=AttributeError()):
+            self.assertGreaterEqual(tuning.host_cpus(), 1)
+
+    @patch("importlib.util.find_spec", return_value=None)
+    def test_tune_small_pod(self, _):
+        """It should Run one threaded worker in a small pod"""
+        settings = tuning.tune(0.25, 64 * MEBIBYTE, {})
+        self.assertEqual(settings["workers"], 1)
+        self.assertEqual(settings["worker_class"], "gthread")
+        self.assertEqual(settings["threads"], 4)
+        self.assertEqual(settings["timeout"], 60)
+        self.assertTrue(settings["preload_app"])
+
+    @patch("importlib.util.find_spec", return_value=None)
+    def test_tune_large_host(self, _):
+        """It should Run 2 x CPUs + 1 workers unless memory runs out"""
+        self.assertEqual(tuning.tune(4, None, {})["workers"], 9)
+        self.assertEqual(tuning.tune(4, 200 * MEBIBYTE, {})["workers"], 5)
+        self.assertEqual(tuning.tune(4, None, {})["timeout"], 30)
+
+    @patch("importlib.util.find_spec", return_value=object())
+    def test_tune_gevent(self, _):
+        """It should Use gevent workers without preloading when gevent is installed"""
+        settings = tuning.tune(1, None, {})
+        self.assertEqual(settings["worker_class"], "gevent")
+        self.assertEqual(settings["worker_connections"], 100)
+        self.assertFalse(settings["preload_app"])
+
+    def test_tune_overrides(self):
+        """It should Let GUNICORN_* variables override every setting"""
+        env = {
+            "GUNICORN_WORKERS": "7",
+            "GUNICORN_WORKER_CLASS": "sync",
+            "GUNICORN_TIMEOUT": "10",
+            "GUNICORN_KEEPALIVE": "1",
+            "GUNICORN_PRELOAD_APP": "false",
+        }
+        settings = tuning.tune(1, None, env)
+        self.assertEqual(settings["workers"], 7)
+        self.assertEqual(settings["worker_class"], "sync")
+        self.assertEqual(settings["threads"], 1)
+        self.assertEqual(settings["timeout"], 10)
+        self.assertEqual(settings["keepalive"], 1)
+        self.assertFalse(settings["preload_app"])
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the Write-Behind Buffer
+"""
+import os
+import time
+import threading
+import logging
+from unittest import TestCase
+from unittest.mock import patch
+from redis import Redis
+from redis.exceptions import ConnectionError as RedisConnectionError
+from service.common.write_behind import WriteBehindBuffer
+from service.models import Counter, CounterOverflowError, counter_key
+
+DATABASE_URI = os.getenv("DATABASE_URI", "redis://:@localhost:6379/0")
+
+logging.disable(logging.CRITICAL)
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class WriteBehindTests(TestCase):
+    """Write-Behind Buffer Tests"""
+
+    def setUp(self):
+        """This runs before each test"""
+        self.redis = Redis.from_url(DATABASE_URI, decode_responses=True)
+        self.redis.flushall()
+        self.redis.set("foo", 5)
+        self.buffer = WriteBehindBuffer(lambda: self.redis, interval=60, max_pending=100, staleness=60)
+
+    def tearDown(self):
+        """This runs after each test"""
+        self.buffer.stop()
+        self.redis.close()
+
+    def test_increment_is_buffered(self):
+        """It should Buffer increments until flushed"""
+        self.assertEqual(self.buffer.increment("foo"), 6)
+        self.assertEqual(self.buffer.increment("foo", 2), 8)
+        self.assertEqual(self.redis.get("foo"), "5")
+        self.assertEqual(self.buffer.read("foo"), 8)
+        self.buffer.flush()
+        self.assertEqual(self.redis.get("foo"), "8")
+        self.assertEqual(self.buffer.read("foo"), 8)
+
+    def test_missing_counter(self):
+        """It should return None for counters that do not exist"""
+        self.assertIsNone(self.buffer.increment("bar"))
+        self.assertIsNone(self.buffer.read("bar"))
+        self.buffer.flush()
+        self.assertIsNone(self.redis.get("bar"))
+
+    def test_staleness_bound(self):
+        """It should re-read values older than the staleness bound"""
+        self.buffer.staleness = 0
+        self.assertEqual(self.buffer.read("foo"), 5)
+        self.redis.set("foo", 10)
+        time.sleep(0.01)
+        self.assertEqual(self.buffer.read("foo"), 10)
+
+    def test_discard(self):
+        """It should Discard increments of a deleted counter"""
+        self.buffer.increment("foo")
+        self.buffer.discard("foo")
+        self.buffer.flush()
+        self.assertEqual(self.redis.get("foo"), "5")
+
+    def test_clear(self):
+        """It should Clear everything that is buffered"""
+        self.buffer.increment("foo")
+        self.buffer.clear()
+        self.buffer.flush()
+        self.assertEqual(self.redis.get("foo"), "5")
+
+    def test_failed_flush_is_retried(self):
+        """It should keep increments when a flush fails"""
+        self.buffer.increment("foo", 3)
+        with patch("redis.client.Pipeline.execute", side_effect=RedisConnectionError()):
+            self.buffer.flush()
+        self.assertEqual(self.redis.get("foo"), "5")
+        self.assertEqual(self.buffer.read("foo"), 8)
+        self.buffer.flush()
+        self.assertEqual(self.redis.get("foo"), "8")
+
+    def test_overflow_is_refused(self):
+        """It should refuse an increment that would overflow without buffering it"""
+        self.redis.set("big", 2**63 - 1)
+        with self.assertRaises(OverflowError):
+            self.buffer.increment("big")
+        self.assertEqual(self.buffer.increment("foo"), 6)
+        self.buffer.flush()
+        self.assertEqual(self.redis.get("big"), str(2**63 - 1))
+        self.assertEqual(self.redis.get("foo"), "6")
+
+    def test_flush_drops_overflow(self):
+        """It should write the rest of a batch once and drop an increment that overflows"""
+        self.redis.set("big", 2**63 - 2)
+        self.assertEqual(self.buffer.read("big"), 2**63 - 2)
+        # another process takes the counter to the limit after it was read
+        self.redis.incr("big")
+        self.assertEqual(self.buffer.increment("big"), 2**63 - 1)
+        self.assertEqual(self.buffer.increment("foo"), 6)
+        self.buffer.flush()
+        self.buffer.flush()
+        self.assertEqual(self.redis.get("big"), str(2**63 - 1))
+        self.assertEqual(self.redis.get("foo"), "6")
+        self.assertEqual(self.buffer.read("foo"), 6)
+
+    def test_counter_flush_drops_overflow(self):
+        """It should flush a batch of counters once when one of them overflows"""
+        Counter.connect(DATABASE_URI)
+        Counter("big", 2**63 - 2).save()
+        Counter("other", 0).save()
+        Counter.enable_write_behind(interval=60, max_pending=1000, staleness=60)
+        try:
+            self.assertEqual(Counter.increment_behind("big"), 2**63 - 1)
+            with self.assertRaises(CounterOverflowError):
+                Counter.increment_behind("big")
+            self.assertEqual(Counter.increment_behind("other"), 1)
+            Counter.increment_existing("big")
+            for _ in range(3):
+                Counter.buffer.flush()
+            self.assertEqual(Counter.read("big"), 2**63 - 1)
+            self.assertEqual(Counter.read("other"), 1)
+            self.assertEqual(Counter.read_behind("other"), 1)
+        finally:
+            Counter.disable_write_behind()
+
+    def test_failed_part_is_retried(self):
+        """It should retry only the increments a flush reports as not written"""
+        self.redis.set("bar", 0)
+
+        def write(batch):
+            self.redis.incrby("bar", batch["bar"])
+            return {"foo": RedisConnectionError(), "bar": int(self.redis.get("bar"))}
+
+        self.buffer.write = write
+        self.buffer.increment("foo", 2)
+        self.buffer.increment("bar")
+        self.buffer.flush()
+        self.assertEqual(self.redis.get("bar"), "1")
+        self.assertEqual(self.buffer.read("foo"), 7)
+        self.buffer.write = self.buffer._incrby
+        self.buffer.flush()
+        self.assertEqual(self.redis.get("foo"), "7")
+        self.assertEqual(self.redis.get("bar"), "1")
+
+    def test_read_during_flush(self):
+        """It should only make reads of the counters being flushed wait for the flush"""
+        self.redis.set("bar", 1)
+        self.buffer.staleness = 0
+        writing, release = threading.Event(), threading.Event()
+        incrby = self.buffer.write
+
+        def slow_write(batch):
+            writing.set()
+            release.wait(5)
+            return incrby(batch)
+
+        self.buffer.write = slow_write
+        self.buffer.increment("foo", 2)
+        flusher = threading.Thread(target=self.buffer.flush)
+        flusher.start()
+        self.assertTrue(writing.wait(5))
+        self.assertEqual(self.buffer.read("bar"), 1)
+        values = []
+        reader = threading.Thread(target=lambda: values.append(self.buffer.read("foo")))
+        reader.start()
+        reader.join(0.1)
+        self.assertTrue(reader.is_alive())
+        release.set()
+        flusher.join(5)
+        reader.join(5)
+        self.assertEqual(values, [7])
+        self.assertEqual(self.redis.get("foo"), "7")
+
+    def test_background_flush(self):
+        """It should Flush in the background once the buffer is full"""
+        self.buffer.max_pending = 2
+        self.buffer.start()
+        self.buffer.increment("foo")
+        self.buffer.increment("foo")
+        for _ in range(100):
+            if self.redis.get("foo") == "7":
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.redis.get("foo"), "7")
+
+    def test_stop_flushes(self):
+        """It should Flush what is left when stopped"""
+        self.buffer.start()
+        self.buffer.increment("foo")
+        self.buffer.stop()
+        self.assertEqual(self.redis.get("foo"), "6")
+
+    def test_flush_does_not_recreate(self):
+        """It should not re-create a counter deleted before the flush"""
+        Counter.connect(DATABASE_URI)
+        Counter("foo", 5).save()
+        buffer = WriteBehindBuffer(lambda: self.redis, interval=60, write=Counter._increment, read=Counter._value)
+        try:
+            self.assertEqual(buffer.increment("foo"), 6)
+            Counter.delete("foo")
+            buffer.flush()
+            self.assertIsNone(self.redis.get(counter_key("foo")))
+            self.assertIsNone(buffer.read("foo"))
+        finally:
+            buffer.stop()
+
+    def test_flush_sharded_counter(self):
+        """It should Flush increments of a sharded counter to its shards"""
+        Counter.connect(DATABASE_URI)
+        Counter("foo", 5).save()
+        Counter.reshard("foo", 4)
+        buffer = WriteBehindBuffer(lambda: self.redis, interval=60, write=Counter._increment, read=Counter._value)
+        try:
+            self.assertEqual(buffer.increment("foo", 3), 8)
+            buffer.flush()
+            self.assertEqual(self.redis.get(counter_key("foo")), "5")
+            self.assertEqual(buffer.read("foo"), 8)
+            self.assertEqual(Counter.read("foo"), 8)
+        finally:
+            buffer.stop()